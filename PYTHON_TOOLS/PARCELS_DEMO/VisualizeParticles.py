@@ -1,6 +1,4 @@
-from parcels import plotTrajectoriesFile
-import matplotlib.pyplot as plt
+# Streams the file by time over the cached base map (animate_trajectories.py)
+from animate_trajectories import animate
 
-plotTrajectoriesFile("tBelize_nemo_particles.nc");
-
-plt.savefig('./pFIGURES/postTrajPlotT1.png', dpi=100)
\ No newline at end of file
+animate("tBelize_nemo_particles.nc", './pFIGURES/postTrajAnimT1.gif')
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""
+animate_trajectories.py
+
+Animate Parcels trajectory output over the diagnostics' base map, streaming
+the observations by time.
+
+** Summary **
+plotTrajectoriesFile reads the whole (traj, obs) file and draws one figure.
+Here the file is read a block of obs columns at a time and the positions are
+grouped by output time. A time is drawn as soon as it is complete: every
+particle still running has been read past it (particles released later start
+their obs later, so the columns of a block cover different times). Only the
+positions of the times not yet complete are held, so memory does not grow
+with the length of the trajectories.
+
+The map (projection, base map layers from NEMO_basemap, gridlines) is drawn
+once and kept as a background (NEMO_anim_writer.Blitter). Each frame only
+updates and draws the particles and the title:
+    points      scatter of the positions, every --decimate'th trajectory
+                (only those are read)
+    density     particle count per lon/lat bin (np.histogram2d), for
+                ensembles too large to scatter
+and is streamed to GIF or MP4 by NEMO_anim_writer.AnimationWriter. In density
+mode the background is drawn again when the colour scale (and so the
+colorbar) grows.
+
+** Useage**::
+python animate_trajectories.py tBelize_ensemble.nc --output pFIGURES/tBelize.mp4
+python animate_trajectories.py tBelize_ensemble.nc --mode density --bins 200 150 --output pFIGURES/tBelize_density.gif
+"""
+
+#### Imports
+import os
+import sys
+import argparse
+import numpy as np
+import matplotlib
+matplotlib.use('Agg') # frames go to the writer, not the screen
+import matplotlib.pyplot as plt
+import matplotlib.colors as colors
+import cartopy.crs as ccrs
+from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+from netCDF4 import Dataset, num2date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PYTHON_DIAGNOSTICS'))
+from NEMO_basemap import add_base_map # cached Natural Earth layers
+from NEMO_anim_writer import AnimationWriter, Blitter # stream frames to gif / mp4
+
+
+#### Constants
+BLOCK_VALUES = 2000000 # (traj x obs) values read at a time, per variable
+BASEMAP_CACHE = 'BASEMAP_CACHE'
+
+
+###################### FUNCTIONS ############################
+
+def stream_frames(traj_file, decimate=1, block=None):
+    """
+    Positions at each output time, in time order, reading block obs columns at a time
+    decimate - read every decimate'th trajectory
+    Yields: time, lon array, lat array
+    """
+    with Dataset(traj_file) as nc:
+        ntraj = len(range(0, len(nc.dimensions['traj']), decimate))
+        nobs = len(nc.dimensions['obs'])
+        if block is None:
+            block = max(1, BLOCK_VALUES // max(1, ntraj))
+        pending = {} # time: list of (lon, lat) not yet complete
+        for k0 in range(0, nobs, block):
+            cols = slice(k0, min(k0+block, nobs))
+            tim, lon, lat = [np.ma.filled(nc.variables[name][::decimate, cols].astype(float), np.nan)
+                             for name in ['time', 'lon', 'lat']]
+            ok = np.isfinite(tim) & np.isfinite(lon) & np.isfinite(lat)
+            times, inverse = np.unique(tim[ok], return_inverse=True)
+            order = np.argsort(inverse, kind='stable')
+            bounds = np.searchsorted(inverse[order], np.arange(len(times)+1))
+            lon_ok, lat_ok = lon[ok][order], lat[ok][order]
+            for itime, tval in enumerate(times):
+                part = slice(bounds[itime], bounds[itime+1])
+                pending.setdefault(tval, []).append((lon_ok[part], lat_ok[part]))
+
+            running = ok[:, -1] # particles with an observation in the last column read
+            complete = tim[running, -1].min() if running.any() else np.inf
+            for tval in sorted(pending):
+                if tval > complete:
+                    break
+                yield (tval,) + join_positions(pending.pop(tval))
+        for tval in sorted(pending):
+            yield (tval,) + join_positions(pending.pop(tval))
+
+def join_positions(parts):
+    """ Concatenate a list of (lon, lat) array pairs. Returns: lon, lat """
+    return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
+
+def trajectory_extent(traj_file, decimate=1, margin=0.05):
+    """ lon, lat limits of all the positions, plus a margin. Returns: xlim, ylim """
+    lo = np.array([np.inf, np.inf])
+    hi = -lo
+    with Dataset(traj_file) as nc:
+        ntraj = len(nc.dimensions['traj'])
+        nobs = len(nc.dimensions['obs'])
+        chunk = max(1, BLOCK_VALUES // max(1, nobs))
+        for i0 in range(0, ntraj, chunk*decimate):
+            rows = slice(i0, min(i0+chunk*decimate, ntraj), decimate)
+            for idim, name in enumerate(['lon', 'lat']):
+                data = np.ma.filled(nc.variables[name][rows, :].astype(float), np.nan)
+                if np.isfinite(data).any():
+                    lo[idim] = min(lo[idim], np.nanmin(data))
+                    hi[idim] = max(hi[idim], np.nanmax(data))
+    pad = (hi - lo) * margin
+    return [lo[0]-pad[0], hi[0]+pad[0]], [lo[1]-pad[1], hi[1]+pad[1]]
+
+def time_label(tval, time_attrs):
+    """ Date of tval if the time variable has units, else the value """
+    if 'units' in time_attrs:
+        try:
+            return str(num2date(tval, time_attrs['units'], time_attrs.get('calendar', 'standard')))
+        except ValueError:
+            pass
+    return '{:g}'.format(tval)
+
+def animate(traj_file, output, mode='points', decimate=1, bins=(200, 150), xlim=None, ylim=None,
+            fps=10, cache_dir=BASEMAP_CACHE, natural_earth_dir=None, draw_features=True):
+    """
+    Draw the map once, then a frame per output time, streamed to output (.gif or .mp4)
+    mode - 'points' or 'density'
+    decimate - points mode: draw every decimate'th trajectory
+    bins - density mode: number of lon, lat bins
+    """
+    if xlim is None or ylim is None:
+        xlim, ylim = trajectory_extent(traj_file, decimate if mode == 'points' else 1)
+    with Dataset(traj_file) as nc:
+        tvar = nc.variables['time']
+        time_attrs = {key: tvar.getncattr(key) for key in tvar.ncattrs()}
+
+    fig = plt.figure()
+    ax = plt.subplot(1,1,1, projection=ccrs.PlateCarree())
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    if draw_features:
+        add_base_map(ax, xlim, ylim, cache_dir=cache_dir, natural_earth_dir=natural_earth_dir)
+    gl = ax.gridlines(crs=ccrs.PlateCarree(), draw_labels=True,
+                      linewidth=0.5, color='gray', alpha=0.5, linestyle='-')
+    gl.xlabels_top = False
+    gl.ylabels_right = False
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+
+    if mode == 'density':
+        xedges = np.linspace(xlim[0], xlim[1], bins[0]+1)
+        yedges = np.linspace(ylim[0], ylim[1], bins[1]+1)
+        artist = ax.pcolormesh(xedges, yedges, np.ma.masked_all((bins[1], bins[0])),
+                               transform=ccrs.PlateCarree(), cmap='viridis', norm=colors.LogNorm(vmin=1, vmax=10))
+        plt.colorbar(artist, shrink=0.6, pad=.05, label='particles per bin')
+        vmax = 10.
+    else:
+        artist = ax.scatter([], [], s=2, c='k', transform=ccrs.PlateCarree())
+    title = ax.set_title('')
+    blitter = Blitter(fig, ax, [artist, title])
+
+    writer = AnimationWriter(output, fps=fps)
+    for tval, lon, lat in stream_frames(traj_file, decimate if mode == 'points' else 1):
+        if mode == 'density':
+            counts = np.histogram2d(lat, lon, bins=[yedges, xedges])[0]
+            artist.set_array(np.ma.masked_equal(counts, 0).ravel())
+            if counts.max() > vmax: # the colour scale only grows
+                vmax = counts.max()
+                artist.set_clim(1, vmax)
+                blitter.save_background() # with the new colorbar
+        else:
+            artist.set_offsets(np.column_stack([lon, lat]))
+        title.set_text('{} ({} particles)'.format(time_label(tval, time_attrs), len(lon)))
+        writer.append_frame(blitter.grab())
+    writer.close()
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Animate a Parcels trajectory file over the base map.')
+    parser.add_argument('traj_file',
+                help='Parcels trajectory file (traj, obs)')
+    parser.add_argument('--output', default='pFIGURES/trajectories.gif',
+                help='.gif or .mp4')
+    parser.add_argument('--mode', choices=['points', 'density'], default='points',
+                help='scatter the particles, or count them per bin')
+    parser.add_argument('--decimate', type=int, default=1,
+                help='points mode: draw every DECIMATE\'th trajectory')
+    parser.add_argument('--bins', nargs=2, type=int, default=[200, 150],
+                help='density mode: lon and lat bins')
+    parser.add_argument('--xlim', nargs=2, type=float,
+                help='longitude limits (default: the trajectories)')
+    parser.add_argument('--ylim', nargs=2, type=float,
+                help='latitude limits (default: the trajectories)')
+    parser.add_argument('--fps', type=int, default=10,
+                help='frames per second')
+    parser.add_argument('--basemap-cache', default=BASEMAP_CACHE,
+                help='directory of the clipped base map layers (shared with the diagnostics)')
+    parser.add_argument('--natural-earth-dir',
+                help='local Natural Earth data')
+    parser.add_argument('--no-features', action='store_true',
+                help='no base map layers')
+    args = parser.parse_args()
+
+    if os.path.dirname(args.output) and not os.path.isdir(os.path.dirname(args.output)):
+        os.makedirs(os.path.dirname(args.output))
+    animate(args.traj_file, args.output, args.mode, args.decimate, args.bins, args.xlim, args.ylim,
+            args.fps, args.basemap_cache, args.natural_earth_dir, not args.no_features)
@@ -0,0 +1,229 @@
+"""
+connectivity.py
+
+Source to destination connectivity matrices from Parcels trajectory output.
+
+** Summary **
+The trajectory file (traj, obs) is read a block of trajectories at a time, so
+memory is bounded by --chunk whatever the number of particles. For each
+trajectory the first and last valid positions are found with array
+operations, and each is placed in a zone:
+    polygons    a shapefile, or a CSV of zone,lon,lat vertices (e.g. reef
+                zones), tested with matplotlib Path.contains_points. Where
+                polygons overlap the first one wins
+    grid        a regular lon/lat partition, binned with np.digitize
+The counts of (start zone, end zone) pairs are accumulated per release time
+(the time of the first valid position) in scipy.sparse matrices of shape
+(nzones, nzones+1). The last column counts particles that ended outside
+every zone, or left the domain. Particles released outside every zone are
+counted but not kept. No loop runs over particles in python.
+
+Each matrix is saved with scipy.sparse.save_npz, with a json index of the
+zones, release times and files.
+
+** Useage**::
+python connectivity.py tBelize_ensemble.nc --zones reef_zones.csv --output CONNECTIVITY
+python connectivity.py tBelize_ensemble.nc --grid -88.4 -87.4 10 16.5 18.5 20
+
+from connectivity import load_connectivity, transition_probabilities
+matrices, index = load_connectivity('CONNECTIVITY')
+"""
+
+#### Imports
+import os
+import csv
+import json
+import argparse
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse
+from matplotlib.path import Path
+from netCDF4 import Dataset, num2date
+from cartopy.io import shapereader
+
+
+#### Constants
+CHUNK = 20000 # trajectories read at a time
+
+
+#### Classes
+
+class PolygonZones(object):
+    """
+    Zones bounded by polygons (lon, lat vertices)
+    """
+    def __init__(self, names, polygons):
+        """ names - list of zone names, polygons - list of (n,2) lon, lat vertex arrays """
+        self.names = list(names)
+        self.paths = [Path(np.asarray(vertices, dtype=float)) for vertices in polygons]
+        self.bounds = [path.get_extents() for path in self.paths]
+
+    def locate(self, lon, lat):
+        """ Zone of each point: index in names, or -1 if in none """
+        zone = np.full(np.shape(lon), -1, dtype=np.int32)
+        points = np.column_stack([lon, lat])
+        for izone in range(len(self.paths) - 1, -1, -1): # first polygon wins
+            bbox = self.bounds[izone]
+            near = np.flatnonzero((lon >= bbox.x0) & (lon <= bbox.x1) & (lat >= bbox.y0) & (lat <= bbox.y1))
+            inside = self.paths[izone].contains_points(points[near])
+            zone[near[inside]] = izone
+        return zone
+
+
+class GridZones(object):
+    """
+    Zones of a regular lon/lat partition, numbered j*nx + i
+    """
+    def __init__(self, lon_edges, lat_edges):
+        """ lon_edges, lat_edges - increasing cell edges """
+        self.lon_edges = np.asarray(lon_edges, dtype=float)
+        self.lat_edges = np.asarray(lat_edges, dtype=float)
+        self.nx = len(self.lon_edges) - 1
+        self.ny = len(self.lat_edges) - 1
+        self.names = ['{}_{}'.format(j, i) for j in range(self.ny) for i in range(self.nx)]
+
+    def locate(self, lon, lat):
+        """ Zone of each point: j*nx + i, or -1 outside the grid """
+        i = np.digitize(lon, self.lon_edges) - 1
+        j = np.digitize(lat, self.lat_edges) - 1
+        outside = (i < 0) | (i >= self.nx) | (j < 0) | (j >= self.ny) | ~np.isfinite(lon) | ~np.isfinite(lat)
+        return np.where(outside, -1, j*self.nx + i).astype(np.int32)
+
+
+###################### FUNCTIONS ############################
+
+def read_zones(zone_file, name_field=None):
+    """
+    PolygonZones from a shapefile (polygon exteriors, named by name_field) or
+    a CSV of zone,lon,lat rows, the vertices of each zone in order (a header line is skipped)
+    """
+    if os.path.splitext(zone_file)[1].lower() == '.shp':
+        names, polygons = [], []
+        for record in shapereader.Reader(zone_file).records():
+            geoms = getattr(record.geometry, 'geoms', [record.geometry]) # MultiPolygon parts
+            for part, geom in enumerate(geoms):
+                name = str(record.attributes[name_field]) if name_field else str(len(names))
+                names.append(name if len(geoms) == 1 else '{}_{}'.format(name, part))
+                polygons.append(np.array(geom.exterior.coords))
+        return PolygonZones(names, polygons)
+
+    vertices = OrderedDict()
+    with open(zone_file) as file_object:
+        for row in csv.reader(file_object):
+            try:
+                vertex = [float(row[1]), float(row[2])]
+            except (ValueError, IndexError): # header or blank line
+                continue
+            vertices.setdefault(row[0].strip(), []).append(vertex)
+    return PolygonZones(list(vertices.keys()), list(vertices.values()))
+
+def end_points(lon, lat, tim):
+    """
+    First and last valid observation of each trajectory of a (traj, obs) block
+    Returns: lon0, lat0, time0, lon1, lat1, valid (trajectories with any observation)
+    """
+    ok = ~np.ma.getmaskarray(lon) & ~np.ma.getmaskarray(lat)
+    lon = np.ma.filled(lon, np.nan).astype(float)
+    lat = np.ma.filled(lat, np.nan).astype(float)
+    tim = np.ma.filled(tim, np.nan).astype(float)
+    ok &= np.isfinite(lon) & np.isfinite(lat)
+    valid = ok.any(axis=1)
+    first = np.argmax(ok, axis=1)
+    last = ok.shape[1] - 1 - np.argmax(ok[:, ::-1], axis=1)
+    rows = np.arange(ok.shape[0])
+    return (lon[rows, first], lat[rows, first], tim[rows, first],
+            lon[rows, last], lat[rows, last], valid)
+
+def connectivity_matrices(traj_file, zones, chunk=CHUNK, time_resolution=1.):
+    """
+    Count start zone -> end zone per release time, streaming the trajectory file
+    time_resolution - release times are rounded to this (in the units of time)
+    Returns: OrderedDict {release time: csr_matrix (nzones, nzones+1)}, time variable attributes
+    """
+    nzones = len(zones.names)
+    matrices = {}
+    nout = 0
+    with Dataset(traj_file) as nc:
+        ntraj = len(nc.dimensions['traj'])
+        tvar = nc.variables['time']
+        time_attrs = {key: tvar.getncattr(key) for key in tvar.ncattrs()}
+        for i0 in range(0, ntraj, chunk):
+            block = slice(i0, min(i0+chunk, ntraj))
+            lon0, lat0, t0, lon1, lat1, valid = end_points(nc.variables['lon'][block],
+                                                           nc.variables['lat'][block], tvar[block])
+            src = zones.locate(lon0, lat0)
+            dst = zones.locate(lon1, lat1)
+            dst[dst < 0] = nzones # ended outside the zones, or left the domain
+            keep = valid & (src >= 0)
+            nout += np.count_nonzero(valid & (src < 0))
+
+            release = np.round(t0[keep] / time_resolution) * time_resolution
+            src, dst = src[keep], dst[keep]
+            for tval in np.unique(release):
+                sel = release == tval
+                counts = scipy.sparse.coo_matrix((np.ones(np.count_nonzero(sel), dtype=np.int64),
+                                                 (src[sel], dst[sel])), shape=(nzones, nzones+1)).tocsr()
+                matrices[tval] = matrices[tval] + counts if tval in matrices else counts
+            print("connectivity_matrices: {} of {} trajectories".format(block.stop, ntraj))
+    if nout:
+        print("connectivity_matrices: {} particles released outside every zone left out".format(nout))
+    return OrderedDict(sorted(matrices.items())), time_attrs
+
+def transition_probabilities(matrix):
+    """ Rows normalised by the number of particles released in each zone (empty rows stay 0) """
+    released = np.asarray(matrix.sum(axis=1)).ravel().astype(float)
+    scale = np.divide(1., released, out=np.zeros_like(released), where=released > 0)
+    return scipy.sparse.diags(scale).dot(matrix).tocsr()
+
+def save_connectivity(matrices, zones, output_dir, time_attrs=None):
+    """ One .npz per release time, and index.json (zones, release times, files) """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    index = {'zones': zones.names, 'columns': zones.names + ['outside'], 'releases': []}
+    for irel, (tval, matrix) in enumerate(matrices.items()):
+        fname = 'connectivity_{:04d}.npz'.format(irel)
+        scipy.sparse.save_npz(os.path.join(output_dir, fname), matrix)
+        label = str(tval)
+        if time_attrs and 'units' in time_attrs:
+            label = str(num2date(tval, time_attrs['units'], time_attrs.get('calendar', 'standard')))
+        index['releases'].append({'time': float(tval), 'label': label, 'file': fname,
+                                  'particles': int(matrix.sum())})
+    with open(os.path.join(output_dir, 'index.json'), 'w') as file_object:
+        json.dump(index, file_object, indent=1)
+    print("save_connectivity: {} matrices written to {}".format(len(matrices), output_dir))
+
+def load_connectivity(output_dir):
+    """ Returns: list of csr matrices, in release time order, and the index dictionary """
+    with open(os.path.join(output_dir, 'index.json')) as file_object:
+        index = json.load(file_object)
+    return [scipy.sparse.load_npz(os.path.join(output_dir, item['file'])) for item in index['releases']], index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Connectivity matrices between zones from a Parcels trajectory file.')
+    parser.add_argument('traj_file',
+                help='Parcels trajectory file (traj, obs)')
+    parser.add_argument('--zones',
+                help='zone polygons: shapefile, or CSV of zone,lon,lat vertices')
+    parser.add_argument('--name-field',
+                help='shapefile attribute naming the zones')
+    parser.add_argument('--grid', nargs=6, type=float, metavar=('LON0', 'LON1', 'NX', 'LAT0', 'LAT1', 'NY'),
+                help='regular lon/lat partition instead of polygons')
+    parser.add_argument('--chunk', type=int, default=CHUNK,
+                help='trajectories read at a time')
+    parser.add_argument('--time-resolution', type=float, default=1.,
+                help='release times closer than this (units of time) are the same release')
+    parser.add_argument('--output', default='CONNECTIVITY',
+                help='output directory')
+    args = parser.parse_args()
+
+    if args.grid is not None:
+        lon0, lon1, nx, lat0, lat1, ny = args.grid
+        zones = GridZones(np.linspace(lon0, lon1, int(nx)+1), np.linspace(lat0, lat1, int(ny)+1))
+    elif args.zones is not None:
+        zones = read_zones(args.zones, args.name_field)
+    else:
+        parser.error('give --zones or --grid')
+
+    matrices, time_attrs = connectivity_matrices(args.traj_file, zones, args.chunk, args.time_resolution)
+    save_connectivity(matrices, zones, args.output, time_attrs)
@@ -1,4 +1,4 @@
-from parcels import FieldSet, ParticleSet, ScipyParticle, JITParticle, AdvectionRK4, ParticleFile
+from parcels import ParticleSet, ScipyParticle, JITParticle, AdvectionRK4, ParticleFile
 from argparse import ArgumentParser
 import numpy as np
 import pytest
@@ -7,6 +7,7 @@ from datetime import timedelta as delta
 from os import path
 import time
 from netCDF4 import Dataset
+from velocity_store import build_store, store_is_current, fieldset_from_store, STORE_DIR
 
 start = time.time()
 # data_path = path.join(path.dirname(__file__), 'NemoCurvilinear_data/')
@@ -16,15 +17,10 @@ ufiles = sorted(glob(data_path+'BLZE12_C1_1h_*10_grid_U.nc'))
 vfiles = sorted(glob(data_path+'BLZE12_C1_1h_*10_grid_V.nc'))
 
 grid_file = data_path+'domain_cfg.nc'
-filenames = {'U': {'lon': grid_file,
-                       'lat': grid_file,
-                       'data': ufiles},
-                 'V': {'lon': grid_file,
-                       'lat': grid_file,
-                       'data': vfiles}}
-variables = {'U': 'ubar', 'V': 'vbar'}
-dimensions = {'lon': 'glamf', 'lat': 'gphif','time': 'time_counter' }
-field_set = FieldSet.from_nemo(filenames, variables, dimensions)
+# ubar, vbar, glamf, gphif preprocessed once into a memory mapped store (velocity_store.py)
+if not store_is_current(STORE_DIR, ufiles, vfiles, grid_file):
+    build_store(ufiles, vfiles, grid_file, STORE_DIR)
+field_set = fieldset_from_store(STORE_DIR)
 	
 	#Plot u field
 #field_set.U.show()
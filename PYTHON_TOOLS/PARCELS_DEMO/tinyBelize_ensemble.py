@@ -0,0 +1,242 @@
+"""
+tinyBelize_ensemble.py
+
+Particle release ensembles (many release sites and release times) for the
+tinyBelize Parcels demo, run in parallel on a process pool.
+
+** Summary **
+tinyBelize_Parcels.py advects one ParticleSet in one process. Here the
+release sites (a CSV of lon,lat) and release times (hours after the first
+velocity record) are split into independent batches: one release time and up
+to --batch-size sites each. The batches run on --nworkers processes.
+
+The velocities are not read from the NEMO files by every process. They are
+written once to a memory mapped store (velocity_store.py). Each worker maps
+it and builds its FieldSet with fieldset_from_store, so the processes share
+the same pages of the page cache instead of holding one copy each.
+The FieldSet is built once per worker, not once per batch.
+
+Each batch writes its own trajectory file, BATCHES/batch_NNNN.nc (the batch
+files of an earlier run are removed first). When all are done, the files of
+the current batches, and only those, are merged into one file along the traj
+dimension, with trajectory ids made unique and the batch release time kept per
+trajectory. The merge fails if one of them is missing.
+
+** Useage**::
+python tinyBelize_ensemble.py --release-file sites.csv --release-hours 0 6 12 18 --nworkers 8
+python tinyBelize_ensemble.py --merge-only --output tBelize_ensemble.nc
+"""
+
+#### Imports
+import os
+import csv
+import time
+import argparse
+from glob import glob
+from datetime import timedelta as delta
+from multiprocessing import Pool
+import numpy as np
+from netCDF4 import Dataset
+
+from parcels import ParticleSet, JITParticle, ScipyParticle, AdvectionRK4, ParticleFile
+from parcels import ErrorCode
+
+from velocity_store import update_store, fieldset_from_store, DATA_PATH, STORE_DIR
+
+
+#### Constants
+BATCH_DIR = 'BATCHES'
+
+_fieldset = None # FieldSet of a worker process, built once by _init_worker
+
+
+###################### FUNCTIONS ############################
+
+def DeleteParticle(particle, fieldset, time):
+    """ Recovery kernel: drop particles that leave the domain """
+    particle.delete()
+
+def read_release_sites(release_file=None, npart=30):
+    """
+    Release sites from a CSV of lon,lat (a header line is skipped), or the
+    tinyBelize_Parcels.py line of npart sites
+    Returns: lon, lat arrays
+    """
+    if release_file is None:
+        return np.linspace(-88.18, -88.20, npart), np.linspace(17.52, 17.53, npart)
+    lon, lat = [], []
+    with open(release_file) as file_object:
+        for row in csv.reader(file_object):
+            try:
+                lon.append(float(row[0]))
+                lat.append(float(row[1]))
+            except (ValueError, IndexError): # header or blank line
+                continue
+    return np.array(lon), np.array(lat)
+
+def make_batches(lon, lat, release_hours, batch_size):
+    """
+    Split sites x release times into batches of one release time and up to batch_size sites
+    Returns: list of dictionaries (batch number, release hour, lon, lat)
+    """
+    batches = []
+    for hour in release_hours:
+        for i0 in range(0, len(lon), batch_size):
+            batches.append({'batch': len(batches), 'hour': float(hour),
+                            'lon': lon[i0:i0+batch_size], 'lat': lat[i0:i0+batch_size]})
+    return batches
+
+def _init_worker(store_dir):
+    """ Pool initializer: map the velocity store and build the FieldSet once per process """
+    global _fieldset
+    _fieldset = fieldset_from_store(store_dir)
+
+def batch_file(batch_dir, batch):
+    """ Trajectory file of a batch: batch_dir/batch_NNNN.nc """
+    return os.path.join(batch_dir, 'batch_{:04d}.nc'.format(batch['batch']))
+
+def run_batch(batch, batch_dir, runtime, dt, outputdt, mode='jit'):
+    """
+    Advect one batch and write batch_dir/batch_NNNN.nc
+    runtime, dt, outputdt - timedelta
+    Returns: (batch number, number of particles, seconds)
+    """
+    t0 = time.time()
+    pclass = JITParticle if mode == 'jit' else ScipyParticle
+    release = np.full(len(batch['lon']), batch['hour']*3600.) # seconds after the first record
+    pset = ParticleSet.from_list(_fieldset, pclass, lon=batch['lon'], lat=batch['lat'], time=release)
+    pfile = ParticleFile(batch_file(batch_dir, batch), pset, outputdt=outputdt)
+    pset.execute(pset.Kernel(AdvectionRK4), runtime=runtime, dt=dt, output_file=pfile,
+                 recovery={ErrorCode.ErrorOutOfBounds: DeleteParticle})
+    pfile.close()
+    return batch['batch'], len(batch['lon']), time.time() - t0
+
+def _run_batch(args):
+    """ Pool.imap_unordered wrapper of run_batch """
+    return run_batch(*args)
+
+def run_ensemble(batches, store_dir, batch_dir, runtime, dt, outputdt, nworkers=1, mode='jit'):
+    """
+    Run the batches on nworkers processes (in this process if nworkers is 1).
+    The batch files of earlier runs in batch_dir are removed first
+    """
+    if not os.path.isdir(batch_dir):
+        os.makedirs(batch_dir)
+    for fname in glob(os.path.join(batch_dir, 'batch_*.nc')):
+        os.remove(fname)
+    jobs = [(batch, batch_dir, runtime, dt, outputdt, mode) for batch in batches]
+    t0 = time.time()
+    if nworkers > 1:
+        pool = Pool(nworkers, initializer=_init_worker, initargs=(store_dir,))
+        results = pool.imap_unordered(_run_batch, jobs)
+    else:
+        pool = None
+        _init_worker(store_dir)
+        results = map(_run_batch, jobs)
+    nparticles = 0
+    for ibatch, npart, seconds in results:
+        nparticles += npart
+        print("run_ensemble: batch {} ({} particles) done in {:.1f}s".format(ibatch, npart, seconds))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    wall = time.time() - t0
+    print("run_ensemble: {} particles in {} batches on {} processes: {:.1f}s, {:.1f} particles/s".format(
+                nparticles, len(batches), nworkers, wall, nparticles/wall))
+
+def merge_batches(batch_dir, output, batches):
+    """
+    Concatenate the trajectory files of the batches (from make_batches) in batch_dir along traj
+    into output, numbering the trajectories and recording the release hour.
+    obs is the longest of the batches; shorter ones are padded with the fill value.
+    Raises IOError if the file of a batch is missing, or holds another number of trajectories (an earlier run)
+    """
+    batch_files = [batch_file(batch_dir, batch) for batch in batches]
+    missing = [fname for fname in batch_files if not os.path.exists(fname)]
+    if missing:
+        raise IOError('merge_batches: {} of {} batch files are missing from {} (e.g. {}): run the ensemble '
+                      'first, with the same sites, release hours and batch size'.format(
+                      len(missing), len(batch_files), batch_dir, missing[0]))
+    nobs = 0
+    ntraj = []
+    for batch, fname in zip(batches, batch_files):
+        with Dataset(fname) as nc:
+            nobs = max(nobs, len(nc.dimensions['obs']))
+            ntraj.append(len(nc.dimensions['traj']))
+        if ntraj[-1] != len(batch['lon']):
+            raise IOError('merge_batches: {} has {} trajectories, not the {} sites of batch {}: it is from '
+                          'another run'.format(fname, ntraj[-1], len(batch['lon']), batch['batch']))
+
+    with Dataset(batch_files[0]) as src, Dataset(output, 'w') as dst:
+        dst.setncatts({key: src.getncattr(key) for key in src.ncattrs()})
+        dst.createDimension('traj', None)
+        dst.createDimension('obs', nobs)
+        for name, var in src.variables.items():
+            if var.dimensions[:1] != ('traj',):
+                continue
+            fill = getattr(var, '_FillValue', None)
+            out = dst.createVariable(name, var.dtype, var.dimensions, fill_value=fill)
+            out.setncatts({key: var.getncattr(key) for key in var.ncattrs() if key != '_FillValue'})
+        out = dst.createVariable('release_hour', 'f4', ('traj',))
+        out.long_name = 'release time, hours after the first velocity record'
+
+    with Dataset(output, 'a') as dst:
+        itraj = 0
+        for batch, fname, n in zip(batches, batch_files, ntraj):
+            with Dataset(fname) as src:
+                for name in dst.variables:
+                    if name not in src.variables:
+                        continue
+                    data = src.variables[name][:]
+                    if name == 'trajectory': # ids unique across batches
+                        data = np.ma.array(np.arange(itraj, itraj+n)[:, None] * np.ones(data.shape, dtype=data.dtype),
+                                           mask=np.ma.getmaskarray(data))
+                    dst.variables[name][itraj:itraj+n, :data.shape[1]] = data
+            dst.variables['release_hour'][itraj:itraj+n] = batch['hour']
+            itraj += n
+    print("merge_batches: {} trajectories from {} files written to {}".format(itraj, len(batch_files), output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run particle release ensembles for tinyBelize in parallel.')
+    parser.add_argument('--data-path', default=DATA_PATH,
+                help='directory of the NEMO grid_U, grid_V files and domain_cfg.nc')
+    parser.add_argument('--release-file',
+                help='CSV of release sites, lon,lat per line (default: the tinyBelize_Parcels.py line)')
+    parser.add_argument('--release-hours', nargs='+', type=float, default=[0.],
+                help='release times, hours after the first velocity record')
+    parser.add_argument('--runtime-days', type=float, default=0.5,
+                help='advection time of each release')
+    parser.add_argument('--dt-hours', type=float, default=0.1,
+                help='time step')
+    parser.add_argument('--outputdt-hours', type=float, default=0.5,
+                help='output interval')
+    parser.add_argument('--batch-size', type=int, default=500,
+                help='sites per batch')
+    parser.add_argument('--nworkers', type=int, default=os.cpu_count(),
+                help='processes')
+    parser.add_argument('--mode', choices=['jit', 'scipy'], default='jit',
+                help='JITParticle or ScipyParticle')
+    parser.add_argument('--store', default=STORE_DIR,
+                help='velocity store (built or updated from --data-path first)')
+    parser.add_argument('--batch-dir', default=BATCH_DIR,
+                help='directory of the per batch trajectory files')
+    parser.add_argument('--output', default='tBelize_ensemble.nc',
+                help='merged trajectory file')
+    parser.add_argument('--merge-only', action='store_true',
+                help='only merge the batch files already in --batch-dir (of the same sites, hours and batch size)')
+    args = parser.parse_args()
+
+    start = time.time()
+    lon, lat = read_release_sites(args.release_file)
+    batches = make_batches(lon, lat, args.release_hours, args.batch_size)
+    if not args.merge_only:
+        update_store(args.data_path, args.store)
+        run_ensemble(batches, args.store, args.batch_dir, delta(days=args.runtime_days),
+                     delta(hours=args.dt_hours), delta(hours=args.outputdt_hours),
+                     max(1, args.nworkers), args.mode)
+    try:
+        merge_batches(args.batch_dir, args.output, batches)
+    except IOError as err:
+        parser.exit(1, str(err)+'\n')
+    print(time.time()-start)
@@ -0,0 +1,173 @@
+"""
+velocity_store.py
+
+Preprocessed, memory mapped copy of the NEMO velocities for Parcels.
+
+** Summary **
+FieldSet.from_nemo opens the XIOS grid_U / grid_V files and domain_cfg.nc and
+decodes them on every run. build_store() does this once: ubar, vbar
+(time,y,x), the f-point grid (glamf, gphif) and time_counter are written as
+contiguous float32 .npy files (land, masked or NaN, set to 0, as parcels
+does), with a meta.json describing them and the source files (size, mtime).
+fieldset_from_store() maps the arrays (np.load mmap_mode) and builds the
+FieldSet with FieldSet.from_data and the C-grid interpolation that from_nemo
+uses, so it starts without reading the NetCDF. Processes that map the same
+store share its pages.
+
+meta.json is written last, so a store without it is incomplete. The store is
+rebuilt only if the source files have changed (store_is_current).
+
+** Useage**::
+python velocity_store.py --data-path /Belize_workshop/RUN_NEMO/EXP_demo/ --store VELOCITY_STORE
+
+from velocity_store import fieldset_from_store
+field_set = fieldset_from_store('VELOCITY_STORE')
+"""
+
+#### Imports
+import os
+import json
+import time
+import argparse
+from glob import glob
+import numpy as np
+from netCDF4 import Dataset, num2date
+
+from parcels import FieldSet
+
+
+#### Constants
+DATA_PATH = '/Belize_workshop/RUN_NEMO/EXP_demo/'
+U_PATTERN = 'BLZE12_C1_1h_*10_grid_U.nc'
+V_PATTERN = 'BLZE12_C1_1h_*10_grid_V.nc'
+GRID_FILE = 'domain_cfg.nc'
+STORE_DIR = 'VELOCITY_STORE'
+VARIABLES = {'U': 'ubar', 'V': 'vbar'} # as passed to FieldSet.from_nemo
+DIMENSIONS = {'lon': 'glamf', 'lat': 'gphif', 'time': 'time_counter'}
+
+
+###################### FUNCTIONS ############################
+
+def build_store(ufiles, vfiles, grid_file, store_dir=STORE_DIR, variables=VARIABLES, dimensions=DIMENSIONS):
+    """
+    Write the velocities, grid and times to store_dir, a file at a time
+    ufiles, vfiles - lists of grid_U, grid_V files, in time order
+    variables, dimensions - names in the files, as for FieldSet.from_nemo
+    """
+    t0 = time.time()
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    if os.path.exists(os.path.join(store_dir, 'meta.json')):
+        os.remove(os.path.join(store_dir, 'meta.json')) # incomplete until rewritten
+
+    with Dataset(grid_file) as nc:
+        for dim in ['lon', 'lat']:
+            np.save(os.path.join(store_dir, dim+'.npy'),
+                    np.asarray(np.squeeze(nc.variables[dimensions[dim]][:]), dtype=np.float32))
+
+    times = []
+    shapes = {}
+    for key, files in [('U', ufiles), ('V', vfiles)]:
+        var = variables[key]
+        nrec = []
+        for fname in files:
+            with Dataset(fname) as nc:
+                nrec.append(len(nc.dimensions[dimensions['time']]))
+                shape = nc.variables[var].shape[1:]
+        out = np.lib.format.open_memmap(os.path.join(store_dir, key+'.npy'), mode='w+',
+                                        dtype=np.float32, shape=(sum(nrec),)+tuple(shape))
+        irec = 0
+        for fname, n in zip(files, nrec):
+            with Dataset(fname) as nc:
+                data = np.ma.filled(np.ma.asarray(nc.variables[var][:], dtype=np.float32), 0.)
+                out[irec:irec+n] = np.where(np.isfinite(data), data, 0.)
+                if key == 'U':
+                    tvar = nc.variables[dimensions['time']]
+                    times.extend(num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard')))
+            irec += n
+        out.flush()
+        shapes[key] = list(out.shape)
+        del out
+    np.save(os.path.join(store_dir, 'time.npy'),
+            np.array([np.datetime64(str(tim)) for tim in times], dtype='datetime64[s]'))
+
+    meta = {'variables': variables, 'dimensions': dimensions, 'shapes': shapes,
+            'sources': source_signatures(ufiles, vfiles, grid_file),
+            'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as file_object:
+        json.dump(meta, file_object, indent=1)
+    print("build_store: {} records written to {} in {:.1f}s".format(len(times), store_dir, time.time()-t0))
+
+def source_signatures(ufiles, vfiles, grid_file):
+    """ Path, size and modification time of each source file """
+    sources = {}
+    for key, files in [('U', ufiles), ('V', vfiles), ('grid', [grid_file])]:
+        sources[key] = []
+        for fname in files:
+            stat = os.stat(fname)
+            sources[key].append([os.path.abspath(fname), stat.st_size, stat.st_mtime])
+    return sources
+
+def store_is_current(store_dir, ufiles, vfiles, grid_file):
+    """ True if store_dir is complete and was built from these files, unchanged since """
+    meta_file = os.path.join(store_dir, 'meta.json')
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file) as file_object:
+        meta = json.load(file_object)
+    return meta['sources'] == source_signatures(ufiles, vfiles, grid_file)
+
+def update_store(data_path=DATA_PATH, store_dir=STORE_DIR, u_pattern=U_PATTERN, v_pattern=V_PATTERN,
+                 grid_file=GRID_FILE):
+    """ Build the store from the files in data_path, unless it is current """
+    ufiles = sorted(glob(os.path.join(data_path, u_pattern)))
+    vfiles = sorted(glob(os.path.join(data_path, v_pattern)))
+    grid_file = os.path.join(data_path, grid_file)
+    if store_is_current(store_dir, ufiles, vfiles, grid_file):
+        print("update_store: {} is current".format(store_dir))
+    else:
+        build_store(ufiles, vfiles, grid_file, store_dir)
+
+def open_store(store_dir=STORE_DIR, mmap_mode='c'):
+    """
+    Map the arrays of the store
+    mmap_mode - 'c' copy-on-write (pages are only copied if written) or 'r'
+    Returns: dictionary of arrays (U, V, lon, lat, time) and the meta dictionary
+    """
+    with open(os.path.join(store_dir, 'meta.json')) as file_object:
+        meta = json.load(file_object)
+    arrays = {name: np.load(os.path.join(store_dir, name+'.npy'), mmap_mode=mmap_mode)
+              for name in ['U', 'V', 'lon', 'lat']}
+    arrays['time'] = np.load(os.path.join(store_dir, 'time.npy'))
+    return arrays, meta
+
+def fieldset_from_store(store_dir=STORE_DIR, **kwargs):
+    """
+    FieldSet on the memory mapped arrays of store_dir, interpolated as FieldSet.from_nemo does.
+    Maps are copy-on-write: parcels sets NaNs to 0 in place, and there are none, so no page is copied
+    kwargs - passed to FieldSet.from_data
+    """
+    arrays, meta = open_store(store_dir)
+    dimensions = {'lon': arrays['lon'], 'lat': arrays['lat'], 'time': arrays['time']}
+    kwargs.setdefault('mesh', 'spherical')
+    kwargs.setdefault('interp_method', {'U': 'cgrid_velocity', 'V': 'cgrid_velocity'})
+    return FieldSet.from_data({'U': arrays['U'], 'V': arrays['V']}, dimensions, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess NEMO ubar, vbar into a memory mapped store for Parcels.')
+    parser.add_argument('--data-path', default=DATA_PATH,
+                help='directory of the NEMO grid_U, grid_V files and domain_cfg.nc')
+    parser.add_argument('--u-pattern', default=U_PATTERN,
+                help='glob of the grid_U files')
+    parser.add_argument('--v-pattern', default=V_PATTERN,
+                help='glob of the grid_V files')
+    parser.add_argument('--store', default=STORE_DIR,
+                help='store directory')
+    parser.add_argument('--force', action='store_true',
+                help='rebuild even if the store is current')
+    args = parser.parse_args()
+
+    if args.force and os.path.exists(os.path.join(args.store, 'meta.json')):
+        os.remove(os.path.join(args.store, 'meta.json'))
+    update_store(args.data_path, args.store, args.u_pattern, args.v_pattern)
@@ -41,29 +41,62 @@ tlim = [] # [datetime.datetime(1960, 4, 20, 12, 0), datetime.datetime(1960, 5, 1
 #config = 'SEAsia'
 #field = 'salinity'
 field = 'temperature'
+fields = [field] # fields drawn in the same pass. E.g. ['temperature', 'salinity', 'speed']
 
 ##################################
 ## DEFINE FIELD SPECIFIC CONSTANTS
 ##################################
-if field == 'salinity':
-	plot_var = 'sss' #sea_surface_salinity' #'zos'. Must be defined in NcML file
-	units = 'psu'
-	levs = np.arange(20,35+1,1)
-	cmap = cmo.haline #'Spectral'
-	maskval = 0
-	ofile = 'FIGURES/TEMPLATE_SSS.gif'
-
-elif field == 'temperature':
-	plot_var = 'sst' #sea_surface_salinity' #'zos'. Must be defined in NcML file
-	units = 'degC'
-	levs = np.arange(20,35+1,1)
-	#levs = np.arange(20,30+1,1)
-	cmap = cm.Spectral_r
-	cmap.set_bad('white',1.)
-	cmap.set_over('red',1.)
-	maskval = 0
-	ofile = 'FIGURES/TEMPLATE_SST.gif'
-
+## One dictionary per field. The one named by field sets plot_var, units, etc.
+## Others can be chosen from the command line: --field salinity
+## or drawn alongside it by listing them in fields.
+field_specs = {}
+
+field_specs['salinity'] = {
+	'plot_var': 'sss', #sea_surface_salinity' #'zos'. Must be defined in NcML file
+	'units': 'psu',
+	'levs': np.arange(20,35+1,1),
+	'cmap': cmo.haline, #'Spectral'
+	'maskval': 0,
+	'ofile': 'FIGURES/TEMPLATE_SSS.gif' }
+
+cmap = cm.Spectral_r
+cmap.set_bad('white',1.)
+cmap.set_over('red',1.)
+field_specs['temperature'] = {
+	'plot_var': 'sst', #sea_surface_salinity' #'zos'. Must be defined in NcML file
+	'units': 'degC',
+	'levs': np.arange(20,35+1,1),
+	#'levs': np.arange(20,30+1,1),
+	'cmap': cmap,
+	'maskval': 0,
+	'ofile': 'FIGURES/TEMPLATE_SST.gif' }
+
+field_specs['speed'] = {
+	'plot_var': 'speed', # computed from ssu and ssv
+	'units': 'm/s',
+	'levs': np.arange(0,1.0+0.1,0.1),
+	'cmap': cmo.speed,
+	'maskval': 0,
+	'ofile': 'FIGURES/TEMPLATE_SPEED.gif' }
+
+field_specs['vorticity'] = {
+	'plot_var': 'vorticity', # NEMO_derived_fields. Needs domain_cfg (scale factors)
+	'units': '1/s',
+	'levs': np.arange(-1e-4,1e-4+2e-5,2e-5),
+	'cmap': cmo.curl,
+	'maskval': 0,
+	'ofile': 'FIGURES/TEMPLATE_VORTICITY.gif' }
+
+field_specs['M2amp'] = {
+	'plot_var': 'M2amp', # from NEMO_tidal_analysis.py, see HARMONICS below
+	'units': 'm',
+	'levs': np.arange(0,0.2+0.02,0.02),
+	'cmap': cmo.amp,
+	'maskval': 0,
+	'ofile': 'FIGURES/TEMPLATE_M2AMP.gif' }
+
+if field in field_specs:
+	globals().update(field_specs[field]) # plot_var, units, levs, cmap, maskval, ofile
 else:
 	print("Not ready for field %s"%field)
 
@@ -73,12 +106,31 @@ else:
 ## COLORBAR shrink factor. It is hard
 #  to automatically set the size of th colourbar for some reason...
 colorbar_shrink = 0.7
+draw_features = True # cartopy land, ocean, borders and rivers. Needs Natural Earth data (downloaded on first use)
+basemap_layers = ['ocean', 'land', 'borders', 'rivers'] # also 'coastline'
+basemap_resolution = None # Natural Earth scale '10m', '50m', '110m'. None: cartopy's per layer
+basemap_cache_dir = 'BASEMAP_CACHE' # layers clipped to the domain, shared by runs and configs
+natural_earth_dir = None # local Natural Earth data (shapefiles/natural_earth/...), e.g. offline
+
+## MEMORY
+lazy = False # True: keep (time,y,x) fields on disk and read them a frame at a time
+
+## ANIMATION
+nworkers = 1 # number of processes rendering animation frames
+# ofile may end in .gif or .mp4 to choose the animation format
+
+## FOLLOW (pf, qf commands or --follow, while NEMO is running)
+follow_interval = 60 # seconds between polls of the output files
+follow_max_idle = None # stop after this many polls with no new records. None: until Ctrl-C
 
 ## QUIVER
 nx_quiv = 60 # number of quiver ticks in x-dirn
 #spacing = 16 # grid spacing between vectors
 speed_min = 0.05 # Min speed to show vector. OOPS REDEFINED IN QUIVER FN CALL
 #ofile = ofile.replace('.gif','_vec.gif')
+domain_cfg = None # e.g. '/Belize_workshop/RUN_NEMO/EXP_demo/domain_cfg.nc': uos, vos averaged onto T points and rotated east/north (NEMO_cgrid)
+cgrid_cache_dir = 'CGRID_CACHE' # U, V to T operators, built once per domain_cfg
+derived_cache_bytes = 256*2**20 # derived field slices (speed, vorticity, ...) kept for reuse
 
 ###############
 ## SOURCE files
@@ -94,6 +146,10 @@ determined from the grid_data variables.
 
 The dictionaries store information as follows:
  dic = {filename1 : [f1var1, f1var2], filename2 : [f2var1, f2var2] }
+
+A filename may be a glob pattern matching many XIOS output chunks
+(@expname@_@freq@_@startdate@_@enddate@). These are lazily concatenated in
+time and, if tlim is set, only the chunks overlapping tlim are opened.
 """
 
 dirname = '/Belize_workshop/RUN_NEMO/EXP_demo/' 
@@ -101,19 +157,31 @@ grid_data = {} # For storing variables to lead the entire grid
 input_data = {} # For storing variables that are subsetted.
 
 ## GRID VARIABLES
-filename = 'BLZE12_C1_1d_19950101_19950110_grid_T.nc' 
+filename = 'BLZE12_C1_1d_*_grid_T.nc' # E.g. 'BLZE12_C1_1d_19950101_19950110_grid_T.nc'
 variable_lst = ['nav_lat', 'nav_lon', 'time_counter'] # variables in the files
 grid_data.update( {dirname+filename: variable_lst} )
 
 ## SUBSETTED VARIABLES
-filename = 'BLZE12_C1_1d_19950101_19950110_grid_U.nc' 
+filename = 'BLZE12_C1_1d_*_grid_U.nc' 
 variable_lst = ['uos', 'nav_lat', 'nav_lon', 'time_counter'] # variables in the files
 input_data.update( {dirname+filename: variable_lst} )
 
-filename = 'BLZE12_C1_1d_19950101_19950110_grid_V.nc' 
+filename = 'BLZE12_C1_1d_*_grid_V.nc' 
 variable_lst = ['vos', 'nav_lat', 'nav_lon'] # variables in the files
 input_data.update( {dirname+filename: variable_lst} )
 
-filename = 'BLZE12_C1_1d_19950101_19950110_grid_T.nc' 
+filename = 'BLZE12_C1_1d_*_grid_T.nc' 
 variable_lst = ['sea_surface_temperature', 'sea_surface_salinity', 'nav_lat', 'nav_lon'] # variables in the files
 input_data.update( {dirname+filename: variable_lst} )
+
+## STATISTICS
+## Output of NEMO_surface_stats.py is drawn like the model output. E.g. the
+## mean SST (the single time_counter record is the middle of the period):
+#grid_data = {'BLZ_stats.nc': ['nav_lat', 'nav_lon', 'time_counter']}
+#input_data = {'BLZ_stats.nc': ['sea_surface_temperature_mean', 'nav_lat', 'nav_lon', 'time_counter']}
+
+## HARMONICS
+## Output of NEMO_tidal_analysis.py (hourly zos). Variables that are not
+## sst/sss/ssu/ssv keep their own name, e.g. --field M2amp:
+#grid_data = {'BLZ_harmonics.nc': ['nav_lat', 'nav_lon', 'time_counter']}
+#input_data = {'BLZ_harmonics.nc': ['M2amp', 'M2phase', 'nav_lat', 'nav_lon', 'time_counter']}
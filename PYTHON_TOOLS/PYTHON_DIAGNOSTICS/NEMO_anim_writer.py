@@ -0,0 +1,208 @@
+"""
+NEMO_anim_writer.py
+
+Stream rendered matplotlib figures straight into an animated GIF or MP4.
+
+** Summary **
+Each frame is taken from the figure canvas buffer (drawn, or blitted by the
+caller) and piped to ffmpeg, which encodes it as it arrives. No intermediate image files are written and memory
+does not grow with the number of frames.
+If ffmpeg cannot be found, imageio is used instead (frames are then held
+until the file is closed).
+A live writer passes each frame on as soon as it is appended, and writes
+MP4 as a fragmented file, so that a file that is still growing can be viewed.
+
+A Blitter makes the frames of a figure whose map stays the same: the figure
+is drawn once without the artists that change (a background, kept by key,
+e.g. per field), and each frame restores it and draws only those artists,
+then the layers drawn above them (map layers, grid lines, outline).
+
+** Useage**::
+from NEMO_anim_writer import AnimationWriter, Blitter
+writer = AnimationWriter('FIGURES/BLZ_SST.gif', fps=10) # or .mp4
+for ...:
+    writer.append_figure(fig)
+writer.close()
+
+blitter = Blitter(fig, ax, [mesh, title])
+for ...:
+    mesh.set_array(...)
+    writer.append_frame(blitter.grab())
+"""
+
+#### Imports
+import os
+import shutil
+import subprocess
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.text import Text
+
+import imageio # fallback encoder
+
+
+#### Classes
+
+class AnimationWriter(object):
+    """
+    Open animation file that frames are appended to one at a time.
+    The output format follows the file extension: .gif or .mp4
+    """
+    def __init__(self, output, fps=10, live=False):
+        """
+        Set up the writer. The encoder starts with the first frame
+        live - flush every frame to the encoder, e.g. while following a run
+        """
+        self.output = output
+        self.fps = fps
+        self.live = live
+        self.nframes = 0
+        self.ffmpeg = find_ffmpeg()
+        self.proc = None # ffmpeg process
+        self.writer = None # imageio fallback
+
+    def _open(self, height, width):
+        """ Start the encoder for frames of the given size """
+        if self.ffmpeg is None:
+            print("AnimationWriter: ffmpeg not found. Frames are kept until close")
+            self.writer = imageio.get_writer(self.output, mode='I', fps=self.fps)
+            return
+
+        if os.path.splitext(self.output)[1].lower() == '.gif':
+            # A palette per frame keeps the colours and does not need all the frames
+            out_args = ['-filter_complex',
+                        'split[a][b];[a]palettegen=stats_mode=single[p];[b][p]paletteuse=new=1',
+                        '-loop', '0']
+        else:
+            # h264 needs even dimensions
+            out_args = ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                        '-vcodec', 'libx264', '-pix_fmt', 'yuv420p']
+            if self.live: # readable before the file is closed
+                out_args += ['-movflags', 'frag_keyframe+empty_moov']
+
+        cmd = [self.ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(width, height),
+               '-r', str(self.fps), '-i', '-'] + out_args + [self.output]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def append_frame(self, rgb):
+        """ Append one (height, width, 3) uint8 image """
+        if self.proc is None and self.writer is None:
+            self._open(*np.shape(rgb)[:2])
+        if self.proc is not None:
+            self.proc.stdin.write(np.ascontiguousarray(rgb, dtype=np.uint8).tobytes())
+            if self.live:
+                self.proc.stdin.flush()
+        else:
+            self.writer.append_data(rgb)
+        self.nframes += 1
+
+    def append_figure(self, fig):
+        """ Draw fig and append its canvas """
+        self.append_frame(figure_to_rgb(fig))
+
+    def close(self):
+        """ Finish the file """
+        if self.proc is not None:
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                raise IOError('ffmpeg failed to write '+self.output)
+            self.proc = None
+        elif self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        print("AnimationWriter: {} frames written to {}".format(self.nframes, self.output))
+
+
+class Blitter(object):
+    """
+    Frames of a figure in which only some artists change, blitted onto a saved background
+    """
+    def __init__(self, fig, ax, artists):
+        """
+        artists - the artists of ax that change from frame to frame (they are set animated,
+                  so canvas.draw() leaves them out)
+        """
+        self.fig = fig
+        self.ax = ax
+        self.artists = list(artists)
+        for artist in self.artists:
+            artist.set_animated(True)
+        self.canvas = agg_canvas(fig)
+        self.overlay = None # artists above the changing ones, redrawn on each frame
+        self.order = None # changing and overlay artists, in drawing (zorder) order
+        self.backgrounds = {} # key: canvas saved without the changing artists
+
+    def _find_overlay(self):
+        """
+        Artists of ax drawn above the changing ones. Of a cartopy Gridliner only the lines are
+        taken: its labels (outside the map) stay in the background
+        """
+        self.canvas.draw() # makes the Gridliner lines
+        zorder = min([artist.get_zorder() for artist in self.artists if not isinstance(artist, Text)] or [0])
+        overlay = []
+        for artist in self.ax.get_children():
+            if (artist in self.artists or artist is self.ax.patch or isinstance(artist, Text)
+                    or not artist.get_visible() or artist.get_zorder() <= zorder):
+                continue
+            if hasattr(artist, 'xline_artists'): # Gridliner
+                overlay += list(artist.xline_artists) + list(artist.yline_artists)
+            else:
+                overlay.append(artist)
+        self.overlay = overlay
+        self.order = sorted(self.artists + overlay, key=lambda artist: artist.get_zorder())
+
+    def save_background(self, key=None):
+        """ Draw the figure without the changing (and overlay) artists and keep it as background key """
+        if self.overlay is None:
+            self._find_overlay()
+        for artist in self.overlay:
+            artist.set_visible(False)
+        self.canvas.draw()
+        for artist in self.overlay:
+            artist.set_visible(True)
+        self.backgrounds[key] = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    def grab(self, key=None):
+        """
+        Restore background key (drawn the first time) and draw the changing artists over it
+        Returns: (height, width, 3) uint8 image
+        """
+        if key not in self.backgrounds:
+            self.save_background(key)
+        self.canvas.restore_region(self.backgrounds[key])
+        for artist in self.order:
+            if artist.get_visible():
+                self.ax.draw_artist(artist)
+        return canvas_to_rgb(self.canvas)
+
+
+###################### FUNCTIONS ############################
+
+def find_ffmpeg():
+    """ Return the ffmpeg executable (bundled with imageio or on the PATH), or None """
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        return shutil.which('ffmpeg')
+
+def figure_to_rgb(fig):
+    """
+    Draw fig and return a copy of its canvas as a (height, width, 3) uint8 array.
+    Usage: rgb = figure_to_rgb(plt.gcf())
+    """
+    canvas = agg_canvas(fig)
+    canvas.draw()
+    return canvas_to_rgb(canvas)
+
+def agg_canvas(fig):
+    """ The Agg canvas of fig (attached if fig has another), for drawing, blitting and reading back """
+    canvas = fig.canvas
+    if not isinstance(canvas, FigureCanvasAgg):
+        canvas = FigureCanvasAgg(fig)
+    return canvas
+
+def canvas_to_rgb(canvas):
+    """ Copy of what is on an Agg canvas now (drawn or blitted) as a (height, width, 3) uint8 array """
+    return np.ascontiguousarray(np.asarray(canvas.buffer_rgba())[:,:,:3])
@@ -0,0 +1,150 @@
+"""
+NEMO_basemap.py
+
+Cartopy base map layers (ocean, land, borders, rivers, coastline) clipped to
+the plot extent once and kept on disk.
+
+** Summary **
+cartopy.feature layers read the whole Natural Earth shapefile, then project
+and clip every geometry each time a figure is drawn. Here the geometries of
+each layer are read once, clipped to the plot extent (plus a margin),
+projected to the map projection and kept, both for the session and as a
+pickle in a cache directory. The key is the extent, projection, resolution and
+layers, not the config, so runs and configs over the same domain share it.
+The layers are drawn from the cached geometries as ShapelyFeatures with the
+usual cartopy styles.
+
+Natural Earth shapefiles are looked for in natural_earth_dir (cartopy's
+pre_existing_data_dir layout: shapefiles/natural_earth/{physical,cultural}/)
+before cartopy's data directory. A layer that cannot be found or downloaded
+(e.g. no network in a container) is left out, with a message.
+
+** Useage**::
+from NEMO_basemap import add_base_map
+add_base_map(ax, xlim, ylim, cache_dir='BASEMAP_CACHE')
+"""
+
+#### Imports
+import os
+import json
+import hashlib
+import pickle
+import cartopy
+import cartopy.crs as ccrs
+import cartopy.feature
+from cartopy.io import shapereader
+from shapely.geometry import box
+
+
+#### Constants
+## layer name: cartopy feature that gives its Natural Earth name, default scale and style
+LAYERS = {
+    'ocean': cartopy.feature.OCEAN,
+    'land': cartopy.feature.LAND,
+    'borders': cartopy.feature.BORDERS,
+    'rivers': cartopy.feature.RIVERS,
+    'coastline': cartopy.feature.COASTLINE,
+    }
+DEFAULT_LAYERS = ['ocean', 'land', 'borders', 'rivers'] # as drawn by NEMO_surface_var_diag
+STYLES = {'borders': {'linestyle': ':'}} # on top of the cartopy feature style
+MARGIN = 0.05 # fraction of the extent added on each side before clipping
+
+_base_maps = {} # clipped layers built (or loaded) this session, by key
+
+
+###################### FUNCTIONS ############################
+
+def add_base_map(ax, xlim, ylim, layers=None, resolution=None, cache_dir=None, natural_earth_dir=None):
+    """
+    Draw the base map layers on the cartopy axes ax, for the extent xlim, ylim (degrees).
+    layers - names from LAYERS (default DEFAULT_LAYERS)
+    resolution - Natural Earth scale '10m', '50m' or '110m' (default: cartopy's, per layer)
+    cache_dir - directory keeping the clipped layers between runs (None: session only)
+    natural_earth_dir - local Natural Earth data, searched before cartopy's data directory
+    Returns: list of the FeatureArtists added
+    """
+    geometries = get_base_map(xlim, ylim, ax.projection, layers, resolution, cache_dir, natural_earth_dir)
+    artists = []
+    for name, geoms in geometries:
+        style = dict(LAYERS[name].kwargs)
+        style.update(STYLES.get(name, {}))
+        artists.append( ax.add_feature(cartopy.feature.ShapelyFeature(geoms, ax.projection, **style)) )
+    return artists
+
+def get_base_map(xlim, ylim, projection=None, layers=None, resolution=None, cache_dir=None,
+                 natural_earth_dir=None):
+    """
+    Clipped and projected geometries of each layer, from the session, the
+    cache directory or, the first time, the shapefiles.
+    Returns: list of (layer name, list of shapely geometries in projection coordinates)
+    """
+    if projection is None:
+        projection = ccrs.PlateCarree()
+    if layers is None:
+        layers = DEFAULT_LAYERS
+    if natural_earth_dir is not None:
+        cartopy.config['pre_existing_data_dir'] = natural_earth_dir
+
+    key = base_map_key(xlim, ylim, projection, layers, resolution)
+    if key in _base_maps:
+        return _base_maps[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'basemap_'+key+'.pkl')
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as file_object:
+            geometries = pickle.load(file_object)
+    else:
+        geometries = clip_layers(xlim, ylim, projection, layers, resolution)
+        if cache_file is not None and all(name in dict(geometries) for name in layers):
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(cache_file+'.tmp', 'wb') as file_object:
+                pickle.dump(geometries, file_object)
+            os.replace(cache_file+'.tmp', cache_file)
+            print("get_base_map: clipped layers saved to {}".format(cache_file))
+
+    _base_maps[key] = geometries
+    return geometries
+
+def clip_layers(xlim, ylim, projection, layers, resolution=None):
+    """
+    Read each layer's shapefile, keep the geometries within the extent (plus
+    MARGIN), clipped to it, and project them.
+    Returns: list of (layer name, list of geometries). Layers without data are left out
+    """
+    dx = (xlim[1] - xlim[0]) * MARGIN
+    dy = (ylim[1] - ylim[0]) * MARGIN
+    clip = box(xlim[0]-dx, max(-90., ylim[0]-dy), xlim[1]+dx, min(90., ylim[1]+dy))
+    source_crs = ccrs.PlateCarree()
+
+    geometries = []
+    for name in layers:
+        feature = LAYERS[name]
+        try:
+            shpfile = shapereader.natural_earth(resolution=resolution or feature.scale,
+                                                category=feature.category, name=feature.name)
+        except Exception as err: # not local, and could not be downloaded
+            print("clip_layers: no Natural Earth data for {} ({}). Layer left out".format(name, err))
+            continue
+        geoms = []
+        for geom in shapereader.Reader(shpfile).geometries():
+            if not geom.intersects(clip):
+                continue
+            geom = geom.intersection(clip)
+            if geom.is_empty:
+                continue
+            if projection != source_crs:
+                geom = projection.project_geometry(geom, source_crs)
+            geoms.append(geom)
+        geometries.append((name, geoms))
+        print("clip_layers: {} {} geometries within the extent".format(len(geoms), name))
+    return geometries
+
+def base_map_key(xlim, ylim, projection, layers, resolution=None):
+    """ Hash of the extent, projection, layers and resolution identifying a base map """
+    description = {'extent': [round(float(val), 4) for val in list(xlim)+list(ylim)],
+                   'projection': projection.proj4_init, 'layers': list(layers),
+                   'resolution': resolution}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,376 @@
+"""
+NEMO_benchmark.py
+
+Benchmark the load / subset / render pipeline of NEMO_surface_var_diag.py on
+synthetic NEMO-like output.
+
+** Summary **
+Writes grid_T, grid_U and grid_V files, named and laid out like XIOS output
+(nav_lat, nav_lon, time_counter, chunked one record per chunk), for a domain
+from BLZE12 up to ORCA12 size and any number of time steps. Then runs the
+diagnostics on them with a config made here (no config file, no Natural Earth
+data, no network) and times each stage separately:
+    load      open the files and read the grid
+    subset    find the subregion and read the (time,y,x) fields
+    frame     draw the first frame (figure, map, colorbar, data)
+    render    draw every frame of the animation
+    encode    pass the frames to the GIF encoder and close the file
+    pa        the whole pa command, DataBucket.pcolor: map, frames and GIF,
+              on --workers processes
+With --base-map the map has land, ocean, border and river layers like those
+of Natural Earth: a stub base map, made from the synthetic land mask and put
+in the NEMO_basemap cache, so it is drawn offline.
+Peak resident memory (ru_maxrss) is recorded after each stage. The results
+are written to json with the git commit, so runs on two commits can be
+compared (--compare). The stages repeated per frame (render, encode, pa) are
+also compared per frame, with the speedup.
+
+** Useage**::
+python NEMO_benchmark.py --domain BLZE12 ORCA025 --nt 10 100 --output bench.json
+python NEMO_benchmark.py --domain BLZE12 --nt 1000 --lazy --compare bench.json
+python NEMO_benchmark.py --domain ORCA1 --nt 100 --base-map --workers 4
+"""
+
+#### Imports
+import os
+import sys
+import time
+import types
+import json
+import pickle
+import shutil
+import argparse
+import resource
+import subprocess
+from glob import glob
+from contextlib import contextmanager
+import numpy as np
+from netCDF4 import Dataset
+import cartopy.crs as ccrs
+from shapely.geometry import LineString, box
+from shapely.ops import unary_union
+import matplotlib
+matplotlib.use('Agg') # no display needed
+import matplotlib.pyplot as plt
+
+import NEMO_surface_var_diag as diag
+from NEMO_anim_writer import AnimationWriter
+from NEMO_basemap import DEFAULT_LAYERS, base_map_key
+
+
+#### Constants
+## name: (ny, nx, lat range, lon range)
+DOMAINS = {
+    'BLZE12':  (48,   48,   [15., 19.],   [-89.5, -85.5]),
+    'ORCA1':   (332,  362,  [-78., 89.],  [-180., 180.]),
+    'ORCA025': (1021, 1442, [-78., 89.],  [-180., 180.]),
+    'ORCA12':  (3059, 4322, [-78., 89.],  [-180., 180.]),
+    }
+STEPS_PER_FILE = 240 # time records per synthetic chunk file (10 days of 1h output)
+STAGES = ['load', 'subset', 'frame', 'render', 'encode', 'pa']
+PER_FRAME_STAGES = ['render', 'encode', 'pa'] # compared per frame as well
+CASE_DEFAULTS = {'workers': 1, 'base_map': False} # of reports written before these settings
+
+
+#### Classes
+
+class StageTimer(object):
+    """
+    Wall clock time and peak memory of named stages.
+    Usage: timer = StageTimer(); with timer.stage('load'): ...
+    """
+    def __init__(self):
+        """ No stages yet """
+        self.results = {}
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the enclosed block as stage name """
+        t0 = time.time()
+        yield
+        self.record(name, time.time() - t0)
+
+    def record(self, name, seconds):
+        """ Add seconds to stage name and note the peak memory so far """
+        item = self.results.setdefault(name, {'seconds': 0.})
+        item['seconds'] += seconds
+        item['peak_rss_mb'] = peak_rss_mb()
+        print("benchmark: {:>8s} {:9.3f}s  peak RSS {:8.1f} MB".format(name, item['seconds'], item['peak_rss_mb']))
+
+
+###################### FUNCTIONS ############################
+
+def peak_rss_mb():
+    """ Peak resident set size of this process so far, in MB (ru_maxrss is in kB on Linux) """
+    scale = 1. if sys.platform != 'darwin' else 1./1024 # bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1024.
+
+def make_synthetic(outdir, domain='BLZE12', nt=10, zlib=False, steps_per_file=STEPS_PER_FILE):
+    """
+    Write synthetic grid_T/U/V files for domain, nt hourly records in chunks
+    of steps_per_file, one record at a time (memory does not grow with nt).
+    Returns: glob patterns of the T, U and V files
+    """
+    ny, nx, latlim, lonlim = DOMAINS[domain]
+    lat = np.linspace(latlim[0], latlim[1], ny, dtype=np.float32)[:,None] * np.ones((1,nx), np.float32)
+    lon = np.linspace(lonlim[0], lonlim[1], nx, dtype=np.float32)[None,:] * np.ones((ny,1), np.float32)
+    land = (np.sin(np.radians(4*lon)) * np.cos(np.radians(3*lat)) > 0.6) # some land points
+    t0 = np.datetime64('1995-01-01T00:30')
+    stem = os.path.join(outdir, 'BENCH_1h_{}_{}_grid_{}.nc')
+
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    for first in range(0, nt, steps_per_file):
+        count = min(steps_per_file, nt - first)
+        start = (t0 + np.timedelta64(first,'h')).astype('datetime64[D]')
+        end = (t0 + np.timedelta64(first+count-1,'h')).astype('datetime64[D]')
+        dates = [str(start).replace('-',''), str(end).replace('-','')]
+        for grid, variables in [('T', ['sea_surface_temperature', 'sea_surface_salinity']),
+                                ('U', ['uos']), ('V', ['vos'])]:
+            fname = stem.format(dates[0], dates[1], grid)
+            dataset = Dataset(fname, 'w')
+            dataset.createDimension('y', ny)
+            dataset.createDimension('x', nx)
+            dataset.createDimension('time_counter', None)
+            for name, values in [('nav_lat', lat), ('nav_lon', lon)]:
+                dvar = dataset.createVariable(name, 'f4', ('y','x'), zlib=zlib)
+                dvar[:] = values
+            dvar = dataset.createVariable('time_counter', 'f8', ('time_counter',))
+            dvar.units = 'seconds since 1995-01-01 00:00:00'
+            dvar.calendar = 'gregorian'
+            dvar[:] = 1800. + 3600.*np.arange(first, first+count)
+            for name in variables:
+                dvar = dataset.createVariable(name, 'f4', ('time_counter','y','x'), zlib=zlib,
+                                              chunksizes=(1,ny,nx), fill_value=np.float32(1.e20))
+                for irec in range(count):
+                    phase = 2*np.pi*(first+irec)/24.
+                    if name == 'uos':
+                        field = 0.3*np.cos(np.radians(lat)*8 + phase)
+                    elif name == 'vos':
+                        field = 0.3*np.sin(np.radians(lon)*8 + phase)
+                    else:
+                        field = 28. - 0.2*np.abs(lat) + np.sin(phase) + (7. if 'salinity' in name else 0.)
+                    dvar[irec] = np.ma.masked_where(land, field)
+            dataset.close()
+    print("make_synthetic: {} {}x{}, {} steps in {}".format(domain, ny, nx, nt, outdir))
+    return [os.path.join(outdir, 'BENCH_1h_*_grid_{}.nc'.format(grid)) for grid in 'TUV']
+
+def make_stub_base_map(cache_dir, xlim, ylim, files):
+    """
+    Write a base map for the extent xlim, ylim to the NEMO_basemap cache in cache_dir, as
+    get_base_map would after clipping Natural Earth: land from the land points of the synthetic
+    files, ocean around it, and borders and rivers crossing the extent
+    """
+    with Dataset(sorted(glob(files[0]))[0]) as dataset:
+        lat = dataset.variables['nav_lat'][:]
+        lon = dataset.variables['nav_lon'][:]
+        land = np.ma.getmaskarray(dataset.variables['sea_surface_temperature'][0])
+    dlat = 0.5 * (lat[1,0] - lat[0,0])
+    dlon = 0.5 * (lon[0,1] - lon[0,0])
+    cells = [] # one box per run of land points along a row
+    for j in range(land.shape[0]):
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], land[j].astype(np.int8), [0]])))
+        for i0, i1 in zip(edges[::2], edges[1::2]):
+            cells.append(box(lon[j,i0]-dlon, lat[j,i0]-dlat, lon[j,i1-1]+dlon, lat[j,i0]+dlat))
+    land = unary_union(cells)
+    extent = box(xlim[0], ylim[0], xlim[1], ylim[1])
+    x = np.linspace(xlim[0], xlim[1], 500)
+    phase = 2*np.pi * (x - xlim[0]) / (xlim[1] - xlim[0])
+    lines = {name: [LineString(np.column_stack([x, ylim[0] + (ylim[1]-ylim[0]) * (frac + 0.05*np.sin(waves*phase))]))
+                    for frac in [0.25, 0.5, 0.75]] for name, waves in [('borders', 3), ('rivers', 7)]}
+    geometries = {'ocean': [extent.difference(land)], 'land': [land.intersection(extent)]}
+    geometries.update(lines)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    key = base_map_key(xlim, ylim, ccrs.PlateCarree(), DEFAULT_LAYERS)
+    with open(os.path.join(cache_dir, 'basemap_'+key+'.pkl'), 'wb') as file_object:
+        pickle.dump([(name, geometries[name]) for name in DEFAULT_LAYERS], file_object)
+
+def make_params(files, subset=False, lazy=False, workers=1, ofile='TEMPLATE_SST.gif', base_map_dir=None):
+    """
+    Config module for the synthetic files, in place of a XXX_config.py
+    subset - select the central quarter of the domain (xlim, ylim)
+    ofile - animation of the pa stage (TEMPLATE is replaced by the config name)
+    base_map_dir - NEMO_basemap cache holding a stub base map. None: no base map
+    """
+    params = types.ModuleType('BENCH_config')
+    dataset = Dataset(sorted(glob(files[0]))[0])
+    lat = dataset.variables['nav_lat'][:]
+    lon = dataset.variables['nav_lon'][:]
+    dataset.close()
+    params.xlim, params.ylim, params.tlim = [], [], []
+    if subset:
+        x0, x1 = float(lon.min()), float(lon.max())
+        y0, y1 = float(lat.min()), float(lat.max())
+        params.xlim = [x0 + (x1-x0)/4., x1 - (x1-x0)/4.]
+        params.ylim = [y0 + (y1-y0)/4., y1 - (y1-y0)/4.]
+    params.field = 'temperature'
+    params.fields = [params.field]
+    params.field_specs = {'temperature': {'plot_var': 'sst', 'units': 'degC',
+                          'levs': np.arange(10,35+1,1), 'cmap': plt.get_cmap('Spectral_r'),
+                          'maskval': 0, 'ofile': ofile}}
+    for key, val in params.field_specs['temperature'].items():
+        setattr(params, key, val)
+    params.colorbar_shrink = 0.7
+    params.draw_features = base_map_dir is not None # the stub only: offline
+    params.basemap_layers = DEFAULT_LAYERS
+    params.basemap_resolution = None
+    params.basemap_cache_dir = base_map_dir
+    params.natural_earth_dir = None
+    params.lazy = lazy
+    params.nworkers = workers
+    params.nx_quiv = 60
+    params.speed_min = 0.05
+    params.grid_data = {files[0]: ['nav_lat', 'nav_lon', 'time_counter']}
+    params.input_data = {files[1]: ['uos', 'nav_lat', 'nav_lon', 'time_counter'],
+                         files[2]: ['vos'],
+                         files[0]: ['sea_surface_temperature', 'sea_surface_salinity']}
+    return params
+
+def run_case(workdir, domain, nt, frames=None, subset=False, lazy=False, zlib=False, keep=False,
+             workers=1, base_map=False):
+    """
+    Generate the files for one case and time each stage of the pipeline.
+    frames - number of frames animated (default all nt)
+    workers - processes sharing the frames of the pa stage (params.nworkers)
+    base_map - draw a stub base map (see make_stub_base_map)
+    Returns: dictionary of case settings and stage results
+    """
+    datadir = os.path.join(workdir, '{}_{}'.format(domain, nt))
+    files = make_synthetic(datadir, domain, nt, zlib=zlib)
+    base_map_dir = os.path.join(datadir, 'BASEMAP_CACHE') if base_map else None
+    diag.params = make_params(files, subset, lazy, workers,
+                              os.path.join(workdir, 'TEMPLATE_{}_{}_pa.gif'.format(domain, nt)), base_map_dir)
+    diag.config = 'BENCH'
+    diag.DATASETS.close()
+    diag.DATASETS.tlim = []
+    diag.DATASETS.lazy = lazy
+
+    timer = StageTimer()
+    bucket = diag.DataBucket()
+    params = diag.params
+    try:
+        with timer.stage('load'):
+            for key in params.grid_data:
+                grid_elements = diag.load_nemo_elements(key, params.grid_data[key])
+        with timer.stage('subset'):
+            for element in grid_elements:
+                bucket.define_slice(element)
+            for key, variable_lst in params.input_data.items():
+                for element in diag.load_nemo_elements(key, variable_lst, limits=bucket.limits, lazy=lazy):
+                    bucket.add_data(element)
+
+        nframes = bucket.nframes('sst') if frames is None else min(frames, bucket.nframes('sst'))
+        if base_map:
+            make_stub_base_map(base_map_dir, diag.set_plot_lim(params.xlim, bucket.vars['lon']),
+                               diag.set_plot_lim(params.ylim, bucket.vars['lat']), files)
+        with timer.stage('frame'):
+            renderer = diag.FrameRenderer(bucket, quiver_flag=False)
+            images = renderer.grab(0, nframes)
+
+        # Frames are drawn and encoded in turn, as in DataBucket.pcolor
+        writer = AnimationWriter(os.path.join(workdir, 'BENCH_{}_{}.gif'.format(domain, nt)), fps=10)
+        render = encode = 0.
+        for count in range(nframes):
+            t0 = time.time()
+            images = renderer.grab(count, nframes)
+            t1 = time.time()
+            writer.append_frame(images[0])
+            render += t1 - t0
+            encode += time.time() - t1
+        renderer.close()
+        timer.record('render', render)
+        t0 = time.time()
+        writer.close()
+        timer.record('encode', encode + time.time() - t0)
+
+        # The pa command as run from the menu or --batch
+        with timer.stage('pa'):
+            bucket.pcolor(anim_flag=True, quiver_flag=False, max_frames=nframes)
+    finally:
+        diag.DATASETS.close()
+        if not keep:
+            shutil.rmtree(datadir)
+
+    ny, nx = DOMAINS[domain][:2]
+    return {'domain': domain, 'ny': ny, 'nx': nx, 'nt': nt, 'frames': nframes,
+            'subset': subset, 'lazy': lazy, 'zlib': zlib, 'workers': workers, 'base_map': base_map,
+            'stages': timer.results,
+            'peak_rss_mb': peak_rss_mb()}
+
+def git_commit():
+    """ Commit of the working tree, or None """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                    cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, reference_file):
+    """ Print the stage times of results against those of an earlier json report """
+    with open(reference_file) as file_object:
+        reference = json.load(file_object)
+    print("compare: this run ({}) against {} ({})".format(results['commit'], reference_file,
+                reference.get('commit')))
+    for case in results['cases']:
+        for old in reference['cases']:
+            if all(old.get(key, CASE_DEFAULTS.get(key)) == case[key]
+                   for key in ['domain', 'nt', 'frames', 'subset', 'lazy', 'zlib', 'workers', 'base_map']):
+                for stage in STAGES:
+                    if stage not in old['stages']: # not timed by the earlier version
+                        continue
+                    new_t = case['stages'][stage]['seconds']
+                    old_t = old['stages'][stage]['seconds']
+                    line = "compare: {:>8s} {:>6d} {:>8s} {:9.3f}s -> {:9.3f}s ({:+.0f}%)".format(case['domain'],
+                                case['nt'], stage, old_t, new_t, 100.*(new_t-old_t)/max(old_t, 1e-9))
+                    if stage in PER_FRAME_STAGES and case['frames'] > 0:
+                        line += ", {:.4f}s -> {:.4f}s per frame (x{:.1f})".format(old_t/case['frames'],
+                                new_t/case['frames'], old_t/max(new_t, 1e-9))
+                    print(line)
+                print("compare: {:>8s} {:>6d} peak RSS {:8.1f} MB -> {:8.1f} MB".format(case['domain'],
+                            case['nt'], old['peak_rss_mb'], case['peak_rss_mb']))
+
+
+###################### CORE CODE ############################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the NEMO_surface_var_diag pipeline on synthetic NEMO output.')
+    parser.add_argument('--domain', nargs='+', default=['BLZE12'], choices=sorted(DOMAINS),
+                help='domain sizes to generate')
+    parser.add_argument('--nt', nargs='+', type=int, default=[10],
+                help='numbers of time steps, e.g. 10 100 1000 10000')
+    parser.add_argument('--frames', type=int,
+                help='animate only the first FRAMES time steps')
+    parser.add_argument('--subset', action='store_true',
+                help='subset to the central quarter of the domain (xlim, ylim)')
+    parser.add_argument('--lazy', action='store_true',
+                help='read the fields a frame at a time (params.lazy)')
+    parser.add_argument('--zlib', action='store_true',
+                help='write compressed files')
+    parser.add_argument('--workers', type=int, default=1,
+                help='processes rendering the frames of the pa stage (params.nworkers)')
+    parser.add_argument('--base-map', action='store_true',
+                help='draw a stub base map (land, ocean, borders, rivers) on the frames')
+    parser.add_argument('--workdir', default='benchmark_work',
+                help='directory for the synthetic files and animations')
+    parser.add_argument('--keep', action='store_true',
+                help='keep the synthetic files')
+    parser.add_argument('--output', default='benchmark.json',
+                help='json report')
+    parser.add_argument('--compare',
+                help='earlier json report to compare with')
+    args = parser.parse_args()
+
+    results = {'commit': git_commit(), 'python': sys.version.split()[0], 'cases': []}
+    for domain in args.domain:
+        for nt in args.nt:
+            print("benchmark: {} with {} time steps".format(domain, nt))
+            results['cases'].append( run_case(args.workdir, domain, nt, args.frames,
+                                     args.subset, args.lazy, args.zlib, args.keep,
+                                     args.workers, args.base_map) )
+
+    with open(args.output, 'w') as file_object:
+        json.dump(results, file_object, indent=1)
+    print("benchmark: results written to {}".format(args.output))
+    if args.compare is not None:
+        compare(results, args.compare)
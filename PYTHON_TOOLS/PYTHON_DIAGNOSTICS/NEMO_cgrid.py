@@ -0,0 +1,243 @@
+"""
+NEMO_cgrid.py
+
+The staggered (Arakawa C) NEMO grid: U, V (and F) onto T points, grid to
+east/north rotation, and the scale factors.
+
+** Summary **
+NEMO output on grid_U and grid_V has the shape of grid_T, but U(j,i) lies
+half a cell east of T(j,i) and V(j,i) half a cell north. A StaggeredGrid reads
+the T, U, V, F point positions, scale factors (e1t, e2u, ...) and the
+surface mask from domain_cfg.nc and builds, once per domain:
+    u_to_t      sparse (nT, nU) average of U(j,i-1) and U(j,i) onto T(j,i)
+    v_to_t      sparse (nT, nV) average of V(j-1,i) and V(j,i) onto T(j,i)
+    f_to_t      sparse (nT, nF) average of the four F points around T(j,i)
+    cos, sin    of the angle of the grid i direction from east, at T points
+                (from the U point positions)
+Land U, V faces (no normal flow) count as 0 with their full weight, as
+NEMO's 0.5*(u(i-1)+u(i)). Only missing values at wet points are skipped: the
+operator is applied to the values (0 where missing) and to the validity, and
+the first is divided by the second.
+A chunk of records (nt,ny,nx) is one sparse product per operator.
+
+The operators are kept in a .npz cache, keyed by domain_cfg.nc (path, size,
+mtime). window() restricts them to a subdomain (the DataBucket ilat, ilon
+limits): neighbours outside the window are treated as missing.
+
+** Useage**::
+from NEMO_cgrid import get_staggered_grid
+grid = get_staggered_grid('domain_cfg.nc', cache_dir='CGRID_CACHE').window([J0,J1], [I0,I1])
+u_east, v_north = grid.velocity_to_t(uos, vos) # (ny,nx) or (nt,ny,nx)
+"""
+
+#### Imports
+import os
+import hashlib
+import numpy as np
+import scipy.sparse
+from netCDF4 import Dataset
+
+
+#### Constants
+POINTS = ['t', 'u', 'v', 'f']
+OPERATORS = ['u_to_t', 'v_to_t', 'f_to_t']
+CACHE_VERSION = 3 # part of the cache key: bump when the cached contents change
+
+
+#### Classes
+
+class StaggeredGrid(object):
+    """
+    Positions, scale factors and masks of the T, U, V, F points, and the U, V, F to T operators
+    """
+    def __init__(self, lon, lat, e, mask, operators, cos, sin):
+        """
+        lon, lat - {point type: (ny,nx)} positions
+        e - {'e1t', 'e2t', 'e1u', ...: (ny,nx)} scale factors (m)
+        mask - {point type: (ny,nx)} True at ocean points
+        operators - {name in OPERATORS: sparse averaging weights (unnormalised)}
+        cos, sin - (ny,nx) grid angle at T points
+        """
+        self.lon = lon
+        self.lat = lat
+        self.e = e
+        self.mask = mask
+        self.tmask = mask['t']
+        self.shape = np.shape(self.tmask)
+        self.operators = {name: matrix.tocsr() for name, matrix in operators.items()}
+        self.u_to_t = self.operators['u_to_t']
+        self.v_to_t = self.operators['v_to_t']
+        self.f_to_t = self.operators['f_to_t']
+        self.cos = cos
+        self.sin = sin
+        self._windows = {}
+
+    @classmethod
+    def from_domain_cfg(cls, domain_cfg):
+        """ Read the grid of domain_cfg.nc and build the operators """
+        lon, lat, e = {}, {}, {}
+        with Dataset(domain_cfg) as nc:
+            for point in POINTS:
+                lon[point] = np.squeeze(nc.variables['glam'+point][:]).astype(float)
+                lat[point] = np.squeeze(nc.variables['gphi'+point][:]).astype(float)
+                for name in ['e1'+point, 'e2'+point]:
+                    if name in nc.variables:
+                        e[name] = np.squeeze(nc.variables[name][:]).astype(float)
+            if 'bottom_level' in nc.variables:
+                tmask = np.squeeze(nc.variables['bottom_level'][:]) > 0
+            else:
+                tmask = np.ones(lon['t'].shape, dtype=bool)
+        ny, nx = tmask.shape
+        index = np.arange(ny*nx).reshape((ny, nx))
+
+        # U(j,i) is ocean if T(j,i) and T(j,i+1) are, V(j,i) if T(j,i) and T(j+1,i) are,
+        # F(j,i) if the four T points around it are
+        mask = {'t': tmask, 'u': np.zeros_like(tmask), 'v': np.zeros_like(tmask), 'f': np.zeros_like(tmask)}
+        mask['u'][:, :-1] = tmask[:, :-1] & tmask[:, 1:]
+        mask['v'][:-1, :] = tmask[:-1, :] & tmask[1:, :]
+        mask['f'][:-1, :-1] = mask['u'][:-1, :-1] & mask['u'][1:, :-1]
+        operators = {
+            'u_to_t': neighbour_operator(index[:, :-1], [index[:, :-1], index[:, 1:]], tmask),
+            'v_to_t': neighbour_operator(index[:-1, :], [index[:-1, :], index[1:, :]], tmask),
+            'f_to_t': neighbour_operator(index[:-1, :-1], [index[:-1, :-1], index[:-1, 1:], index[1:, :-1], index[1:, 1:]],
+                                         tmask)}
+
+        # angle of the i direction, from U(j,i-1) to U(j,i) (from T(j,0) to T(j,1) on the first column)
+        dlon = np.empty((ny, nx))
+        dlat = np.empty((ny, nx))
+        dlon[:, 1:] = lon['u'][:, 1:] - lon['u'][:, :-1]
+        dlat[:, 1:] = lat['u'][:, 1:] - lat['u'][:, :-1]
+        dlon[:, 0] = lon['t'][:, 1] - lon['t'][:, 0]
+        dlat[:, 0] = lat['t'][:, 1] - lat['t'][:, 0]
+        dlon = (dlon + 180.) % 360. - 180.
+        angle = np.arctan2(dlat, dlon * np.cos(np.radians(lat['t'])))
+        return cls(lon, lat, e, mask, operators, np.cos(angle), np.sin(angle))
+
+    def window(self, ilat=None, ilon=None):
+        """
+        The grid restricted to rows ilat=[J0,J1] and columns ilon=[I0,I1] (slices J0:J1, I0:I1,
+        as the DataBucket limits select). None: the whole grid
+        """
+        ny, nx = self.shape
+        J0, J1 = ilat if ilat is not None else (0, ny)
+        I0, I1 = ilon if ilon is not None else (0, nx)
+        key = (int(J0), int(J1), int(I0), int(I1))
+        if key == (0, ny, 0, nx):
+            return self
+        if key not in self._windows:
+            sub = (slice(*key[:2]), slice(*key[2:]))
+            rows = np.arange(ny*nx).reshape((ny, nx))[sub].ravel()
+            self._windows[key] = StaggeredGrid({point: arr[sub] for point, arr in self.lon.items()},
+                                               {point: arr[sub] for point, arr in self.lat.items()},
+                                               {name: arr[sub] for name, arr in self.e.items()},
+                                               {point: arr[sub] for point, arr in self.mask.items()},
+                                               {name: matrix[rows][:, rows] for name, matrix in self.operators.items()},
+                                               self.cos[sub], self.sin[sub])
+        return self._windows[key]
+
+    def to_t(self, field, operator, mask=None):
+        """
+        Average field (ny,nx) or (nt,ny,nx) onto T points with operator, skipping missing values
+        mask - (ny,nx) wet points of field. Elsewhere (land faces) field counts as 0
+        Returns: masked array of the same shape, masked where no neighbour is valid
+        """
+        field = np.ma.asarray(field, dtype=float)
+        shape = field.shape
+        values = np.ma.filled(field, np.nan)
+        if mask is not None:
+            values = np.where(mask, values, 0.)
+        values = values.reshape((-1, shape[-2]*shape[-1])).T
+        valid = np.isfinite(values)
+        total = operator.dot(np.where(valid, values, 0.))
+        weight = operator.dot(valid.astype(float))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = total / weight
+        out = out.T.reshape(shape)
+        return np.ma.masked_where(~np.isfinite(out) | ~self.tmask, out)
+
+    def velocity_to_t(self, U, V, rotate=True):
+        """
+        U, V (ny,nx) or (nt,ny,nx) on the U and V points, onto T points and
+        (rotate) turned from the grid i, j directions to east, north
+        Returns: masked arrays u, v
+        """
+        u = self.to_t(U, self.u_to_t, self.mask['u'])
+        v = self.to_t(V, self.v_to_t, self.mask['v'])
+        if not rotate:
+            return u, v
+        return u*self.cos - v*self.sin, u*self.sin + v*self.cos
+
+    def scale_factor(self, name):
+        """ Scale factor e.g. 'e1u' (m). Raises KeyError if domain_cfg did not have it """
+        if name not in self.e:
+            raise KeyError('StaggeredGrid: no scale factor {} in domain_cfg'.format(name))
+        return self.e[name]
+
+    def save(self, cache_file):
+        """ Write the positions, scale factors, masks and operators to a .npz file (aside, then moved into place) """
+        arrays = {'cos': self.cos, 'sin': self.sin}
+        for point in POINTS:
+            arrays['lon_'+point] = self.lon[point]
+            arrays['lat_'+point] = self.lat[point]
+            arrays['mask_'+point] = self.mask[point]
+        for name, arr in self.e.items():
+            arrays['e_'+name] = arr
+        for name, matrix in self.operators.items():
+            arrays.update({name+'_data': matrix.data, name+'_indices': matrix.indices,
+                           name+'_indptr': matrix.indptr, name+'_shape': np.array(matrix.shape)})
+        with open(cache_file+'.tmp', 'wb') as file_object:
+            np.savez(file_object, **arrays)
+        os.replace(cache_file+'.tmp', cache_file)
+
+    @classmethod
+    def load(cls, cache_file):
+        """ StaggeredGrid from a .npz file written by save """
+        with np.load(cache_file) as npz:
+            operators = {name: scipy.sparse.csr_matrix((npz[name+'_data'], npz[name+'_indices'], npz[name+'_indptr']),
+                                                       shape=tuple(npz[name+'_shape'])) for name in OPERATORS}
+            return cls({point: npz['lon_'+point] for point in POINTS}, {point: npz['lat_'+point] for point in POINTS},
+                       {key[2:]: npz[key] for key in npz.files if key.startswith('e_')},
+                       {point: npz['mask_'+point] for point in POINTS}, operators, npz['cos'], npz['sin'])
+
+
+###################### FUNCTIONS ############################
+
+_staggered_grids = {} # StaggeredGrid instances built this session, by domain_cfg signature
+
+def get_staggered_grid(domain_cfg, cache_dir=None):
+    """
+    Return the StaggeredGrid of domain_cfg, building it only if it has not been seen.
+    cache_dir - optional directory where the operators are also kept between sessions
+    Usage: u, v = get_staggered_grid('domain_cfg.nc').velocity_to_t(uos, vos)
+    """
+    stat = os.stat(domain_cfg)
+    key = hashlib.sha1(str([os.path.abspath(domain_cfg), stat.st_size, stat.st_mtime, CACHE_VERSION]).encode()).hexdigest()
+    if key in _staggered_grids:
+        return _staggered_grids[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'cgrid_'+key+'.npz')
+    if cache_file is not None and os.path.exists(cache_file):
+        grid = StaggeredGrid.load(cache_file)
+    else:
+        grid = StaggeredGrid.from_domain_cfg(domain_cfg)
+        if cache_file is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            grid.save(cache_file)
+
+    _staggered_grids[key] = grid
+    return grid
+
+def neighbour_operator(points, tpoints, tmask):
+    """
+    Sparse (nT, n) averaging weights: the point at points (flat indices) lies between the T points
+    tpoints (list of flat index arrays) and is given an equal weight at each ocean one, land faces included
+    """
+    n = tmask.size
+    rows = np.concatenate([tpoint.ravel() for tpoint in tpoints])
+    cols = np.concatenate([points.ravel()] * len(tpoints))
+    keep = tmask.ravel()[rows]
+    return scipy.sparse.coo_matrix((np.full(np.count_nonzero(keep), 1./len(tpoints)), (rows[keep], cols[keep])),
+                                   shape=(n, n)).tocsr()
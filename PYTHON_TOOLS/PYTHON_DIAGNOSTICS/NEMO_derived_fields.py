@@ -0,0 +1,162 @@
+"""
+NEMO_derived_fields.py
+
+Fields derived from the surface velocities (speed, kinetic energy, relative
+vorticity, divergence), computed a time slice at a time when a plot asks for
+them by name, and kept in a bounded cache.
+
+** Summary **
+Each derived field is a function registered with @derived_field(name, needs).
+DataBucket.get_frame(name, icount) looks the name up in DERIVED_FIELDS when it
+is not a loaded variable, reads the slices of the variables it needs, and
+evaluates it. The stencils are vectorized over (ny,nx), or (nt,ny,nx) chunks,
+on the NEMO C-grid with the domain_cfg.nc scale factors of NEMO_cgrid:
+    speed       |u| from U, V averaged onto T points (as loaded without domain_cfg)
+    ke          0.5 (U^2 + V^2), the squares averaged onto T points
+    vorticity   (d(e2v v)/di - d(e1u u)/dj) / (e1f e2f) at F points, averaged
+                onto T points. Needs domain_cfg
+    divergence  (d(e2u u)/di + d(e1v v)/dj) / (e1t e2t) at T points. Needs domain_cfg
+Velocities at land U, V points are 0.
+
+Evaluated slices are kept in a FrameCache: least recently used slices are
+dropped beyond params.derived_cache_bytes, so repeated commands and the
+frames of an animation are only computed once.
+
+** Useage**::
+In the config: field_specs['vorticity'] = {'plot_var': 'vorticity', ...}; domain_cfg = dirname+'domain_cfg.nc'
+
+from NEMO_derived_fields import derived_field
+@derived_field('speed2', ['ssu', 'ssv'], 'm2/s2')
+def speed2(U, V, grid):
+    return U**2 + V**2
+"""
+
+#### Imports
+from collections import OrderedDict
+import numpy as np
+
+
+#### Constants
+CACHE_BYTES = 256*2**20 # derived slices kept per DataBucket
+
+
+#### Classes
+
+class DerivedField(object):
+    """
+    A field computed from loaded variables
+    """
+    def __init__(self, name, needs, units, function, needs_grid=False):
+        """
+        needs - variables (DataBucket keys) passed to function, in order
+        function - function(*arrays, grid) returning a masked array on T points
+        needs_grid - function needs the StaggeredGrid (scale factors)
+        """
+        self.name = name
+        self.needs = list(needs)
+        self.units = units
+        self.function = function
+        self.needs_grid = needs_grid
+
+    def evaluate(self, arrays, grid=None):
+        """ The field from the arrays of the variables in needs. grid: a StaggeredGrid or None """
+        if self.needs_grid and grid is None:
+            raise ValueError('{} needs the C-grid scale factors: set domain_cfg in the config'.format(self.name))
+        return self.function(*(list(arrays) + [grid]))
+
+
+class FrameCache(object):
+    """
+    Least recently used cache of arrays, bounded in bytes
+    """
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ The array stored under key (now the most recently used), or None """
+        if key not in self.items:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        """ Store value, dropping the least recently used arrays beyond max_bytes """
+        if key in self.items:
+            self.nbytes -= np.ma.asarray(self.items.pop(key)).nbytes
+        self.items[key] = value
+        self.nbytes += np.ma.asarray(value).nbytes
+        while self.nbytes > self.max_bytes and len(self.items) > 1:
+            self.nbytes -= np.ma.asarray(self.items.popitem(last=False)[1]).nbytes
+
+    def clear(self):
+        """ Drop every array, e.g. when the variables they were derived from change """
+        self.items.clear()
+        self.nbytes = 0
+
+
+###################### FUNCTIONS ############################
+
+DERIVED_FIELDS = OrderedDict() # name: DerivedField
+
+def derived_field(name, needs, units='', needs_grid=False):
+    """ Decorator registering function(*arrays, grid) as the derived field name """
+    def register(function):
+        DERIVED_FIELDS[name] = DerivedField(name, needs, units, function, needs_grid)
+        return function
+    return register
+
+def inputs_of(name):
+    """ Variables needed to draw name: its inputs if it is derived, else [name] """
+    return DERIVED_FIELDS[name].needs if name in DERIVED_FIELDS else [name]
+
+def land_to_zero(field, mask):
+    """ Field (masked, (...,ny,nx)) as a float array, 0 where not mask (land), NaN where missing """
+    field = np.ma.filled(np.ma.asarray(field, dtype=float), np.nan)
+    return np.where(mask, field, 0.)
+
+@derived_field('speed', ['ssu', 'ssv'], 'm/s')
+def speed(U, V, grid):
+    """ Current speed on T points """
+    if grid is not None:
+        U, V = grid.velocity_to_t(U, V, rotate=False)
+    return np.ma.sqrt(U**2 + V**2)
+
+@derived_field('ke', ['ssu', 'ssv'], 'm2/s2')
+def kinetic_energy(U, V, grid):
+    """ Kinetic energy per unit mass on T points: the squares averaged from U and V points """
+    if grid is None:
+        return 0.5 * (U**2 + V**2)
+    return 0.5 * (grid.to_t(U**2, grid.u_to_t, grid.mask['u']) + grid.to_t(V**2, grid.v_to_t, grid.mask['v']))
+
+@derived_field('vorticity', ['ssu', 'ssv'], '1/s', needs_grid=True)
+def vorticity(U, V, grid):
+    """ Relative vorticity at F points, as NEMO's curl, averaged onto T points (land F points skipped) """
+    u = land_to_zero(U, grid.mask['u'])
+    v = land_to_zero(V, grid.mask['v'])
+    e1u, e2v = grid.scale_factor('e1u'), grid.scale_factor('e2v')
+    e1f, e2f = grid.scale_factor('e1f'), grid.scale_factor('e2f')
+    zeta = np.full(u.shape, np.nan)
+    zeta[..., :-1, :-1] = ( e2v[:-1, 1:]*v[..., :-1, 1:] - e2v[:-1, :-1]*v[..., :-1, :-1]
+                          - e1u[1:, :-1]*u[..., 1:, :-1] + e1u[:-1, :-1]*u[..., :-1, :-1] ) \
+                          / (e1f[:-1, :-1]*e2f[:-1, :-1])
+    zeta = np.where(grid.mask['f'], zeta, np.nan)
+    return grid.to_t(zeta, grid.f_to_t)
+
+@derived_field('divergence', ['ssu', 'ssv'], '1/s', needs_grid=True)
+def divergence(U, V, grid):
+    """ Horizontal divergence at T points, as NEMO's hdiv """
+    u = land_to_zero(U, grid.mask['u'])
+    v = land_to_zero(V, grid.mask['v'])
+    e2u, e1v = grid.scale_factor('e2u'), grid.scale_factor('e1v')
+    e1t, e2t = grid.scale_factor('e1t'), grid.scale_factor('e2t')
+    div = np.full(u.shape, np.nan)
+    div[..., 1:, 1:] = ( e2u[1:, 1:]*u[..., 1:, 1:] - e2u[1:, :-1]*u[..., 1:, :-1]
+                       + e1v[1:, 1:]*v[..., 1:, 1:] - e1v[:-1, 1:]*v[..., :-1, 1:] ) \
+                       / (e1t[1:, 1:]*e2t[1:, 1:])
+    return np.ma.masked_where(~np.isfinite(div) | ~grid.tmask, div)
@@ -0,0 +1,270 @@
+"""
+NEMO_diag_timing.py
+
+Opt-in timing and profiling of the stages of the diagnostics.
+
+** Summary **
+Code is marked up with named stages:
+    with TRACE.stage('read', file=fname): ...
+which cost next to nothing until tracing is switched on with TRACE.enable().
+Each stage then records its wall time, CPU time, bytes read by the process
+(/proc/self/io, where available) and, optionally, the peak of the memory
+allocated by python (tracemalloc). Stages may be nested. At exit the records
+are written as a JSON or CSV trace, and a summary table per stage is printed.
+
+Commands can also be profiled one at a time:
+    with TRACE.profile(command): ...
+runs cProfile (a .prof file and the top functions are printed) or a sampling
+profiler (stack samples of the main thread every few ms, in the folded format
+used by flamegraph.pl and speedscope) when the command is one of those asked for.
+
+** Useage**::
+from NEMO_diag_timing import TRACE
+TRACE.enable('BLZ_trace.json', memory=True, profile_commands=['pa'], profile_mode='sample')
+with TRACE.stage('savefig', frame=icount):
+    fig.savefig(fname)
+"""
+
+#### Imports
+import os
+import sys
+import csv
+import json
+import time
+import atexit
+import threading
+import cProfile
+import pstats
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+
+#### Constants
+SAMPLE_INTERVAL = 0.005 # seconds between stack samples
+
+
+#### Classes
+
+class StageTrace(object):
+    """
+    Records of timed stages. Disabled (and nearly free) until enable() is called.
+    """
+    def __init__(self):
+        """ Start disabled, with no records """
+        self.enabled = False
+        self.trace_file = None
+        self.memory = False
+        self.profile_commands = []
+        self.profile_mode = 'cprofile'
+        self.records = []
+        self._stack = [] # open stages, innermost last
+        self._t0 = time.perf_counter()
+
+    def enable(self, trace_file=None, memory=False, profile_commands=None, profile_mode='cprofile'):
+        """
+        Switch tracing on. The trace is written and the summary printed at exit.
+        trace_file - .json or .csv trace (None: summary only)
+        memory - also record allocation peaks (tracemalloc, slows python code down)
+        profile_commands - commands run under the profiler
+        profile_mode - 'cprofile' or 'sample'
+        """
+        self.enabled = True
+        self.trace_file = trace_file
+        self.memory = memory
+        self.profile_commands = list(profile_commands or [])
+        self.profile_mode = profile_mode
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        atexit.register(self.finish)
+
+    @contextmanager
+    def stage(self, name, **info):
+        """
+        Time the enclosed block as stage name.
+        info - extra fields for the record, e.g. frame=icount
+        """
+        if not self.enabled:
+            yield
+            return
+
+        record = {'stage': name, 'depth': len(self._stack),
+                  'start': time.perf_counter() - self._t0}
+        record.update(info)
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            if self._stack: # the enclosing stage keeps its peak so far
+                self._stack[-1]['_peak'] = max(self._stack[-1].get('_peak', 0), peak)
+            tracemalloc.reset_peak()
+            record['_base'] = tracemalloc.get_traced_memory()[0]
+        self._stack.append(record)
+        io0 = read_io()
+        cpu0 = time.process_time()
+        wall0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            record['wall'] = time.perf_counter() - wall0
+            record['cpu'] = time.process_time() - cpu0
+            io1 = read_io()
+            for key in ['read_bytes', 'rchar']:
+                record[key] = io1[key] - io0[key] if key in io0 and key in io1 else None
+            self._stack.pop()
+            if self.memory:
+                peak = max(tracemalloc.get_traced_memory()[1], record.pop('_peak', 0))
+                record['alloc_peak_mb'] = (peak - record.pop('_base')) / 2.**20
+                if self._stack:
+                    self._stack[-1]['_peak'] = max(self._stack[-1].get('_peak', 0), peak)
+            self.records.append(record)
+
+    @contextmanager
+    def profile(self, command):
+        """ Profile the enclosed block if command is one of profile_commands """
+        if not self.enabled or command not in self.profile_commands:
+            yield
+            return
+        stem = os.path.splitext(self.trace_file or 'trace')[0] + '_' + command
+        if self.profile_mode == 'sample':
+            sampler = StackSampler()
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                sampler.write(stem+'.folded')
+                sampler.print_top()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(stem+'.prof')
+                print("profile: {} written to {}.prof".format(command, stem))
+                pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+
+    def write(self, trace_file):
+        """ Write the records to a .json or .csv file """
+        if os.path.splitext(trace_file)[1].lower() == '.csv':
+            fields = ['stage', 'depth', 'start', 'wall', 'cpu', 'read_bytes', 'rchar', 'alloc_peak_mb']
+            for record in self.records:
+                fields += [key for key in record if key not in fields]
+            with open(trace_file, 'w') as file_object:
+                writer = csv.DictWriter(file_object, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(self.records)
+        else:
+            with open(trace_file, 'w') as file_object:
+                json.dump({'stages': self.records, 'summary': self.summary()}, file_object, indent=1)
+        print("StageTrace: {} records written to {}".format(len(self.records), trace_file))
+
+    def summary(self):
+        """
+        Totals per stage name, in order of first appearance
+        Returns: list of dictionaries
+        """
+        table = {}
+        for record in self.records:
+            item = table.setdefault(record['stage'], {'stage': record['stage'], 'count': 0,
+                        'wall': 0., 'cpu': 0., 'read_bytes': 0, 'rchar': 0, 'alloc_peak_mb': None})
+            item['count'] += 1
+            item['wall'] += record['wall']
+            item['cpu'] += record['cpu']
+            item['read_bytes'] += record.get('read_bytes') or 0
+            item['rchar'] += record.get('rchar') or 0
+            if record.get('alloc_peak_mb') is not None:
+                item['alloc_peak_mb'] = max(item['alloc_peak_mb'] or 0., record['alloc_peak_mb'])
+        return list(table.values())
+
+    def print_summary(self):
+        """
+        Print the summary table. read is from storage, rchar includes reads
+        served from the page cache. Nested stages are also part of their parent
+        """
+        print("{:>16s} {:>7s} {:>10s} {:>10s} {:>10s} {:>10s} {:>11s} {:>10s}".format('stage', 'count',
+                    'wall (s)', 'cpu (s)', 'mean (s)', 'read (MB)', 'rchar (MB)', 'peak (MB)'))
+        for item in self.summary():
+            peak = '' if item['alloc_peak_mb'] is None else '{:.1f}'.format(item['alloc_peak_mb'])
+            print("{:>16s} {:7d} {:10.3f} {:10.3f} {:10.4f} {:10.1f} {:11.1f} {:>10s}".format(item['stage'],
+                        item['count'], item['wall'], item['cpu'], item['wall']/item['count'],
+                        item['read_bytes']/2.**20, item['rchar']/2.**20, peak))
+
+    def finish(self):
+        """ Write the trace and print the summary (run at exit) """
+        if not self.enabled or not self.records:
+            return
+        if self.trace_file is not None:
+            self.write(self.trace_file)
+        self.print_summary()
+        self.records = []
+
+
+class StackSampler(object):
+    """
+    Sampling profiler: a thread that records the main thread's python stack
+    every interval seconds. Each distinct stack is counted, as py-spy does.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        """ Sample the thread that creates the sampler """
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Start sampling """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        """ Sampling loop """
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name,
+                                os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """ Stop sampling """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, folded_file):
+        """ Write the stacks in folded format: 'outer;...;inner count' per line """
+        with open(folded_file, 'w') as file_object:
+            for stack, count in self.counts.most_common():
+                file_object.write('{} {}\n'.format(stack, count))
+        print("StackSampler: {} samples written to {}".format(sum(self.counts.values()), folded_file))
+
+    def print_top(self, number=15):
+        """ Print the functions seen most often on top of the stack, with their share of the samples """
+        total = float(sum(self.counts.values())) or 1.
+        own = Counter()
+        for stack, count in self.counts.items():
+            own[stack.rsplit(';', 1)[-1]] += count
+        for name, count in own.most_common(number):
+            print("StackSampler: {:6.1f}% {}".format(100.*count/total, name))
+
+
+###################### FUNCTIONS ############################
+
+def read_io():
+    """ Cumulative I/O counters of this process from /proc/self/io, or {} where not available """
+    try:
+        with open('/proc/self/io') as file_object:
+            return {key: int(val) for key, val in
+                    (line.split(':') for line in file_object if ':' in line)}
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+TRACE = StageTrace() # One trace per session
@@ -0,0 +1,54 @@
+"""
+NEMO_file_tools.py
+
+Small helpers for NEMO (XIOS) output file names and times, shared by the
+diagnostics scripts.
+
+** Summary **
+expand_nemo_files() expands a glob pattern into the sorted XIOS output chunks,
+dropping the chunks whose @startdate@_@enddate@ do not overlap tlim.
+parse_time() reads an ISO 8601 date from the command line. Only the standard
+library and numpy are needed, so the offline scripts (NEMO_surface_stats,
+NEMO_tidal_analysis, NEMO_station_extract) do not import the plotting code.
+
+** Useage**::
+from NEMO_file_tools import expand_nemo_files, parse_time
+files = expand_nemo_files(dirname+'BLZE12_C1_1h_*_grid_T.nc', [parse_time('1995-01-01'), parse_time('1995-02-01')])
+"""
+
+#### Imports
+import os
+import re
+import datetime
+from glob import glob
+import numpy as np
+
+
+###################### FUNCTIONS ############################
+
+def expand_nemo_files(file_name, tlim=[]):
+    """
+    Expand a file name or glob pattern into a sorted list of XIOS output chunks.
+    If tlim is set, chunks named @expname@_@freq@_@startdate@_@enddate@ that do
+    not overlap it are dropped. Files without parsable dates are kept.
+    Usage: files = expand_nemo_files(dirname+'BLZE12_C1_1h_*_grid_T.nc', tlim)
+    """
+    files = sorted(glob(file_name))
+    if tlim == []:
+        return files
+
+    kept = []
+    for fname in files:
+        dates = re.search(r'_(\d{8})_(\d{8})_', os.path.basename(fname))
+        if dates is None:
+            kept.append(fname)
+            continue
+        start = datetime.datetime.strptime(dates.group(1), '%Y%m%d')
+        end = datetime.datetime.strptime(dates.group(2), '%Y%m%d') + datetime.timedelta(days=1)
+        if start <= tlim[1] and end > tlim[0]:
+            kept.append(fname)
+    return kept
+
+def parse_time(text):
+    """ datetime.datetime from an ISO 8601 string, e.g. 1995-01-01 or 1995-01-01T12:00 """
+    return np.datetime64(text, 's').item()
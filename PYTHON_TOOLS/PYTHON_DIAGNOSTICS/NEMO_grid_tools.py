@@ -0,0 +1,117 @@
+"""
+NEMO_grid_tools.py
+
+Nearest grid point lookup on NEMO curvilinear grids.
+
+** Summary **
+A GridIndex is a KD-tree over the (nav_lat, nav_lon) points of a grid, placed
+on the unit sphere so that neighbours are ordered by great-circle distance.
+It is built once per grid and then answers batched queries for any number of
+points in one vectorized call. get_grid_index() keeps the indices built in a
+session, and can also keep them on disk.
+
+** Useage**::
+from NEMO_grid_tools import get_grid_index
+index = get_grid_index(nav_lat, nav_lon)
+J, I = index.query(lats, lons) # arrays of any shape
+"""
+
+#### Imports
+import os
+import hashlib
+import pickle
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+#### Constants
+EARTH_RADIUS = 6371.0 # km
+
+
+#### Classes
+
+class GridIndex(object):
+    """
+    KD-tree over the points of a 2D grid.
+    Points with NaN coordinates, or outside the optional mask, are never returned.
+    """
+    def __init__(self, lat_grid, lon_grid, mask=None):
+        """
+        Build the tree
+        mask - True where a grid point may be returned, e.g. wet points
+        """
+        lat_grid = np.ma.filled(np.ma.asarray(lat_grid, dtype=float), np.nan)
+        lon_grid = np.ma.filled(np.ma.asarray(lon_grid, dtype=float), np.nan)
+        self.shape = np.shape(lat_grid)
+
+        valid = np.isfinite(lat_grid) & np.isfinite(lon_grid)
+        if mask is not None:
+            valid &= np.asarray(mask, dtype=bool)
+        self.points = np.flatnonzero(valid) # flat index of each tree point
+        self.tree = cKDTree( lonlat_to_xyz(lon_grid.ravel()[self.points],
+                                           lat_grid.ravel()[self.points]) )
+
+    def query(self, lat, lon, return_distance=False):
+        """
+        Nearest grid point to each lat, lon (scalars or arrays of the same shape)
+        Returns: J, I index arrays with the shape of lat [, great-circle distance in km]
+        """
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        chord, k = self.tree.query( lonlat_to_xyz(lon.ravel(), lat.ravel()) )
+        J, I = np.unravel_index(self.points[k], self.shape)
+        J = J.reshape(lat.shape)
+        I = I.reshape(lat.shape)
+        if return_distance:
+            dist = 2. * EARTH_RADIUS * np.arcsin( np.minimum(chord, 2.) / 2. )
+            return J, I, dist.reshape(lat.shape)
+        return J, I
+
+
+###################### FUNCTIONS ############################
+
+_grid_indices = {} # GridIndex instances built this session, by grid fingerprint
+
+def get_grid_index(lat_grid, lon_grid, mask=None, cache_dir=None):
+    """
+    Return the GridIndex for this grid, building it only if it has not been seen.
+    cache_dir - optional directory where indices are also kept between sessions
+    Usage: J, I = get_grid_index(nav_lat, nav_lon).query(lats, lons)
+    """
+    key = grid_fingerprint(lat_grid, lon_grid, mask)
+    if key in _grid_indices:
+        return _grid_indices[key]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'gridindex_'+key+'.pkl')
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as file_object:
+            index = pickle.load(file_object)
+    else:
+        index = GridIndex(lat_grid, lon_grid, mask)
+        if cache_file is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(cache_file+'.tmp', 'wb') as file_object:
+                pickle.dump(index, file_object)
+            os.replace(cache_file+'.tmp', cache_file)
+
+    _grid_indices[key] = index
+    return index
+
+def grid_fingerprint(lat_grid, lon_grid, mask=None):
+    """ Hash of the grid coordinates (and mask) identifying a GridIndex """
+    sha = hashlib.sha1()
+    for arr in [lat_grid, lon_grid, mask]:
+        if arr is not None:
+            arr = np.ascontiguousarray(np.ma.filled(np.ma.asarray(arr, dtype=float), np.nan))
+            sha.update(str(arr.shape).encode())
+            sha.update(arr.tobytes())
+    return sha.hexdigest()
+
+def lonlat_to_xyz(lon, lat):
+    """ Unit sphere cartesian coordinates of lon, lat (degrees). Returns: (n,3) array """
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    return np.column_stack([ np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat) ])
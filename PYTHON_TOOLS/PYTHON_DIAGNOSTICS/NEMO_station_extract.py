@@ -0,0 +1,357 @@
+"""
+NEMO_station_extract.py
+
+Time series of NEMO surface output at stations (e.g. tide gauges), kept in a
+point-major store, and comparison with gauge records.
+
+** Summary **
+The stations (a CSV of name,lat,lon) are mapped to the nearest wet grid point
+once, with the cached GridIndex of NEMO_grid_tools. From each output file,
+only the columns of those points are read: one read per variable and grid row
+holding stations (netCDF4 orthogonal indexing of the station columns of the
+row), never the (time,y,x) maps. The files are read on --nworkers processes.
+
+The store is a directory of
+    <var>.npy           float32 (ntimes, nstations) per variable, in time order
+    <var>_time.npy      datetime64[s] times of the variable
+    meta.json           stations, grid indices and the source files (size,
+                        mtime, records) of each variable
+Only files not yet in the store, or changed since (e.g. a chunk XIOS was still
+writing), are read on an update. Their records are appended to the .npy files
+in place; the arrays are rewritten aside (then moved into place) when stored
+records change, i.e. a changed file, or a file before the stored records.
+meta.json is replaced last (written aside, then moved into place) and the
+store is read only up to the records it lists, so an interrupted update leaves
+the previous store readable. The store is rebuilt if the stations change.
+Different variables may come from different files (grid_T zos, grid_U ssu,
+grid_V ssv); the station points are the wet points of the first variable.
+
+compare() matches a gauge record (CSV of time,value) with the model series
+(linear interpolation to the gauge times, within the model record) and
+returns the bias, RMSE and correlation, optionally after removing both means
+(datums differ between zos and gauges).
+
+** Useage**::
+python NEMO_station_extract.py '/Belize_workshop/RUN_NEMO/EXP_demo/BLZE12_C1_1h_*_grid_T.nc' \
+    --stations BLZ_stations.csv --var zos --store STATIONS --nworkers 4
+python NEMO_station_extract.py --store STATIONS --gauge Belize_City belize_city_gauge.csv --demean
+
+from NEMO_station_extract import StationStore
+times, zos = StationStore('STATIONS').series('Belize_City', 'zos')
+"""
+
+#### Imports
+import io
+import os
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+from netCDF4 import Dataset, num2date
+
+from NEMO_grid_tools import get_grid_index
+from NEMO_file_tools import expand_nemo_files, parse_time
+
+
+#### Constants
+STORE_DIR = 'STATIONS'
+STORE_VERSION = 2 # stores of another version are rebuilt
+GRID_INDEX_CACHE = 'GRID_INDEX_CACHE'
+
+
+#### Classes
+
+class StationStore(object):
+    """
+    Station time series of a store directory, memory mapped
+    """
+    def __init__(self, store_dir=STORE_DIR):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as file_object:
+            self.meta = json.load(file_object)
+        self.names = [station['name'] for station in self.meta['stations']]
+
+    def variables(self):
+        return sorted(self.meta['variables'])
+
+    def series(self, station, var):
+        """ Returns: datetime64 times, float32 values of station (name or index) """
+        istation = self.names.index(station) if not isinstance(station, int) else station
+        nrec = self.meta['variables'][var]['records']
+        values = np.load(os.path.join(self.store_dir, var+'.npy'), mmap_mode='r')
+        times = np.load(os.path.join(self.store_dir, var+'_time.npy'), mmap_mode='r')
+        return np.array(times[:nrec]), np.array(values[:nrec, istation])
+
+
+###################### FUNCTIONS ############################
+
+def read_stations(station_file):
+    """ Stations from a CSV of name,lat,lon rows (a header line is skipped). Returns: list of dictionaries """
+    stations = []
+    with open(station_file) as file_object:
+        for row in csv.reader(file_object):
+            try:
+                stations.append({'name': row[0].strip(), 'lat': float(row[1]), 'lon': float(row[2])})
+            except (ValueError, IndexError): # header or blank line
+                continue
+    return stations
+
+def locate_stations(stations, grid_file, mask_var, cache_dir=GRID_INDEX_CACHE):
+    """
+    Nearest wet point of grid_file to each station (wet: mask_var valid in the first record)
+    Returns: stations, with J, I, model lat, lon and distance (km) added
+    """
+    with Dataset(grid_file) as nc:
+        nav_lat = nc.variables['nav_lat'][:]
+        nav_lon = nc.variables['nav_lon'][:]
+        nc_var = nc.variables[mask_var]
+        first = nc_var[0, 0] if nc_var.ndim == 4 else nc_var[0]
+    wet = ~np.ma.getmaskarray(first) & np.isfinite(np.ma.filled(first, np.nan))
+    J, I, dist = get_grid_index(nav_lat, nav_lon, wet, cache_dir).query(
+                        [station['lat'] for station in stations], [station['lon'] for station in stations],
+                        return_distance=True)
+    for station, j, i, d in zip(stations, J, I, dist):
+        station.update({'J': int(j), 'I': int(i), 'distance': float(d),
+                        'model_lat': float(nav_lat[j, i]), 'model_lon': float(nav_lon[j, i])})
+        print("locate_stations: {} at J={} I={}, {:.2f} km away".format(station['name'], j, i, d))
+    return stations
+
+def read_points(nc_var, J, I):
+    """
+    All the records of nc_var at the points (J, I), one read per grid row holding points
+    Returns: (ntimes, npoints) float32, NaN where masked
+    """
+    J = np.asarray(J)
+    I = np.asarray(I)
+    out = np.empty((nc_var.shape[0], len(J)), dtype=np.float32)
+    for j in np.unique(J):
+        cols = np.flatnonzero(J == j)
+        icols = sorted(set(I[cols])) # netCDF4 wants increasing indices
+        if nc_var.ndim == 4:
+            row = nc_var[:, 0, int(j), icols]
+        else:
+            row = nc_var[:, int(j), icols]
+        row = np.ma.filled(np.ma.asarray(row, dtype=np.float32), np.nan)
+        out[:, cols] = row[:, np.searchsorted(icols, I[cols])]
+    return out
+
+def extract_file(job):
+    """
+    Pool worker: the station columns of the variables found in one file
+    job - (file name, variables, J, I)
+    Returns: file name, datetime64 times, {var: (ntimes, npoints)}
+    """
+    fname, variables, J, I = job
+    with Dataset(fname) as nc:
+        tvar = nc.variables['time_counter']
+        dates = num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard'))
+        times = np.array([np.datetime64(str(date)) for date in dates], dtype='datetime64[s]')
+        data = {var: read_points(nc.variables[var], J, I) for var in variables if var in nc.variables}
+    return fname, times, data
+
+def file_signature(fname):
+    """ Path, size and modification time """
+    stat = os.stat(fname)
+    return [os.path.abspath(fname), stat.st_size, stat.st_mtime]
+
+def append_records(path, array, keep):
+    """
+    Keep the first keep records (rows) of the .npy file path and append array after them.
+    If keep is all the records of the file, they are appended in place: the new records are written
+    after the old ones, then the header. Otherwise (records overwritten, or no file) the file is
+    rewritten aside and moved into place, so an interrupted call leaves a readable file
+    """
+    if keep and os.path.exists(path):
+        with open(path, 'r+b') as file_object:
+            version = np.lib.format.read_magic(file_object)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(file_object)
+            offset = file_object.tell()
+            header = io.BytesIO()
+            write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+            write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                                  'shape': (keep + len(array),) + tuple(shape[1:])})
+            # the header has room for the record count to grow: it only moves if the layout differs
+            if (not fortran_order and dtype == array.dtype and tuple(shape[1:]) == array.shape[1:]
+                    and keep == shape[0] and len(header.getvalue()) == offset):
+                file_object.seek(offset + keep * dtype.itemsize * int(np.prod(shape[1:])))
+                file_object.truncate()
+                file_object.write(np.ascontiguousarray(array).tobytes())
+                file_object.seek(0)
+                file_object.write(header.getvalue())
+                return
+        array = np.concatenate([np.load(path, mmap_mode='r')[:keep], array])
+    with open(path+'.tmp', 'wb') as file_object:
+        np.save(file_object, array)
+    os.replace(path+'.tmp', path)
+
+def update_store(files, stations, variables, store_dir=STORE_DIR, nworkers=1, cache_dir=GRID_INDEX_CACHE):
+    """
+    Extract the stations from the files not yet in store_dir (or changed), and append
+    their records to the arrays of the variables. Returns: StationStore
+    """
+    t0 = time.time()
+    meta = None
+    if os.path.exists(os.path.join(store_dir, 'meta.json')):
+        with open(os.path.join(store_dir, 'meta.json')) as file_object:
+            meta = json.load(file_object)
+        station_keys = [(station['name'], station['lat'], station['lon']) for station in meta['stations']]
+        if meta.get('version') != STORE_VERSION:
+            print("update_store: {} was written by another version, rebuilding it".format(store_dir))
+            meta = None
+        elif station_keys != [(station['name'], station['lat'], station['lon']) for station in stations]:
+            print("update_store: the stations have changed, rebuilding {}".format(store_dir))
+            meta = None
+    if meta is None:
+        for grid_file in files: # the first file holding the first variable sets the points
+            with Dataset(grid_file) as nc:
+                if variables[0] in nc.variables:
+                    break
+        stations = locate_stations(stations, grid_file, variables[0], cache_dir)
+        meta = {'version': STORE_VERSION, 'stations': stations, 'variables': {}}
+    J = [station['J'] for station in meta['stations']]
+    I = [station['I'] for station in meta['stations']]
+
+    # variables to read from each file: all if it is new or changed since it was read, else those not read yet
+    signatures = {fname: file_signature(fname) for fname in files}
+    scanned = meta.setdefault('files', {})
+    wanted = {}
+    for fname in files:
+        entry = scanned.get(signatures[fname][0], {})
+        done = entry['variables'] if entry.get('signature') == signatures[fname] else []
+        wanted[fname] = [var for var in variables if var not in done]
+    todo = [fname for fname in files if wanted[fname]]
+    if not todo:
+        print("update_store: {} is current".format(store_dir))
+        return StationStore(store_dir)
+
+    jobs = [(fname, wanted[fname], J, I) for fname in todo]
+    if nworkers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nworkers, len(jobs)))
+        try:
+            results = pool.map(extract_file, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [extract_file(job) for job in jobs]
+
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    for var in variables:
+        new = [(signatures[fname] + [len(times)], times, data[var]) for fname, times, data in results if var in data]
+        if not new:
+            continue
+        new.sort(key=lambda part: part[1][0] if len(part[1]) else np.datetime64('NaT'))
+        sources = meta['variables'].get(var, {'sources': []})['sources']
+        replaced = set(source[0] for source, times, values in new)
+        kept = [source for source in sources if source[0] not in replaced]
+        offsets = np.cumsum([0] + [source[3] for source in sources])
+        time_file = os.path.join(store_dir, var+'_time.npy')
+        value_file = os.path.join(store_dir, var+'.npy')
+        keep = int(offsets[len(kept)])
+        new_times = np.concatenate([times for source, times, values in new])
+        new_values = np.concatenate([values for source, times, values in new])
+        if kept != sources[:len(kept)] or (keep and len(new_times)
+                                            and np.load(time_file, mmap_mode='r')[keep-1] >= new_times[0]):
+            # a file before the last stored record: rewrite in time order
+            old_times = np.load(time_file, mmap_mode='r')
+            old_values = np.load(value_file, mmap_mode='r')
+            parts = [(source, old_times[i0:i1], old_values[i0:i1])
+                     for source, i0, i1 in zip(sources, offsets[:-1], offsets[1:]) if source[0] not in replaced]
+            parts = sorted(parts + new, key=lambda part: part[1][0] if len(part[1]) else np.datetime64('NaT'))
+            kept, keep, new = [], 0, parts
+            new_times = np.concatenate([times for source, times, values in parts])
+            new_values = np.concatenate([values for source, times, values in parts])
+        append_records(time_file, new_times, keep)
+        append_records(value_file, new_values, keep)
+        meta['variables'][var] = {'sources': kept + [source for source, times, values in new],
+                                  'records': keep + len(new_times)}
+
+    for fname in todo:
+        entry = scanned.get(signatures[fname][0], {})
+        done = entry['variables'] if entry.get('signature') == signatures[fname] else []
+        scanned[signatures[fname][0]] = {'signature': signatures[fname], 'variables': done + wanted[fname]}
+    meta['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    with open(os.path.join(store_dir, 'meta.json.tmp'), 'w') as file_object:
+        json.dump(meta, file_object, indent=1)
+    os.replace(os.path.join(store_dir, 'meta.json.tmp'), os.path.join(store_dir, 'meta.json'))
+    print("update_store: {} files read into {} in {:.1f}s".format(len(todo), store_dir, time.time()-t0))
+    return StationStore(store_dir)
+
+def read_gauge(gauge_file):
+    """ Gauge record from a CSV of time,value rows (ISO 8601 times, a header line is skipped). Returns: times, values """
+    times, values = [], []
+    with open(gauge_file) as file_object:
+        for row in csv.reader(file_object):
+            try:
+                times.append(np.datetime64(parse_time(row[0].strip()), 's'))
+                values.append(float(row[1]))
+            except (ValueError, IndexError): # header, blank line or missing value
+                continue
+    return np.array(times, dtype='datetime64[s]'), np.array(values)
+
+def compare(model_times, model_values, gauge_times, gauge_values, demean=False):
+    """
+    Model against gauge at the gauge times within the model record (model linearly interpolated)
+    demean - remove both means first (e.g. zos against a gauge datum)
+    Returns: dictionary n, bias (model - gauge), rmse, correlation
+    """
+    ok = np.isfinite(model_values)
+    tm = model_times[ok].astype('datetime64[s]').astype(float)
+    tg = gauge_times.astype('datetime64[s]').astype(float)
+    inside = np.isfinite(gauge_values)
+    if len(tm):
+        inside &= (tg >= tm[0]) & (tg <= tm[-1])
+    else:
+        inside[:] = False
+    if np.count_nonzero(inside) < 2:
+        return {'n': int(np.count_nonzero(inside)), 'bias': np.nan, 'rmse': np.nan, 'correlation': np.nan}
+    gauge = gauge_values[inside]
+    model = np.interp(tg[inside], tm, model_values[ok])
+    if demean:
+        model = model - model.mean()
+        gauge = gauge - gauge.mean()
+    diff = model - gauge
+    return {'n': int(len(diff)), 'bias': float(diff.mean()), 'rmse': float(np.sqrt(np.mean(diff**2))),
+            'correlation': float(np.corrcoef(model, gauge)[0, 1])}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Station time series from NEMO output, and comparison with gauges.')
+    parser.add_argument('files', nargs='*',
+                help='NEMO output files or glob patterns (XIOS chunks). None: use the store as it is')
+    parser.add_argument('--stations',
+                help='CSV of name,lat,lon')
+    parser.add_argument('--var', nargs='+', default=['zos'],
+                help='variables to extract, e.g. zos ssu ssv. The first sets the wet points')
+    parser.add_argument('--tlim', nargs=2, type=parse_time, metavar=('START', 'END'),
+                help='only files overlapping these dates, e.g. 1995-01-01 1996-01-01')
+    parser.add_argument('--store', default=STORE_DIR,
+                help='store directory')
+    parser.add_argument('--nworkers', type=int, default=1,
+                help='processes reading files')
+    parser.add_argument('--gauge', nargs=2, action='append', metavar=('STATION', 'CSV'), default=[],
+                help='compare a station with a gauge record (time,value CSV). Repeat for more')
+    parser.add_argument('--compare-var', default='zos',
+                help='stored variable compared with the gauges')
+    parser.add_argument('--demean', action='store_true',
+                help='remove the means before comparing (different datums)')
+    args = parser.parse_args()
+
+    files = []
+    for pattern in args.files:
+        files += expand_nemo_files(pattern, args.tlim or [])
+    if files:
+        if args.stations is None:
+            parser.error('--stations is needed to extract')
+        store = update_store(files, read_stations(args.stations), args.var, args.store, args.nworkers)
+    else:
+        store = StationStore(args.store)
+
+    for name, gauge_file in args.gauge:
+        times, values = store.series(name, args.compare_var)
+        result = compare(times, values, *read_gauge(gauge_file), demean=args.demean)
+        print("{}: n={n} bias={bias:.4f} rmse={rmse:.4f} r={correlation:.3f}".format(name, **result))
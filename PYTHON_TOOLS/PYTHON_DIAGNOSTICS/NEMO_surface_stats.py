@@ -0,0 +1,277 @@
+"""
+NEMO_surface_stats.py
+
+Temporal statistics (mean, variance, min, max, percentiles) of NEMO surface
+fields, in one pass over any number of output files.
+
+** Summary **
+The (time,y,x) fields are read a block of time records at a time (the depth
+dimension, if any, is reduced to the surface level). Per grid cell, each block
+updates:
+    count, mean, M2     combined with the running values by Chan et al.'s
+                        parallel form of Welford's algorithm
+    min, max
+    histogram           of --nbins bins, from which percentiles are
+                        interpolated (approximate: to within a bin width)
+Memory is O(ny*nx): a block of records plus nbins counts per cell, whatever
+the length of the record. Masked and NaN values (land) are left out.
+
+The histogram range is --range or, failing that, the valid_min/valid_max
+attributes of the variable: percentiles need one of them. Values outside it
+are counted in the edge bins (and reported: widen --range if there are many),
+and percentiles are kept within the exact min and max.
+
+The output has nav_lat, nav_lon and a single time_counter record (the middle
+of the period), and a (time_counter,y,x) field per variable and statistic,
+named <variable>_<statistic>, e.g. sea_surface_temperature_mean,
+sea_surface_temperature_p90. NEMO_surface_var_diag.py can draw these like any
+other output file (see the STATISTICS example in BLZ_config.py).
+
+** Useage**::
+python NEMO_surface_stats.py '/Belize_workshop/RUN_NEMO/EXP_demo/BLZE12_C1_1h_*_grid_T.nc' \
+    --var sea_surface_temperature --percentiles 10 50 90 --range 15 35 \
+    --tlim 1995-01-01 1995-02-01 --output BLZ_stats.nc
+"""
+
+#### Imports
+import os
+import time
+import argparse
+import numpy as np
+from netCDF4 import Dataset, date2num, num2date
+
+from NEMO_file_tools import expand_nemo_files, parse_time
+
+
+#### Constants
+BLOCK_BYTES = 256*2**20 # size of a block of time records, as float64
+NBINS = 100 # histogram bins per cell, for percentiles
+HIST_CHUNK = 2**20 # histogram counts updated at a time (cells x bins)
+
+
+#### Classes
+
+class RunningStats(object):
+    """
+    Per cell running statistics of a (time,y,x) field, updated a block at a time
+    """
+    def __init__(self, shape, nbins=NBINS, value_range=None):
+        """
+        shape - (ny,nx)
+        nbins - histogram bins per cell. 0: no histogram (and no percentiles)
+        value_range - (lo, hi) of the histogram, needed if nbins
+        """
+        if nbins and value_range is None:
+            raise ValueError('RunningStats: percentiles need a histogram range (--range LO HI)')
+        self.shape = tuple(shape)
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self.mean = np.zeros(self.shape)
+        self.M2 = np.zeros(self.shape)
+        self.min = np.full(self.shape, np.inf)
+        self.max = np.full(self.shape, -np.inf)
+        self.nbins = nbins
+        self.range = value_range
+        self.hist = None # (nbins, ny*nx) counts, allocated with the first block
+        self.clipped = 0 # values outside range, counted in the edge bins
+
+    def update(self, block):
+        """ Add a (nt,ny,nx) block. Masked and NaN values are left out """
+        block = np.ma.filled(np.ma.asarray(block, dtype=float), np.nan)
+        valid = np.isfinite(block)
+        n_b = valid.sum(axis=0)
+        if not n_b.any():
+            return
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_b = np.where(n_b > 0, np.nansum(block, axis=0) / n_b, 0.)
+            M2_b = np.nansum((block - mean_b)**2, axis=0)
+            n = self.count + n_b
+            delta = mean_b - self.mean
+            self.mean = np.where(n > 0, self.mean + delta * n_b / np.maximum(n, 1), 0.)
+            self.M2 = self.M2 + M2_b + delta**2 * self.count * n_b / np.maximum(n, 1)
+        self.count = n
+        self.min = np.fmin(self.min, np.nanmin(np.where(valid, block, np.inf), axis=0))
+        self.max = np.fmax(self.max, np.nanmax(np.where(valid, block, -np.inf), axis=0))
+        if self.nbins:
+            self._update_histogram(block, valid)
+
+    def _update_histogram(self, block, valid):
+        """ Count the valid values of block in the bins of each cell, HIST_CHUNK counts at a time """
+        ncell = self.count.size
+        if self.hist is None:
+            self.hist = np.zeros((self.nbins, ncell), dtype=np.uint32)
+        lo, hi = self.range
+        self.clipped += np.count_nonzero(valid & ((block < lo) | (block > hi)))
+        width = (hi - lo) / float(self.nbins)
+        block = block.reshape((-1, ncell))
+        valid = valid.reshape((-1, ncell))
+        step = max(1, HIST_CHUNK // self.nbins)
+        for c0 in range(0, ncell, step):
+            c1 = min(c0+step, ncell)
+            ok = valid[:, c0:c1]
+            ibin = np.clip(((block[:, c0:c1][ok] - lo) / width).astype(np.int64), 0, self.nbins-1)
+            icell = np.broadcast_to(np.arange(c1-c0), ok.shape)[ok]
+            counts = np.bincount(ibin*(c1-c0) + icell, minlength=self.nbins*(c1-c0))
+            np.add(self.hist[:, c0:c1], counts.reshape(self.nbins, c1-c0), out=self.hist[:, c0:c1], casting='unsafe')
+
+    def variance(self):
+        """ Sample variance (n-1), NaN where fewer than 2 values """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, self.M2 / (self.count - 1), np.nan)
+
+    def percentile(self, q):
+        """ Approximate q'th percentile (0-100) of each cell, NaN where there are no values """
+        if self.hist is None:
+            return np.full(self.shape, np.nan)
+        width = (self.range[1] - self.range[0]) / float(self.nbins)
+        cum = np.cumsum(self.hist, axis=0, dtype=np.int64)
+        target = q / 100. * self.count.ravel()
+        ibin = np.argmax(cum >= np.maximum(target, 1e-9), axis=0)
+        cells = np.arange(cum.shape[1])
+        below = np.where(ibin > 0, cum[ibin-1, cells], 0)
+        inbin = self.hist[ibin, cells].astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(inbin > 0, (target - below) / inbin, 0.)
+        value = (self.range[0] + (ibin + frac) * width).reshape(self.shape)
+        value = np.clip(value, self.min, self.max)
+        return np.where(self.count > 0, value, np.nan)
+
+    def result(self, percentiles=()):
+        """ Returns: {statistic name: (ny,nx) array}, NaN where there are no values """
+        empty = self.count == 0
+        out = {'mean': np.where(empty, np.nan, self.mean),
+               'var': self.variance(),
+               'min': np.where(empty, np.nan, self.min),
+               'max': np.where(empty, np.nan, self.max),
+               'count': self.count}
+        out['std'] = np.sqrt(out['var'])
+        for q in percentiles:
+            out['p{:g}'.format(q)] = self.percentile(q)
+        return out
+
+
+###################### FUNCTIONS ############################
+
+def surface_block(nc_var, t0, t1):
+    """ Records t0:t1 of a (time,y,x) or (time,depth,y,x) variable, at the surface """
+    if nc_var.ndim == 4:
+        return nc_var[t0:t1, 0, :, :]
+    return nc_var[t0:t1, :, :]
+
+def accumulate(files, variables, tlim=None, nbins=NBINS, value_range=None, block_bytes=BLOCK_BYTES):
+    """
+    Stream the variables of files (in time order) through RunningStats
+    tlim - [start, end] datetimes; records outside are skipped
+    Returns: {variable: RunningStats}, info (nav_lat, nav_lon, time units, calendar, first, last time, records)
+    """
+    stats = {}
+    info = {'records': 0, 'first': None, 'last': None}
+    for fname in files:
+        with Dataset(fname) as nc:
+            tvar = nc.variables['time_counter']
+            if 'units' not in info:
+                info['units'] = tvar.units
+                info['calendar'] = getattr(tvar, 'calendar', 'standard')
+                info['nav_lat'] = nc.variables['nav_lat'][:]
+                info['nav_lon'] = nc.variables['nav_lon'][:]
+            times = date2num(num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard')),
+                             info['units'], info['calendar'])
+            keep = np.ones(len(times), dtype=bool)
+            if tlim:
+                keep = ((times >= date2num(tlim[0], info['units'], info['calendar'])) &
+                        (times <= date2num(tlim[1], info['units'], info['calendar'])))
+            if not keep.any():
+                continue
+            i0, i1 = np.flatnonzero(keep)[[0, -1]]
+            info['first'] = times[i0] if info['first'] is None else min(info['first'], times[i0])
+            info['last'] = times[i1] if info['last'] is None else max(info['last'], times[i1])
+            info['records'] += i1 + 1 - i0
+
+            for var in variables:
+                nc_var = nc.variables[var]
+                shape = nc_var.shape[-2:]
+                if var not in stats:
+                    vrange = value_range
+                    if vrange is None and hasattr(nc_var, 'valid_min') and hasattr(nc_var, 'valid_max'):
+                        vrange = (float(nc_var.valid_min), float(nc_var.valid_max))
+                    stats[var] = RunningStats(shape, nbins, vrange)
+                nrec = max(1, int(block_bytes // (8 * shape[0] * shape[1])))
+                for t0 in range(i0, i1+1, nrec):
+                    stats[var].update(surface_block(nc_var, t0, min(t0+nrec, i1+1)))
+        print("accumulate: {} ({} records so far)".format(fname, info['records']))
+    for var, running in stats.items():
+        if running.clipped:
+            print("accumulate: {} values of {} outside the histogram range {} (percentiles near the edges are "
+                  "approximate: widen --range)".format(running.clipped, var, running.range))
+    return stats, info
+
+def write_stats(output, stats, info, percentiles=(), source=''):
+    """
+    Write the statistics as (time_counter,y,x) fields <variable>_<statistic>,
+    with nav_lat, nav_lon and one time_counter record at the middle of the period
+    """
+    with Dataset(output+'.tmp', 'w') as nc:
+        ny, nx = np.shape(info['nav_lat'])
+        nc.createDimension('time_counter', None)
+        nc.createDimension('y', ny)
+        nc.createDimension('x', nx)
+        nc.createDimension('axis_nbounds', 2)
+        for name in ['nav_lat', 'nav_lon']:
+            nc.createVariable(name, 'f4', ('y', 'x'))[:] = info[name]
+        tvar = nc.createVariable('time_counter', 'f8', ('time_counter',))
+        tvar.units = info['units']
+        tvar.calendar = info['calendar']
+        tvar.bounds = 'time_counter_bounds'
+        tvar[0] = 0.5 * (info['first'] + info['last'])
+        nc.createVariable('time_counter_bounds', 'f8', ('time_counter', 'axis_nbounds'))[0, :] = [info['first'], info['last']]
+
+        for var, running in stats.items():
+            for stat, value in running.result(percentiles).items():
+                if stat == 'count':
+                    out = nc.createVariable(var+'_'+stat, 'i4', ('time_counter', 'y', 'x'), zlib=True)
+                else:
+                    out = nc.createVariable(var+'_'+stat, 'f4', ('time_counter', 'y', 'x'), zlib=True,
+                                            fill_value=np.float32(1.e20))
+                    value = np.ma.masked_invalid(value)
+                out.long_name = '{} of {}'.format(stat, var)
+                out.cell_methods = 'time_counter: ' + {'mean': 'mean', 'var': 'variance', 'std': 'standard_deviation',
+                                        'min': 'minimum', 'max': 'maximum', 'count': 'sum'}.get(stat, 'percentile')
+                out[0, :, :] = value
+        nc.source = source
+        nc.time_coverage_start = str(num2date(info['first'], info['units'], info['calendar']))
+        nc.time_coverage_end = str(num2date(info['last'], info['units'], info['calendar']))
+        nc.records = info['records']
+    os.replace(output+'.tmp', output)
+    print("write_stats: statistics of {} records written to {}".format(info['records'], output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming temporal statistics of NEMO surface fields.')
+    parser.add_argument('files', nargs='+',
+                help='NEMO output files or glob patterns (XIOS chunks)')
+    parser.add_argument('--var', nargs='+', required=True,
+                help='variables, e.g. sea_surface_temperature sea_surface_salinity')
+    parser.add_argument('--tlim', nargs=2, type=parse_time, metavar=('START', 'END'),
+                help='time limits, e.g. 1995-01-01 1995-02-01')
+    parser.add_argument('--percentiles', nargs='*', type=float, default=[],
+                help='percentiles to estimate, e.g. 10 50 90')
+    parser.add_argument('--nbins', type=int, default=NBINS,
+                help='histogram bins per cell for the percentiles')
+    parser.add_argument('--range', nargs=2, type=float, metavar=('LO', 'HI'),
+                help='histogram range, needed with --percentiles unless the variables have valid_min/valid_max')
+    parser.add_argument('--output', default='NEMO_stats.nc',
+                help='output NetCDF file')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    files = []
+    for pattern in args.files:
+        files += expand_nemo_files(pattern, args.tlim or [])
+    try:
+        stats, info = accumulate(files, args.var, args.tlim, args.nbins if args.percentiles else 0, args.range)
+    except ValueError as err:
+        parser.error(str(err))
+    if info['records'] == 0:
+        print("NEMO_surface_stats: no records in {}".format(args.files))
+    else:
+        write_stats(args.output, stats, info, args.percentiles, ' '.join(files))
+        print("NEMO_surface_stats: {:.1f}s".format(time.time()-t0))
@@ -12,7 +12,6 @@ pcolor / quiver data as static frame or animation, as requested by commandline i
 jp: 16 July 2019
 
 ** To-do **:
-* multiple file loading (NCML vs xarray): xr.open_mfdataset('my/files/*.nc')
 * Add a mask variable to initial grid data set up
 * Create new diagnostics: e.g. difference between SST model fields
 
@@ -28,33 +27,94 @@ jp: 16 July 2019
 * 19 July 2019: xarray can load partial datasets
 * 22 July 2019: Subset data over time, using parameter file
 * 23 July 2019: Collapse z dim to surface value if 3d
+* 18 Oct 2026: Open each file once (DATASETS registry) and batch the variable reads
+* 18 Oct 2026: grid_data/input_data keys may be glob patterns over XIOS chunks
+* 18 Oct 2026: Save the DataBucket to a compressed NetCDF cache, lazily reloaded
+* 18 Oct 2026: Render animation frames on params.nworkers processes
+* 18 Oct 2026: FrameRenderer draws the map once and updates only the data per frame
+* 18 Oct 2026: Stream frames from the canvas to the GIF/MP4 writer. No PNG round trip
+* 18 Oct 2026: Subregion corners from a cached KD-tree GridIndex (NEMO_grid_tools)
+* 18 Oct 2026: Keep time as datetime64. tlim bounds found by np.searchsorted
+* 18 Oct 2026: Headless --batch and --jobs modes with exit status and timing report
+* 18 Oct 2026: params.fields renders several fields (e.g. sst, sss, speed) in one pass
+* 18 Oct 2026: params.lazy (--lazy) keeps (time,y,x) fields as dask arrays, read per frame
+* 18 Oct 2026: dask chunks follow the NetCDF4 chunks. Surface level by isel. Report bytes read
+* 18 Oct 2026: Follow mode (pf, qf, --follow) renders new time records as the run writes them
+* 18 Oct 2026: params.draw_features=False skips the Natural Earth layers (offline, NEMO_benchmark.py)
+* 18 Oct 2026: Opt-in stage timing, trace and per command profiling (--trace, NEMO_diag_timing)
+* 18 Oct 2026: Natural Earth layers clipped to the domain once and cached (NEMO_basemap)
+* 18 Oct 2026: Streaming temporal statistics files (NEMO_surface_stats.py) are drawn like model output
+* 18 Oct 2026: Tidal harmonics (NEMO_tidal_analysis.py). Unrecognised variables keep their own name
+* 18 Oct 2026: Station time series in a point-major store, compared with gauges (NEMO_station_extract.py)
+* 18 Oct 2026: params.domain_cfg: ssu, ssv averaged onto T points and rotated east/north for speed and quiver (NEMO_cgrid)
+* 18 Oct 2026: Derived fields (speed, ke, vorticity, divergence) by plot_var name, LRU cached (NEMO_derived_fields)
 
 ** Useage**::
 python NEMO_surface_var_diag.py ORCA0083_SEAsia
 or
 ipython$ %run NEMO_surface_var_diag SEAsia
   where SEAsia_config.py is an associated config file.
+
+Without prompting (e.g. under cron or SLURM), run actions then save and exit:
+python NEMO_surface_var_diag.py BLZ --batch a pa qa --field temperature salinity speed --workers 4 \
+    --tlim 1995-01-01 1995-01-05 --report BLZ_timing.json
+Add --lazy to read the (time,y,x) fields a frame at a time. Memory then does
+not grow with the length of the run.
+or run the jobs listed in a json job file, 4 processes at a time:
+python NEMO_surface_var_diag.py --jobs jobs.json --parallel 4
+  where jobs.json is e.g. [{"config": "BLZ", "actions": ["a", "pa"], "field": ["temperature"]}]
+While NEMO is running, follow its output. New frames are added to the animation
+as the files are written. Stops after 30 polls with no new records, or Ctrl-C:
+python NEMO_surface_var_diag.py BLZ --follow qf --interval 60 --max-idle 30
+Trace the time, CPU, bytes read (and memory) of each stage and frame, and
+profile the pa command with cProfile (or --profile-mode sample):
+python NEMO_surface_var_diag.py BLZ --batch a pa --trace BLZ_trace.json --trace-memory --profile pa
 """
 
 #### Imports
 import os
+# The files are only read. Do not take HDF5 file locks, which would stop XIOS
+# writing output that is being followed. Must be set before the first file is opened
+os.environ.setdefault('HDF5_USE_FILE_LOCKING', 'FALSE')
 import sys # argv passing
+import argparse # command line options
+import time
+import subprocess
+import traceback
+import shutil
+import tempfile
+import importlib
+import multiprocessing # parallel frame rendering
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import datetime
-#from netCDF4 import Dataset # switch *xarr* functions for *nc4* fns
+from netCDF4 import Dataset # switch *xarr* functions for *nc4* fns. Chunk layout
 import xarray as xr
+import dask # batched computation of lazy xarray selections
+import dask.array as da # out-of-core (time,y,x) fields
 import matplotlib.pyplot as plt
 
-import pickle
+import json # cache metadata
 from platform import python_version # to test python version
 import cartopy.crs as ccrs # mapping plots
-import cartopy.feature # add rivers, regional boundaries etc
 from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER # deg symb
 
 import imageio # Image conversion to animated gif
+from NEMO_anim_writer import AnimationWriter, Blitter # stream frames to gif / mp4
+from NEMO_grid_tools import get_grid_index # nearest grid point lookup
+from NEMO_file_tools import expand_nemo_files, parse_time # XIOS chunks within tlim
+from NEMO_diag_timing import TRACE # opt-in stage timing and profiling
+from NEMO_basemap import add_base_map # cached Natural Earth layers
+from NEMO_cgrid import get_staggered_grid # U, V onto T points
+from NEMO_derived_fields import DERIVED_FIELDS, FrameCache, inputs_of # speed, vorticity, ...
+
 
 
 
+#### Constants
+FRAMES_PER_JOB = 4 # animation frames rendered per parallel job
+DASK_CHUNK_BYTES = 64*2**20 # disk chunks are grouped into dask chunks of up to this size
+_worker_renderer = None # FrameRenderer of a pcolor pool process
 
 #### Classes
 
@@ -63,26 +123,35 @@ class Controller(object):
     This is where the main things happen.
     Where user input is managed and methods are launched
     """
-    def __init__(self):
+    def __init__(self, interactive=True):
         """
         Initialise main controller. Look for file. If exists load it
+        interactive - start the user input loop
         """
         print("Aim: Load netCDF4 data and plot it using class structure.")
+        self.held = [] # files kept open for lazy fields
         self.data_bucket = self.load()
-        self.run_interface()
+        if interactive:
+            self.run_interface()
 
     def load(self):
         """
-        Load pickle file from the standard file save
+        Load the DataBucket from the standard NetCDF cache file.
+        The (time,y,x) fields are left on disk and read a frame at a time.
+        The cache is ignored if the source files, or limits, have changed.
         """
         data_bucket = DataBucket()
-        print("Auto loads from pickle file if it exists.")
+        print("Auto loads from cache file if it exists.")
         try:
             if os.path.exists(SAVE_FILE_NAME):
                 template = "...Loading (%s)"
                 print(template%SAVE_FILE_NAME)
-                with open(SAVE_FILE_NAME, 'rb') as file_object:
-                    data_bucket = pickle.load(file_object)
+                DS = xr.open_dataset(SAVE_FILE_NAME)
+                if DS.attrs.get('sources') != json.dumps(source_signature()):
+                    print("... %s is out of date. Ignoring it"%SAVE_FILE_NAME)
+                    DS.close()
+                else:
+                    data_bucket.from_dataset(DS)
             else:
                 print("... %s does not exist"%SAVE_FILE_NAME)
         except KeyError:
@@ -109,44 +178,235 @@ class Controller(object):
             if command == "q":
                 print("run_interface: Saving DataBucket instance")
                 save(self.data_bucket) # Function call.
+                self.release_files()
                 print("run_interface: Exiting the application")
                 break
-            elif command == "i":
-                print(INSTRUCTIONS)
-            elif command == "a":
-                print('run_interface: First define geographic subregion')
-                for key,variable_lst in params.grid_data.items():
-                    for var in variable_lst:
-                        self.data_bucket.define_slice( NemoDataElement(key, var) )
-
-                print('run_interface: Second add (subdomain) data to bucket')
-                for key,variable_lst in params.input_data.items():
-                    for var in variable_lst:
-                        self.data_bucket.add_data( NemoDataElement(key, var, limits=self.data_bucket.limits) )
-                        print("run_interface: From {}, read in {}".format(key,var))
-                        #self.data_bucket.add_data( NemoDataElement(filname,'sea_surface_temperature') )
-
-            elif command == "s":
-                print('run_interface: Show bucket contents')
-                self.data_bucket.show()
-            elif command == "pcolor":
-                print('run_interface: pcolormesh bucket contents')
-                self.data_bucket.pcolor(anim_flag=False, quiver_flag=False)
-            elif command == "quiver":
-                print('run_interface: pcolormesh+quiver bucket contents')
-                self.data_bucket.pcolor(anim_flag=False, quiver_flag=True)
-                #self.data_bucket.pcolor_quiver(anim_flag=False)
-
-            elif command == "pa":
-                print('run_interface: animate pcolormesh bucket contents to file')
-                self.data_bucket.pcolor(anim_flag=True, quiver_flag=False)
-            elif command == "qa":
-                print('run_interface: animate pcolormesh+quiver bucket contents to file')
-                self.data_bucket.pcolor(anim_flag=True, quiver_flag=True)
+            else:
+                try:
+                    self.run_command(command)
+                except ValueError as err: # e.g. no times within tlim
+                    print(err)
+
 
+    def run_command(self, command):
+        """
+        Respond to one command, timed (and profiled) when tracing is on
+        Returns: False if the command is not recognised
+        """
+        with TRACE.stage('command', command=command), TRACE.profile(command):
+            return self._run_command(command)
+
+    def _run_command(self, command):
+        """
+        Respond to one command
+        Returns: False if the command is not recognised
+        """
+        if command == "i":
+            print(INSTRUCTIONS)
+        elif command == "a":
+            # Hold a handle on every file for the whole load, so that files
+            # listed in both grid_data and input_data are opened only once.
+            # In lazy mode they stay open until the fields are saved.
+            lazy = getattr(params, 'lazy', False)
+            DATASETS.tlim = params.tlim
+            DATASETS.lazy = lazy
+            held = []
+            for key in list(params.grid_data.keys()) + list(params.input_data.keys()):
+                try:
+                    DATASETS.acquire(key)
+                    held.append(key)
+                except (IOError, RuntimeError):
+                    print('run_interface: Cannot open the file '+key)
+
+            print('run_interface: First define geographic subregion')
+            for key,variable_lst in params.grid_data.items():
+                for element in load_nemo_elements(key, variable_lst):
+                    with TRACE.stage('define_slice', var=element.var_name):
+                        self.data_bucket.define_slice( element )
+
+            print('run_interface: Second add (subdomain) data to bucket')
+            for key,variable_lst in params.input_data.items():
+                for element in load_nemo_elements(key, variable_lst, limits=self.data_bucket.limits, lazy=lazy):
+                    self.data_bucket.add_data( element )
+                    print("run_interface: From {}, read in {}".format(key,element.var_name))
+
+            self.release_files()
+            if lazy:
+                self.held = held
             else:
-                template = "run_interface: I don't recognise (%s)"
-                print(template%command)
+                for key in held:
+                    DATASETS.release(key)
+
+        elif command == "s":
+            print('run_interface: Show bucket contents')
+            self.data_bucket.show()
+        elif command == "pcolor":
+            print('run_interface: pcolormesh bucket contents')
+            self.data_bucket.pcolor(anim_flag=False, quiver_flag=False)
+        elif command == "quiver":
+            print('run_interface: pcolormesh+quiver bucket contents')
+            self.data_bucket.pcolor(anim_flag=False, quiver_flag=True)
+            #self.data_bucket.pcolor_quiver(anim_flag=False)
+
+        elif command == "pa":
+            print('run_interface: animate pcolormesh bucket contents to file')
+            self.data_bucket.pcolor(anim_flag=True, quiver_flag=False)
+        elif command == "qa":
+            print('run_interface: animate pcolormesh+quiver bucket contents to file')
+            self.data_bucket.pcolor(anim_flag=True, quiver_flag=True)
+        elif command == "pf":
+            print('run_interface: animate pcolormesh to file, following new output')
+            self.follow(quiver_flag=False)
+        elif command == "qf":
+            print('run_interface: animate pcolormesh+quiver to file, following new output')
+            self.follow(quiver_flag=True)
+
+        else:
+            template = "run_interface: I don't recognise (%s)"
+            print(template%command)
+            return False
+        return True
+
+    def follow(self, quiver_flag=False, interval=None, max_idle=None):
+        """
+        Animate the bucket, then keep the animation files open and poll the
+        input_data files every interval seconds (params.follow_interval).
+        New chunk files, or new records in a file, are read (only the records
+        after the last time in the bucket), appended to the bucket and drawn
+        as new frames. Stops after max_idle polls (params.follow_max_idle)
+        without new records, or on Ctrl-C.
+        """
+        if interval is None:
+            interval = getattr(params, 'follow_interval', 60)
+        if max_idle is None:
+            max_idle = getattr(params, 'follow_max_idle', None)
+        if 'datetime' not in self.data_bucket.vars:
+            print('follow: load the data first (a)')
+            return
+
+        specs = field_products()
+        writers = [ AnimationWriter(animation_file_name(quiver_flag, spec), fps=10, live=True)
+                    for spec in specs ]
+        renderer = FrameRenderer(self.data_bucket, quiver_flag, specs=specs)
+        signatures = {}
+        nframes = 0
+        idle = 0
+        try:
+            while True:
+                new_frames = self.data_bucket.nframes(specs[0]['plot_var'])
+                for count in range(nframes, new_frames):
+                    for writer, rgb in zip(writers, renderer.grab(count, new_frames)):
+                        writer.append_frame(rgb)
+                nframes = new_frames
+
+                if max_idle is not None and idle >= max_idle:
+                    print('follow: nothing new after {} polls. Stopping'.format(idle))
+                    break
+                time.sleep(interval)
+
+                changed = []
+                for key in params.input_data.keys():
+                    signature = file_signatures(key)
+                    if signature != signatures.get(key):
+                        signatures[key] = signature
+                        changed.append(key)
+                nrecords = 0
+                if changed:
+                    try:
+                        for key in changed:
+                            DATASETS.refresh(key)
+                        nrecords = self.load_new_records()
+                    except (IOError, RuntimeError, OSError, ValueError) as err:
+                        print('follow: cannot read new output yet ({}). Retry next poll'.format(err))
+                idle = 0 if nrecords > 0 else idle + 1
+        except KeyboardInterrupt:
+            print('follow: interrupted')
+        finally:
+            renderer.close()
+            for writer in writers:
+                writer.close()
+
+    def load_new_records(self):
+        """
+        Read the input_data time records after the last time in the bucket
+        (and within tlim) and append them. Only the records present in every
+        file are added, the others are picked up by a later call.
+        Returns: number of records added
+        """
+        limits = dict(self.data_bucket.limits)
+        start = np.datetime64(self.data_bucket.vars['datetime'][-1]) + np.timedelta64(1,'ns')
+        stop = np.datetime64(params.tlim[1]) if params.tlim != [] else None
+        limits['itime'] = [start, stop]
+
+        DATASETS.tlim = params.tlim
+        new_vars = {}
+        for key,variable_lst in params.input_data.items():
+            for element in load_nemo_elements(key, variable_lst, limits=limits,
+                                              lazy=getattr(params, 'lazy', False)):
+                if element.std_name == 'datetime' or np.ndim(element.data) == 3:
+                    new_vars.setdefault(element.std_name, element.data)
+        if 'datetime' not in new_vars:
+            return 0
+
+        nrecords = min(len(arr) for arr in new_vars.values())
+        if nrecords > 0:
+            self.data_bucket.append_data({ key: arr[:nrecords] for key, arr in new_vars.items() })
+            print('load_new_records: {} new records, to {}'.format(nrecords,
+                        format_datetime64(new_vars['datetime'][nrecords-1], '%d %b %Y %H:%M')))
+        return nrecords
+
+    def release_files(self):
+        """ Close the files held open for lazy fields """
+        for key in self.held:
+            DATASETS.release(key)
+        self.held = []
+
+    def run_batch(self, actions, fields=None, report_file=None):
+        """
+        Run a list of commands without prompting, then save and return.
+        The plotting commands render every field in fields (default params.fields)
+        in the same pass. Stops at the first command that fails.
+        A timing report is written as json to report_file.
+        Returns: exit status. 0 if every command succeeded
+        """
+        if fields is not None:
+            select_field(fields[0])
+            params.fields = list(fields)
+        fields = getattr(params, 'fields', [params.field])
+        status = 0
+        timings = []
+        start = time.time()
+        for command in actions:
+            if command == 'q':
+                continue
+            t0 = time.time()
+            error = None
+            try:
+                if not self.run_command(command):
+                    error = "unknown command"
+            except Exception as err:
+                traceback.print_exc()
+                error = repr(err)
+            timings.append({'command': command, 'fields': fields,
+                            'seconds': time.time()-t0, 'error': error})
+            if error is not None:
+                status = 1
+                break
+
+        if status == 0:
+            save(self.data_bucket)
+        self.release_files()
+        report = {'config': config, 'status': status, 'seconds': time.time()-start,
+                  'commands': timings}
+        if report_file is not None:
+            with open(report_file, 'w') as file_object:
+                json.dump(report, file_object, indent=1)
+            print("run_batch: timing report written to {}".format(report_file))
+        for item in timings:
+            print("run_batch: {:>8s} {:>24s} {:8.2f}s {}".format(item['command'], ' '.join(item['fields']),
+                        item['seconds'], item['error'] or 'ok'))
+        print("run_batch: total {:.2f}s, status {}".format(report['seconds'], status))
+        return status
 
 
 
@@ -160,6 +420,9 @@ class DataBucket(object):
         """ set variable (and grid) attributes to empty """
         self.vars = {} # empty dictionary
         self.limits = {} # Need to define the x,y subdomain as indices for subselecting patent data.
+        self.modified = False # True if the contents differ from the cache file
+        self.collocated = False # True if ssu, ssv are already east, north on T points (pcolor workers)
+        self.derived_cache = FrameCache(getattr(params, 'derived_cache_bytes', 256*2**20)) # derived field slices
 
     def define_slice(self, new_data):
         """
@@ -170,8 +433,10 @@ class DataBucket(object):
         Though for data with depth information only the surface field is extracted.
         """
         print("define_slice: updating limits var: std_name {}".format( new_data.std_name  ))
+        self.modified = True
         #print("define_slice: updating limits var: data {}".format( new_data.data  ))
         self.limits.update({ new_data.std_name : new_data.data[:] })
+        self.derived_cache.clear() # derived frames of the old subdomain
 
         #if len( self.limits.keys() ) == 2:
         if "lat" in self.limits.keys() and "lon" in self.limits.keys():
@@ -184,10 +449,11 @@ class DataBucket(object):
                 self.limits.update({ 'ilat': None, 'ilon': None } )
             else:
                 #print( "limits.keys()".format( self.limits.keys() ))
-                [J00,I00] = findJI(params.ylim[0], params.xlim[0], self.limits['lat'], self.limits['lon'])
-                [J01,I01] = findJI(params.ylim[0], params.xlim[1], self.limits['lat'], self.limits['lon'])
-                [J11,I11] = findJI(params.ylim[1], params.xlim[1], self.limits['lat'], self.limits['lon'])
-                [J10,I10] = findJI(params.ylim[1], params.xlim[0], self.limits['lat'], self.limits['lon'])
+                # Corners (00, 01, 11, 10) found in one query of the grid's index
+                index = get_grid_index(self.limits['lat'], self.limits['lon'])
+                [J00,J01,J11,J10],[I00,I01,I11,I10] = index.query(
+                                [params.ylim[0], params.ylim[0], params.ylim[1], params.ylim[1]],
+                                [params.xlim[0], params.xlim[1], params.xlim[1], params.xlim[0]] )
                 J0 = min(J00,J01)
                 J1 = max(J11,J10)
                 I0 = min(I00,I10)
@@ -207,11 +473,16 @@ class DataBucket(object):
                     datetime.datetime not type {}'.format(type(params.tlim[0]) ))
                     print('E.g. tlim=[datetime.datetime(1966, 12, 26, 12, 0), datetime.datetime(1966, 12, 27, 12, 0)]')
                 #self.limits.update({ 'itime': None })
-                #print("defin_slice: self.limits['datetime'] {}".format(self.limits['datetime']))
-                [_,T0] = nearest( [dd for dd in self.limits['datetime']], params.tlim[0] )
-                [_,T1] = nearest( [dd for dd in self.limits['datetime']], params.tlim[1] )
+                # First and last times within tlim, by binary search of the (sorted) datetime64 array
+                times = np.asarray(self.limits['datetime'])
+                T0 = np.searchsorted(times, np.datetime64(params.tlim[0]), side='left')
+                T1 = np.searchsorted(times, np.datetime64(params.tlim[1]), side='right') - 1
+                if T1 < T0:
+                    raise ValueError('define_slice: no times within tlim {} (the files cover {} to {})'.format(
+                                        params.tlim, times[0], times[-1]) if len(times) else
+                                     'define_slice: no times in the files')
                 #print("define_slice: limits {}".format(self.limits))
-                self.limits.update({ 'itime': [T0,T1] } )
+                self.limits.update({ 'itime': [times[T0],times[T1]] } )
             self.limits.pop("datetime") # remove datetime key
         #elif len( self.limits.keys() ) > 2:
         #    print("Didn't expect this many keys {}".format(self.limits.keys() ))
@@ -227,9 +498,123 @@ class DataBucket(object):
         The new_data should be an instance of the DataEntry class.
         The data elements are stored in a dictionary with the key being a standard
         string for the associated variable. See function "convert_modelvarname_to_stdvarname"
+        Lazy (dask) fields are stored unread, with NaN where masked.
         """
         print("add_data: import {} as {}".format(new_data.var_name,new_data.std_name))
         self.vars.update({ new_data.std_name : new_data.data[:] })
+        self.derived_cache.clear() # derived frames of the old data
+        self.modified = True
+
+    def append_data(self, new_vars):
+        """
+        Append time records to the (time,y,x) fields and datetime.
+        new_vars - {std_name: array}, each with the same number of records
+        Lazy fields stay lazy.
+        """
+        for key, arr in new_vars.items():
+            old = self.vars[key]
+            if isinstance(old, xr.DataArray): # on the cache file
+                old = old.chunk({old.dims[0]: 1}).data
+            if key == 'datetime':
+                self.vars[key] = np.concatenate([old, arr])
+            elif isinstance(old, da.Array) or isinstance(arr, da.Array):
+                self.vars[key] = da.concatenate([da.asarray(old), da.asarray(arr)])
+            else:
+                self.vars[key] = np.ma.concatenate([as_masked(old), as_masked(arr)])
+        self.modified = True
+
+    def get_frame(self, key, icount):
+        """
+        Return time slice icount of vars[key] as a masked array.
+        Only that slice is read if the variable is still on disk.
+        Keys in DERIVED_FIELDS (e.g. speed, vorticity) are computed from their variables.
+        """
+        if key not in self.vars and key in DERIVED_FIELDS:
+            return self.derived_frame(key, icount)
+        return as_masked(self.vars[key][icount,:,:])
+
+    def derived_frame(self, key, icount):
+        """
+        Time slice icount of the derived field key, evaluated on the C-grid of
+        params.domain_cfg (if set). Kept in the bucket's LRU derived_cache
+        """
+        frame = self.derived_cache.get((key, icount))
+        if frame is None:
+            field = DERIVED_FIELDS[key]
+            grid = None if self.collocated else staggered_grid(self.limits)
+            with TRACE.stage('derived', field=key, frame=icount):
+                frame = field.evaluate([self.get_frame(name, icount) for name in field.needs], grid)
+            self.derived_cache.put((key, icount), frame)
+        return frame
+
+    def velocity_frame(self, icount):
+        """
+        ssu, ssv at time index icount. With params.domain_cfg they are averaged
+        from the U and V points onto the T points and rotated to east, north
+        """
+        U = self.get_frame('ssu', icount)
+        V = self.get_frame('ssv', icount)
+        grid = None if self.collocated else staggered_grid(self.limits)
+        if grid is not None:
+            with TRACE.stage('collocate', frame=icount):
+                U, V = grid.velocity_to_t(U, V)
+        return U, V
+
+    def nframes(self, key):
+        """ Length of the time dimension of vars[key] (or of the first variable it is derived from) """
+        if key not in self.vars and key in DERIVED_FIELDS:
+            key = inputs_of(key)[0]
+        return np.shape(self.vars[key])[0]
+
+    def to_dataset(self):
+        """
+        Pack the bucket into an xarray Dataset for the cache file.
+        Masked values are stored as NaN. Limits are kept as a json attribute.
+        """
+        data_vars = {}
+        sizes = {}
+        for key, arr in self.vars.items():
+            if key == 'datetime':
+                data_vars[key] = (('t',), np.array(arr, dtype='datetime64[ns]'))
+                continue
+            dims = ('t','y','x')[-np.ndim(arr):]
+            if any(sizes.get(dim, size) != size for dim, size in zip(dims, np.shape(arr))):
+                dims = tuple(dim+'_'+key for dim in dims) # does not share the grid
+            sizes.update(dict(zip(dims, np.shape(arr))))
+            if isinstance(arr, da.Array): # written a chunk at a time
+                data_vars[key] = (dims, arr.astype(float))
+            else:
+                data_vars[key] = (dims, np.ma.filled(as_masked(arr).astype(float), np.nan))
+
+        limits = {}
+        for key, val in self.limits.items():
+            if val is None:
+                limits[key] = None
+            elif isinstance(val[0], np.datetime64):
+                limits[key] = [str(dd) for dd in val]
+            else:
+                limits[key] = [int(ii) for ii in val]
+        return xr.Dataset(data_vars, attrs={'limits': json.dumps(limits)})
+
+    def from_dataset(self, DS):
+        """
+        Unpack a cache Dataset. Grid variables are read now, (time,y,x)
+        fields are left as lazy DataArrays on the open file.
+        """
+        self.derived_cache.clear()
+        for key in DS.data_vars:
+            if key == 'datetime':
+                self.vars[key] = DS[key].values
+            elif DS[key].ndim < 3:
+                self.vars[key] = as_masked(DS[key].values)
+            else:
+                self.vars[key] = DS[key]
+
+        for key, val in json.loads(DS.attrs['limits']).items():
+            if val is not None and type(val[0]) == str:
+                val = [np.datetime64(dd) for dd in val]
+            self.limits[key] = val
+        self.modified = False
 
     def show(self):
         """ Show the data bucket contents """
@@ -241,12 +626,15 @@ class DataBucket(object):
         return None
 
 
-    def _ccrs_pcolor(self, fig, ax, icount):
+    def _ccrs_pcolor(self, fig, ax, icount, spec=None):
         """
         pcolormesh elements that get reused
         icount - time dimension index
-        Returns: ax,X,Y,Z
+        spec - field specification (plot_var, cmap, levs). Default: the first of field_products()
+        Returns: ax,X,Y,cset,cbar
         """
+        if spec is None:
+            spec = field_products()[0]
         #icount = 1
         #lab = self.variable + ' at time step:'+str(icount)
         xlim = set_plot_lim(params.xlim, self.vars['lon'])
@@ -258,25 +646,28 @@ class DataBucket(object):
         # replace former nan locations in x,y coords
         #X[self.vars['lon'].mask] = np.mean(xlim)
         #Y[self.vars['lat'].mask] = np.mean(ylim)
-        Z = self.vars[params.plot_var][icount,:,:]
+        Z = self.get_frame(spec['plot_var'], icount)
 
         ax = plt.subplot(1,1,1, projection=ccrs.PlateCarree())
         ax.set_xlim(xlim)
         ax.set_ylim(ylim)
 
-        cset = ax.pcolormesh( X, Y, Z, transform=ccrs.PlateCarree(), cmap=params.cmap )
+        cset = ax.pcolormesh( X, Y, Z, transform=ccrs.PlateCarree(), cmap=spec['cmap'] )
 
-        cset.set_clim([params.levs[0],params.levs[-1]])
+        cset.set_clim([spec['levs'][0],spec['levs'][-1]])
 
         # Add nice CARTOPY features
         #cartopy.feature.COLORS = {'water': np.array([ 0.59375 , 0.71484375, 0.8828125 ]), \
         #     'LAND': np.array([ 0.9375 , 0.9375 , 0.859375]), \
         #     'land_alt1': np.array([ 0.859375, 0.859375, 0.859375])}
 
-        ax.add_feature(cartopy.feature.OCEAN)
-        ax.add_feature(cartopy.feature.LAND)
-        ax.add_feature(cartopy.feature.BORDERS, linestyle=':')
-        ax.add_feature(cartopy.feature.RIVERS)
+        if getattr(params, 'draw_features', True): # Natural Earth layers, clipped once and cached
+            with TRACE.stage('features'):
+                add_base_map(ax, xlim, ylim,
+                             layers=getattr(params, 'basemap_layers', None),
+                             resolution=getattr(params, 'basemap_resolution', None),
+                             cache_dir=getattr(params, 'basemap_cache_dir', None),
+                             natural_earth_dir=getattr(params, 'natural_earth_dir', None))
 
         #ax.coastlines()
         #ax.gridlines(draw_labels=True)
@@ -295,11 +686,11 @@ class DataBucket(object):
 
         #ax.hold(True)
 
-        plt.colorbar(cset, shrink=params.colorbar_shrink, pad=.05) # Add colorbar
+        cbar = plt.colorbar(cset, shrink=params.colorbar_shrink, pad=.05) # Add colorbar
         #plt.colorbar(wspd_contours, ax=ax, orientation="horizontal", pad=.05)
 
         #plt.title(lab)
-        return ax,X,Y,Z
+        return ax,X,Y,cset,cbar
 
     def _pcolor(self, fig, ax, icount):
         """
@@ -319,7 +710,7 @@ class DataBucket(object):
         #X[self.vars['lon'].mask] = np.mean(xlim)
         #Y[self.vars['lat'].mask] = np.mean(ylim)
 
-        Z = self.vars[params.plot_var][icount,:,:]
+        Z = self.get_frame(params.plot_var, icount)
 
         cset = ax.pcolormesh( X, Y, Z, cmap=params.cmap )
 
@@ -336,80 +727,307 @@ class DataBucket(object):
         #plt.title(lab)
         return ax,X,Y,Z
 
-    def pcolor(self, anim_flag=True, quiver_flag=True):
+    def pcolor(self, anim_flag=True, quiver_flag=True, max_frames=None):
         """
         pcolormesh the data bucket
         Optionally add quiver ticks
-        Optionally animate
+        Optionally animate. Animation frames are shared between params.nworkers
+        processes if more than one is requested.
+        Every field in params.fields is drawn, one output file each, in a single
+        pass over time that shares the data, subset and map.
+        max_frames - animate only the first max_frames time indices (default all)
         """
+        specs = field_products()
 
         if anim_flag == True:
-            nframes = np.shape(self.vars[params.plot_var])[0]
+            nframes = self.nframes(specs[0]['plot_var'])
+            if max_frames is not None:
+                nframes = min(nframes, max_frames)
         else:
             nframes = 1
-        
-        files = [] # store images from saving to file
-
-        ## Time timeseries of frames
-        for count in range(0,nframes):
-            print('frame progress: {} / {}'.format(count,nframes-1))
-
-            plt.close('all')
-            fig = plt.figure(figsize=(10,10))
-            ax = fig.gca()
-
-            if quiver_flag == False:
-                ax,_,_,_ = self._ccrs_pcolor(fig,ax,count)
-            elif quiver_flag == True:
-                ax,X,Y,Z = self._ccrs_pcolor(fig,ax,count)
-                spacing = int( np.shape(X)[1] // params.nx_quiv ) # quiver point spacing
-                #spacing = params.spacing # quiver point spacing
-                U = self.vars['ssu'][count,:,:]
-                V = self.vars['ssv'][count,:,:]
-
-                speed = np.sqrt(U**2+V**2)
 
-                U = np.ma.masked_where( speed < params.speed_min, U)
-                V = np.ma.masked_where( speed < params.speed_min, V)
+        nworkers = getattr(params, 'nworkers', 1)
 
-                qset = ax.quiver( X[::spacing,::spacing],
-                            Y[::spacing,::spacing],
-                            U[::spacing,::spacing],
-                            V[::spacing,::spacing],
-                               units='xy', scale_units='width',scale=40)
+        if anim_flag == True:
+            # Stream the frames into one animated gif (or mp4) per field
+            writers = [ AnimationWriter(animation_file_name(quiver_flag, spec), fps=10)
+                        for spec in specs ]
 
+            ## Time timeseries of frames
+            if nworkers > 1 and nframes > 1:
+                self._pcolor_parallel(nframes, quiver_flag, nworkers, writers, specs)
             else:
-                break
+                renderer = FrameRenderer(self, quiver_flag, specs=specs)
+                for count in range(0,nframes):
+                    for writer, rgb in zip(writers, renderer.grab(count, nframes)):
+                        with TRACE.stage('encode', frame=count):
+                            writer.append_frame(rgb)
+                renderer.close()
+            with TRACE.stage('encode_close'):
+                for writer in writers:
+                    writer.close()
 
-            dat = datetime.datetime.strftime(self.vars['datetime'][count], '%d %b %Y') #: %H:%M')
-            plt.title(config+': '+params.field+' ('+params.units+'): '+str(dat))
+        else:
+            renderer = FrameRenderer(self, quiver_flag, specs=specs)
+            renderer.render(0, nframes)
+            renderer.close()
 
+        return None
 
-            #if(anim_flag):
-            if(1): # Always save file. Can not display from within docker container
-                fname = params.ofile.replace('TEMPLATE',config). \
-                                replace('.gif','_'+str(count).zfill(4)+'.png')
-                plt.savefig(fname, dpi=100)
-                files.append(fname)
+    def _pcolor_parallel(self, nframes, quiver_flag, nworkers, writers, specs):
+        """
+        Render frames on a pool of nworkers processes, one FrameRenderer each.
+        The plotted fields (derived ones evaluated here) are written once to
+        memory-mapped .npy files, so each worker only reads the time slices it draws. Frames are rendered in
+        blocks, one wave of nworkers blocks at a time, and appended to writers
+        (one per spec) in index order. Memory is bounded by the size of a wave.
+        """
+        keys = []
+        for spec in specs:
+            keys.append(spec['plot_var'])
+        if quiver_flag:
+            keys += ['ssu', 'ssv']
+        keys = sorted(set(keys))
+
+        tmpdir = tempfile.mkdtemp(prefix='frames_', dir=os.path.dirname(os.path.abspath(specs[0]['ofile'])))
+        try:
+            shared = {}
+            for key in keys:
+                shared[key] = os.path.join(tmpdir, key+'.npy')
+                arr = np.lib.format.open_memmap(shared[key], mode='w+', dtype=np.float32,
+                                                shape=(nframes,)+np.shape(self.vars['lon']))
+                for count in range(nframes): # one slice at a time keeps lazy fields lazy
+                    if key in ['ssu', 'ssv']: # shared on T points
+                        frame = self.velocity_frame(count)[['ssu', 'ssv'].index(key)]
+                    else:
+                        frame = self.get_frame(key, count)
+                    arr[count] = np.ma.filled(frame.astype(np.float32), np.nan)
+                arr.flush()
+                del arr
+
+            grid = { key: self.vars[key] for key in ['lon', 'lat', 'datetime'] }
+            blocks = [ list(block) for block in np.array_split(np.arange(nframes),
+                                        max(1, nframes // FRAMES_PER_JOB)) ]
+
+            print('pcolor: render {} frames on {} processes'.format(nframes, nworkers))
+            pool = multiprocessing.Pool(nworkers, initializer=_init_pcolor_worker,
+                                        initargs=(config, shared, grid, quiver_flag, specs))
+            try:
+                for wave in range(0, len(blocks), nworkers):
+                    jobs = [ (block, nframes) for block in blocks[wave:wave+nworkers] ]
+                    for frames in pool.map(_pcolor_block, jobs):
+                        for images in frames:
+                            for writer, rgb in zip(writers, images):
+                                with TRACE.stage('encode'):
+                                    writer.append_frame(rgb)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+
+class FrameRenderer(object):
+    """
+    Animation frames for one DataBucket, drawing the map only once.
+    The figure, cartopy axes, features, gridlines and colorbar (and the quiver)
+    are built for the first frame. Each later frame only updates the
+    pcolormesh array (set_array), the quiver vectors (set_UVC) and the title.
+    With several field specs there is one pcolormesh per field on the same map.
+    Only the one being drawn is visible and the colorbar follows it.
+    grab() blits: the map without the data is drawn once per field spec and
+    saved; each frame restores it and draws only the pcolormesh, quiver and
+    title, then the layers that lie above them (borders, rivers, grid lines,
+    map outline).
+    Usage: renderer = FrameRenderer(bucket, quiver_flag); fnames = renderer.render(count, nframes)
+    """
+    def __init__(self, bucket, quiver_flag=False, icount=0, specs=None):
+        """
+        Build the static map layers, using time index icount for the data
+        specs - field specifications to draw. Default: field_products()
+        """
+        self.bucket = bucket
+        self.quiver_flag = quiver_flag
+        self.specs = specs or field_products()
+
+        plt.close('all')
+        self.fig = plt.figure(figsize=(10,10), dpi=100)
+        with TRACE.stage('base_map'):
+            self.ax,X,Y,cset,self.cbar = bucket._ccrs_pcolor(self.fig,None,icount,self.specs[0])
+        self.csets = [cset]
+        for spec in self.specs[1:]:
+            cset = self.ax.pcolormesh( X, Y, bucket.get_frame(spec['plot_var'], icount),
+                                transform=ccrs.PlateCarree(), cmap=spec['cmap'] )
+            cset.set_clim([spec['levs'][0],spec['levs'][-1]])
+            cset.set_visible(False)
+            self.csets.append(cset)
+
+        if quiver_flag == True:
+            self.spacing = max(1, int( np.shape(X)[1] // params.nx_quiv )) # quiver point spacing
+            #spacing = params.spacing # quiver point spacing
+            U,V = self._quiver_frame(icount)
+            self.qset = self.ax.quiver( X[::self.spacing,::self.spacing],
+                            Y[::self.spacing,::self.spacing],
+                            U, V, units='xy', scale_units='width',scale=40)
+        self.qcount = icount # time index of the quiver vectors
+
+        self.title = self.ax.set_title('')
+
+        # the artists that change from frame to frame are blitted onto a background per field spec
+        self.blitter = Blitter(self.fig, self.ax,
+                               self.csets + ([self.qset] if quiver_flag == True else []) + [self.title])
+
+    def _quiver_frame(self, icount):
+        """ Subsampled U,V for time index icount. Slow vectors are masked """
+        U,V = self.bucket.velocity_frame(icount)
+
+        speed = np.sqrt(U**2+V**2)
+
+        U = np.ma.masked_where( speed < params.speed_min, U)
+        V = np.ma.masked_where( speed < params.speed_min, V)
+        return U[::self.spacing,::self.spacing], V[::self.spacing,::self.spacing]
+
+    def update(self, icount, ispec=0):
+        """ Update the data artists and title to time index icount of field specs[ispec] """
+        spec = self.specs[ispec]
+        cset = self.csets[ispec]
+        for other in self.csets:
+            other.set_visible(other is cset)
+        if self.cbar.mappable is not cset:
+            self.cbar.update_normal(cset)
+
+        with TRACE.stage('frame_data', frame=icount, field=spec['field']):
+            Z = self.bucket.get_frame(spec['plot_var'], icount)
+        arr = cset.get_array()
+        if np.size(arr) != np.size(Z): # flat shading drops the last row and column
+            Z = Z[:-1,:-1]
+        cset.set_array(Z.reshape(np.shape(arr)))
+
+        if self.quiver_flag == True and self.qcount != icount:
+            with TRACE.stage('quiver_data', frame=icount):
+                U,V = self._quiver_frame(icount)
+            self.qset.set_UVC(U, V)
+            self.qcount = icount
+
+        dat = format_datetime64(self.bucket.vars['datetime'][icount], '%d %b %Y') #: %H:%M')
+        self.title.set_text(config+': '+spec['field']+' ('+spec['units']+'): '+str(dat))
+
+    def render(self, icount, nframes):
+        """
+        Draw time index icount of each field to its own file.
+        Always save file. Can not display from within docker container
+        Returns: list of file names, one per spec
+        """
+        print('frame progress: {} / {}'.format(icount,nframes-1))
+        fnames = []
+        for ispec, spec in enumerate(self.specs):
+            self.update(icount, ispec)
+            fname = os.path.splitext(spec['ofile'].replace('TEMPLATE',config))[0] \
+                            +'_'+str(icount).zfill(4)+'.png'
+            with TRACE.stage('savefig', frame=icount, field=spec['field']):
+                self.fig.savefig(fname, dpi=100)
+            fnames.append(fname)
+        return fnames
+
+    def grab(self, icount, nframes):
+        """
+        Blit time index icount of each field onto its saved background
+        Returns: list of (height, width, 3) uint8 images, one per spec
+        """
+        print('frame progress: {} / {}'.format(icount,nframes-1))
+        images = []
+        for ispec, spec in enumerate(self.specs):
+            self.update(icount, ispec)
+            if ispec not in self.blitter.backgrounds:
+                with TRACE.stage('background', field=spec['field']):
+                    self.blitter.save_background(ispec)
+            with TRACE.stage('draw', frame=icount, field=spec['field']):
+                images.append(self.blitter.grab(ispec))
+        return images
 
-            else:
-                plt.show()
+    def close(self):
+        """ Release the figure """
+        plt.close(self.fig)
 
-        if anim_flag == True:
-            # Make the animated gif and clean up the files
-            if(quiver_flag):
-                make_gif(files,params.ofile.replace('TEMPLATE',config). \
-                                replace('.gif','_vec.gif'),delay=20)
-            else:
-                make_gif(files,params.ofile.replace('TEMPLATE',config) \
-                                ,delay=20)
 
-            for f in files:
-                os.remove(f)
 
+class DatasetRegistry(object):
+    """
+    Shared xarray dataset handles, keyed by file path (or glob pattern).
+    acquire() opens the file on first use and increments a reference count,
+    release() decrements it and closes the file when it is no longer referenced.
+    close() shuts a handle (or all handles) regardless of the count.
+    Usage: DS = DATASETS.acquire(fname); ...; DATASETS.release(fname)
+    """
+    def __init__(self, tlim=[], lazy=False):
+        """
+        set handle and reference count dictionaries to empty
+        tlim - time window. Chunk files wholly outside it are never opened
+        lazy - one time record per dask chunk, for reading a frame at a time
+        """
+        self.handles = {} # file path : xarray dataset
+        self.counts = {} # file path : number of current users
+        self.layouts = {} # file path : on-disk chunk layout of its first file
+        self.nopened = 0 # number of files opened since start up
+        self.tlim = tlim
+        self.lazy = lazy
+
+    def acquire(self, file_name):
+        """ Return the open dataset for file_name, opening it if required """
+        if file_name not in self.handles:
+            files = expand_nemo_files(file_name, self.tlim)
+            if files == []:
+                raise IOError('No files match '+file_name)
+            # Lazily concatenate the chunks along time, with dask chunks that
+            # are whole multiples of the NetCDF4 chunks of the files.
+            # Grid variables (nav_lat, nav_lon) are taken from the first file.
+            with TRACE.stage('chunk_layout', file=file_name):
+                self.layouts[file_name] = nc_chunk_layout(files[0])
+            chunks = dask_chunks(self.layouts[file_name], self.lazy)
+            print("acquire: open {} ({} files) with chunks {}".format(file_name, len(files), chunks))
+            with TRACE.stage('open_mfdataset', file=file_name):
+                self.handles[file_name] = xr.open_mfdataset(files, combine='nested',
+                                        concat_dim='time_counter', data_vars='minimal',
+                                        coords='minimal', compat='override', chunks=chunks)
+            self.counts[file_name] = 0
+            self.nopened += 1
+        self.counts[file_name] += 1
+        return self.handles[file_name]
+
+    def refresh(self, file_name):
+        """
+        Reopen file_name if it is open, to see new chunk files and time records.
+        The reference count is kept
+        """
+        if file_name in self.handles:
+            count = self.counts[file_name]
+            self.close(file_name)
+            self.acquire(file_name)
+            self.counts[file_name] = count
+
+    def release(self, file_name):
+        """ Drop one reference to file_name. Close it if nobody holds it """
+        if file_name not in self.handles:
+            return
+        self.counts[file_name] -= 1
+        if self.counts[file_name] <= 0:
+            self.close(file_name)
+
+    def close(self, file_name=None):
+        """ Explicitly close file_name, or every open handle if None """
+        if file_name is None:
+            names = list(self.handles.keys())
+        else:
+            names = [file_name]
+        for name in names:
+            if name in self.handles:
+                self.handles.pop(name).close()
+                self.counts.pop(name)
+                self.layouts.pop(name, None)
 
-        return None
 
+DATASETS = DatasetRegistry() # One registry per session
 
 
 class GenericDataElement(object):
@@ -445,9 +1063,10 @@ class NemoDataElement(GenericDataElement):
 
     If geographic limits are set, then only a subset of data is extracted.
     """
-    def __init__(self, filename = None, var_name = None, long_name = None, limits = None):
+    def __init__(self, filename = None, var_name = None, long_name = None, limits = None, values = None):
         """
         Initialise attributes: variable name, long name, data, ndims
+        values - data already read in a batched read (see load_nemo_elements)
         """
         self.file_name = filename
         self.var_name = var_name
@@ -456,80 +1075,31 @@ class NemoDataElement(GenericDataElement):
         #self.long_name = self.get_nc4_attribute_value('long_name')
         #self.long_name = self.get_xarr_attribute_value('long_name')
         self.limits = limits
+        self.values = values
         self.data = self.load_item()
 
     def load_item(self):
         """ NEMO load statement. """
         print('load_item: NEMO load statement')
+        if self.values is not None: # Already read
+            return self.__format_xarr_item__(self.values)
         #return self.__get_nc4_item__()
         return self.__get_xarr_item__()
 
     def __get_xarr_item__(self):
         """
         xarray: Return the data requested.
-        The data "sel"ected (subsampled) in x,y,t and z dimensions:
-            tlim defines the time dimension subsetting
-            xlim defines the longitude dimension subsetting
-            ylim defines the latitude dimension subsetting
-        NOTE: xarray has a problem when it reads in latitude values at the equator.
-        It replaces the values with NaNs...
-        Here I manaully fill NaNs in the lat or lon fields with Zero.
+        The file handle is borrowed from the DATASETS registry.
         """
 
         try:
-            #DS = xr.open_dataset(self.file_name)
-            DS = xr.open_mfdataset(self.file_name)
-            #print(DS)
-            #print (self.var_name)
-            #dvar = dataset.variables[self.var_name]
-            ret_item = []
-            #print("get_xarr_item: self.limits.keys(): {}".format(self.limits.keys()))
-            print("get_xarr_item: Read var_name: {} or std_name: {}".format( self.var_name, self.std_name))
-
-            # First time through read in the whole data set for the given (grid) variables
-            if self.limits == None: # Limits have not yet been sought
-                ret_item = getattr(DS, self.var_name).values
-
-            # Second time through read in subsetted data
-            else:
-                # Initialise arguement dictionary for selecting data subset
-                arguments_dictionary = {}
-                _depth_nam = None
-
-                for key in DS[self.var_name].dims:
-                    if('depth' in key):
-                        _depth_nam = key
-                        arguments_dictionary.update( {_depth_nam : slice(None,1)} ) # Only surface level
-                    elif('x' in key):
-                        arguments_dictionary.update( {'x' : slice(*self.__formatlimits(self.limits['ilon']))} )
-                    elif('y' in key):
-                        arguments_dictionary.update( {'y' : slice(*self.__formatlimits(self.limits['ilat']))} )
-                    elif('time_counter' in key):
-                        arguments_dictionary.update( {'time_counter' : slice(*self.__formatlimits(self.limits['itime']))} )
-
-                # Extract the data 'SELection'
-                if _depth_nam is not None: # Squeeze out redundant z dimention
-                    ret_item = DS[self.var_name].sel( **arguments_dictionary ).squeeze(_depth_nam).values
-                else:
-                    ret_item = DS[self.var_name].sel( **arguments_dictionary ).values
-
-
-            ## Process the format of the extraction
-            # Use datetime format
-            if self.std_name == 'datetime':
-                #print('limits: {}'.format(self.limits))
-                ret_item = npdatetime2datetime( ret_item )
-
-            # When xarray loads lat it replaces the zeros with NaNs!
-            elif self.std_name == 'lat' or self.std_name == 'lon':
-                ret_item[np.isnan(ret_item)] = 0.
-                ret_item = np.ma.masked_invalid(ret_item)
-            #elif self.std_name == 'datetime':
-            #    ret_item = ret_item # datetime does not support mamasked_invalif
-            else:
-                ret_item = np.ma.masked_invalid(ret_item) # values are masked or 'define_slice' extraction of lat lon limits wont work
-            return ret_item
-            #return getattr(DS, self.var_name).sel(y=slice(10, 100), x=slice(100, 200)).values
+            DS = DATASETS.acquire(self.file_name)
+            try:
+                print("get_xarr_item: Read var_name: {} or std_name: {}".format( self.var_name, self.std_name))
+                ret_item = self.select_xarr_item(DS, self.var_name, self.limits).values
+            finally:
+                DATASETS.release(self.file_name)
+            return self.__format_xarr_item__(ret_item)
 
         except KeyError:
             print('a. Cannot find the requested variable '+self.var_name)
@@ -537,11 +1107,74 @@ class NemoDataElement(GenericDataElement):
             print('a. Cannot open the file '+self.file_name)
         return None
 
+    @staticmethod
+    def select_xarr_item(DS, var_name, limits):
+        """
+        xarray: Return the (lazy) selection of var_name. No data are read.
+        The data "sel"ected (subsampled) in x,y,t and z dimensions:
+            itime defines the time dimension subsetting
+            ilon defines the longitude dimension subsetting
+            ilat defines the latitude dimension subsetting
+        The z dimension is reduced to the surface level
+        """
+        # First time through read in the whole data set for the given (grid) variables
+        if limits == None: # Limits have not yet been sought
+            return DS[var_name]
+
+        # Second time through read in subsetted data
+        depth_arguments, arguments_dictionary = NemoDataElement.selection_arguments(DS, var_name, limits)
+        return DS[var_name].isel( **depth_arguments ).sel( **arguments_dictionary )
+
+    @staticmethod
+    def selection_arguments(DS, var_name, limits):
+        """
+        isel and sel arguments of the subset of var_name given by limits
+        Returns: {depth dim: 0} (surface level, by position), {dim: label slice}
+        """
+        # Initialise arguement dictionary for selecting data subset
+        depth_arguments = {}
+        arguments_dictionary = {}
+
+        for key in DS[var_name].dims:
+            if('depth' in key):
+                depth_arguments.update( {key : 0} ) # Only surface level. Drops the z dimension
+            elif('x' in key):
+                arguments_dictionary.update( {'x' : slice(*NemoDataElement.__formatlimits(limits['ilon']))} )
+            elif('y' in key):
+                arguments_dictionary.update( {'y' : slice(*NemoDataElement.__formatlimits(limits['ilat']))} )
+            elif('time_counter' in key):
+                arguments_dictionary.update( {'time_counter' : slice(*NemoDataElement.__formatlimits(limits['itime']))} )
+        return depth_arguments, arguments_dictionary
+
+    def __format_xarr_item__(self, ret_item):
+        """
+        Process the format of the extraction.
+        NOTE: xarray has a problem when it reads in latitude values at the equator.
+        It replaces the values with NaNs...
+        Here I manaully fill NaNs in the lat or lon fields with Zero.
+        Lazy (dask) fields are returned as they are, NaN where masked.
+        """
+        if isinstance(ret_item, da.Array):
+            return ret_item
+
+        # Keep time as a datetime64 array
+        if self.std_name == 'datetime':
+            #print('limits: {}'.format(self.limits))
+            ret_item = np.asarray(ret_item, dtype='datetime64[ns]')
+
+        # When xarray loads lat it replaces the zeros with NaNs!
+        elif self.std_name == 'lat' or self.std_name == 'lon':
+            ret_item[np.isnan(ret_item)] = 0.
+            ret_item = np.ma.masked_invalid(ret_item)
+        else:
+            ret_item = np.ma.masked_invalid(ret_item) # values are masked or 'define_slice' extraction of lat lon limits wont work
+        return ret_item
+
 
     def get_xarr_attribute_value(self, attr_name):
         """ xarray: Returns the attribute value of the variable """
         try:
-            DS = xr.open_dataset(self.file_name)
+            DS = DATASETS.acquire(self.file_name)
             #dvar = dataset.variables[self.var_name]
             ret_val = {}
             try:
@@ -549,6 +1182,8 @@ class NemoDataElement(GenericDataElement):
                 ret_val = getattr(DS, self.var_name).attrs[attr_name]
             except AttributeError:
                 ret_val = None
+            finally:
+                DATASETS.release(self.file_name)
             return ret_val
         except KeyError:
             print('b. Cannot find the requested variable '+self.var_name)
@@ -587,9 +1222,12 @@ class NemoDataElement(GenericDataElement):
         return None
 
 
-    def __formatlimits(self, limitlist):
+    @staticmethod
+    def __formatlimits(limitlist):
         if limitlist == None:
             return None, None
+        elif isinstance(limitlist[0], np.datetime64):
+            return limitlist[0], limitlist[1]
         elif type(limitlist[0])==datetime.datetime:
             return limitlist[0].strftime('%Y-%m-%dT%H:%M:%S'), \
                     limitlist[1].strftime('%Y-%m-%dT%H:%M:%S')
@@ -599,6 +1237,260 @@ class NemoDataElement(GenericDataElement):
 
 ###################### FUNCTIONS ############################
 
+def _init_pcolor_worker(config_name, shared, grid, quiver_flag, specs):
+    """
+    Pool initializer: make the config available to a render process (forked
+    processes inherit it, spawned ones import it again), and set up its
+    FrameRenderer on the memory-mapped fields.
+    """
+    global params, config, _worker_renderer
+    if 'params' not in globals():
+        params = importlib.import_module(config_name+'_config')
+    config = config_name
+
+    bucket = DataBucket()
+    bucket.vars.update(grid)
+    for key, fname in shared.items():
+        bucket.vars[key] = np.load(fname, mmap_mode='r')
+    bucket.collocated = True # ssu, ssv were shared on T points
+    _worker_renderer = FrameRenderer(bucket, quiver_flag, specs=specs)
+
+def _pcolor_block(job):
+    """
+    Pool worker: render one contiguous block of frames.
+    Returns: list of images per frame (one per spec), in frame order
+    """
+    frames, nframes = job
+    return [_worker_renderer.grab(count, nframes) for count in frames]
+
+def staggered_grid(limits):
+    """
+    The StaggeredGrid of params.domain_cfg on the subdomain of limits (ilat, ilon),
+    or None if domain_cfg is not set. Operators are cached in params.cgrid_cache_dir
+    """
+    domain_cfg = getattr(params, 'domain_cfg', None)
+    if domain_cfg is None:
+        return None
+    grid = get_staggered_grid(domain_cfg, cache_dir=getattr(params, 'cgrid_cache_dir', None))
+    return grid.window(limits.get('ilat'), limits.get('ilon'))
+
+def select_field(field):
+    """
+    Set the field specific constants (plot_var, units, levs, cmap, ofile, ...)
+    in params from params.field_specs[field].
+    Usage: select_field('salinity')
+    """
+    field_specs = getattr(params, 'field_specs', {})
+    if field in field_specs:
+        for key, val in field_specs[field].items():
+            setattr(params, key, val)
+        params.field = field
+    elif field != params.field:
+        raise KeyError('Field {} is not in {}_config.field_specs'.format(field, config))
+
+def field_products():
+    """
+    Specifications of the fields drawn together: one per entry of params.fields
+    (default [params.field]), from params.field_specs. Each is a dictionary with
+    field, plot_var, units, levs, cmap and ofile.
+    Usage: for spec in field_products(): print(spec['field'], spec['plot_var'])
+    """
+    field_specs = getattr(params, 'field_specs', {})
+    specs = []
+    for field in getattr(params, 'fields', [params.field]):
+        if field in field_specs:
+            spec = dict(field_specs[field])
+        elif field == params.field:
+            spec = { key: getattr(params, key) for key in ['plot_var', 'units', 'levs', 'cmap', 'ofile'] }
+        else:
+            raise KeyError('Field {} is not in {}_config.field_specs'.format(field, config))
+        spec['field'] = field
+        specs.append(spec)
+    return specs
+
+def run_jobs(job_file, nparallel=1, report_file=None):
+    """
+    Run the batch jobs listed in a json job file, nparallel at a time, each in
+    its own process. A job is a dictionary, only config and actions are required:
+        {"config": "BLZ", "actions": ["a", "pa", "qa"], "field": ["temperature"],
+         "tlim": ["1995-01-01", "1995-01-05"], "workers": 2, "lazy": true}
+    Each job logs to XXX_jobN.log and reports to XXX_jobN_timing.json.
+    Returns: exit status. 0 if every job succeeded
+    """
+    with open(job_file) as file_object:
+        jobs = json.load(file_object)
+
+    def run_job(ijob):
+        """ Run job number ijob. Returns: summary dictionary """
+        job = jobs[ijob]
+        stem = '{}_job{}'.format(job['config'], ijob)
+        cmd = [sys.executable, os.path.abspath(__file__), job['config'], '--batch'] + list(job['actions'])
+        if 'field' in job:
+            cmd += ['--field'] + list(np.atleast_1d(job['field']))
+        if 'tlim' in job:
+            cmd += ['--tlim'] + list(job['tlim'])
+        if 'workers' in job:
+            cmd += ['--workers', str(job['workers'])]
+        if job.get('lazy'):
+            cmd += ['--lazy']
+        cmd += ['--report', stem+'_timing.json']
+
+        print("run_jobs: start {}".format(' '.join(cmd[2:])))
+        start = time.time()
+        with open(stem+'.log', 'w') as log:
+            status = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+        print("run_jobs: {} finished with status {}".format(stem, status))
+        return {'job': job, 'log': stem+'.log', 'status': status, 'seconds': time.time()-start}
+
+    start = time.time()
+    pool = ThreadPool(max(1, nparallel)) # each thread waits on one job process
+    try:
+        results = pool.map(run_job, range(len(jobs)))
+    finally:
+        pool.close()
+        pool.join()
+
+    status = 0 if all(result['status'] == 0 for result in results) else 1
+    if report_file is None:
+        report_file = os.path.splitext(job_file)[0]+'_timing.json'
+    with open(report_file, 'w') as file_object:
+        json.dump({'status': status, 'seconds': time.time()-start, 'jobs': results},
+                  file_object, indent=1)
+    print("run_jobs: {} jobs in {:.2f}s, status {}. Report in {}".format(len(jobs),
+                time.time()-start, status, report_file))
+    return status
+
+def load_nemo_elements(filename, variable_lst, limits=None, lazy=False):
+    """
+    Read several variables from one file in a single batched read.
+    The handle is shared through DATASETS, the (subsetted) selections are
+    computed together and each is wrapped as a NemoDataElement.
+    lazy - leave (time,y,x) selections unread, as dask arrays. The file must
+           then be held open (DATASETS.acquire) while they are used
+    Usage: elements = load_nemo_elements(fname, ['nav_lat','nav_lon'], limits)
+    """
+    try:
+        DS = DATASETS.acquire(filename)
+    except (IOError, RuntimeError):
+        print('a. Cannot open the file '+filename)
+        return []
+
+    try:
+        found_lst = []
+        selections = []
+        for var in variable_lst:
+            try:
+                selections.append( NemoDataElement.select_xarr_item(DS, var, limits).data )
+                found_lst.append(var)
+            except KeyError:
+                print('a. Cannot find the requested variable '+var)
+        if limits is not None:
+            for var in found_lst:
+                report_read_bytes(DS, var, limits, DATASETS.layouts.get(filename, {}))
+        deferred = [lazy and sel.ndim == 3 for sel in selections]
+        print("load_nemo_elements: Read {} from {}".format(
+                    [var for var, defer in zip(found_lst, deferred) if not defer], filename))
+        with TRACE.stage('read', file=filename):
+            computed = iter(dask.compute(*[sel for sel, defer in zip(selections, deferred) if not defer]))
+        values = [sel if defer else np.asarray(next(computed)) for sel, defer in zip(selections, deferred)]
+    finally:
+        DATASETS.release(filename)
+
+    with TRACE.stage('format', file=filename): # masked_invalid
+        return [NemoDataElement(filename, var, limits=limits, values=val)
+                for var, val in zip(found_lst, values)]
+
+def nc_chunk_layout(file_name):
+    """
+    On-disk layout of the variables of a NetCDF4 file
+    Returns: {var_name: {'dims', 'shape', 'chunks' (None if contiguous), 'itemsize',
+              'zlib', 'complevel', 'shuffle'}}
+    """
+    layout = {}
+    dataset = Dataset(file_name, 'r')
+    try:
+        for name, dvar in dataset.variables.items():
+            chunking = dvar.chunking()
+            filters = dvar.filters() or {}
+            layout[name] = {'dims': dvar.dimensions, 'shape': dvar.shape,
+                            'chunks': None if chunking == 'contiguous' else list(chunking),
+                            'itemsize': dvar.dtype.itemsize if hasattr(dvar.dtype, 'itemsize') else 1,
+                            'zlib': bool(filters.get('zlib')), 'complevel': filters.get('complevel', 0),
+                            'shuffle': bool(filters.get('shuffle'))}
+    finally:
+        dataset.close()
+    return layout
+
+def disk_chunks(item):
+    """
+    Chunk shape of one layout entry. A contiguous variable is not
+    decompressed and any hyperslab can be read, so its chunk is one value
+    """
+    if item['chunks'] is not None:
+        return list(item['chunks'])
+    return [1 for dim in item['dims']]
+
+def dask_chunks(layout, lazy=False):
+    """
+    dask chunks, per dimension, for a file with this on-disk layout.
+    Each is a whole multiple of the disk chunk, so no disk chunk is decompressed
+    by two dask tasks. Depth is one level (only the surface is read). x and y,
+    then time (unless lazy), are grown towards DASK_CHUNK_BYTES.
+    The largest variable sets the chunks of the dimensions it uses.
+    Usage: DS = xr.open_dataset(fname, chunks=dask_chunks(nc_chunk_layout(fname)))
+    """
+    chunks = {}
+    for name in sorted(layout, key=lambda name: -np.prod(layout[name]['shape'])):
+        item = layout[name]
+        if len(item['dims']) == 0:
+            continue
+        length = dict(zip(item['dims'], item['shape']))
+        size = dict(zip(item['dims'], disk_chunks(item)))
+        order = [dim for dim in reversed(item['dims']) if dim != 'time_counter' and 'depth' not in dim]
+        if not lazy and 'time_counter' in size:
+            order.append('time_counter')
+        for dim in item['dims']:
+            if 'depth' in dim:
+                size[dim] = 1
+        for dim in order:
+            nbytes = item['itemsize'] * int(np.prod(list(size.values())))
+            factor = max(1, DASK_CHUNK_BYTES // max(1, nbytes))
+            size[dim] = min(length[dim], size[dim]*factor)
+        for dim in item['dims']:
+            chunks.setdefault(dim, size[dim])
+    return chunks
+
+def report_read_bytes(DS, var_name, limits, layout):
+    """
+    Print the bytes decompressed to read the subset of var_name, whole disk
+    chunks at a time, against the bytes of the subset itself.
+    Returns: bytes read, bytes used
+    """
+    if var_name not in layout:
+        return None, None
+    item = layout[var_name]
+    depth_arguments, arguments_dictionary = NemoDataElement.selection_arguments(DS, var_name, limits)
+    nread = nused = item['itemsize']
+    for dim, chunk in zip(item['dims'], disk_chunks(item)):
+        if dim in depth_arguments:
+            index = slice(depth_arguments[dim], depth_arguments[dim]+1)
+        elif dim in arguments_dictionary and dim in DS.indexes: # label slice, as sel does
+            index = DS.indexes[dim].slice_indexer(arguments_dictionary[dim].start,
+                                                  arguments_dictionary[dim].stop)
+        elif dim in arguments_dictionary: # no coordinate: sel slices by position
+            index = arguments_dictionary[dim]
+        else:
+            index = slice(None)
+        start, stop, _ = index.indices(DS.sizes[dim])
+        if stop <= start:
+            return 0, 0
+        nused *= stop - start
+        nread *= ((stop-1)//chunk - start//chunk + 1) * chunk # whole chunks. Time chunks assumed aligned in each file
+    compression = 'zlib {}'.format(item['complevel']) if item['zlib'] else 'uncompressed'
+    print("report_read_bytes: {} read {:.2f} MB for {:.2f} MB used ({:.0f}%), {}, chunks {}".format(
+                var_name, nread/2.**20, nused/2.**20, 100.*nused/nread, compression, item['chunks'] or 'contiguous'))
+    return nread, nused
+
 def PythonVersion():
     """ Find python version """
     return python_version()
@@ -622,18 +1514,64 @@ def convert_modelvarname_to_stdvarname(var_name):
         return 'lon'
     elif 'time' in var_name:
         return 'datetime'
-    return
+    return var_name # e.g. M2amp from NEMO_tidal_analysis.py
 
 def save(thing):
-    """ save copy of self into pickle file """
-    os.system('rm -f '+SAVE_FILE_NAME)
-    if(1):
-        with open(SAVE_FILE_NAME, 'wb') as file_object:
-            pickle.dump(thing, file_object)
-    else:
-        print("Don't save as pickle file")
+    """
+    Save the DataBucket into the NetCDF cache file.
+    Each (time,y,x) field is stored compressed, chunked one frame per chunk.
+    The file is written aside and then moved into place.
+    """
+    if not thing.modified:
+        print("save: %s is up to date"%SAVE_FILE_NAME)
+        return
+    DS = thing.to_dataset()
+    DS.attrs['sources'] = json.dumps(source_signature())
+    encoding = {}
+    for key in DS.data_vars:
+        encoding[key] = {'zlib': True, 'complevel': 4}
+        if DS[key].ndim == 3:
+            encoding[key]['chunksizes'] = (1,) + DS[key].shape[1:]
+    with TRACE.stage('save_cache'):
+        DS.to_netcdf(SAVE_FILE_NAME+'.tmp', encoding=encoding)
+    os.replace(SAVE_FILE_NAME+'.tmp', SAVE_FILE_NAME)
+    thing.modified = False
     return
 
+def source_signature():
+    """
+    Identify the data behind a cache file: the modification time and size
+    of every source file, plus the subsetting limits.
+    """
+    sources = {}
+    for key in list(params.grid_data.keys()) + list(params.input_data.keys()):
+        sources.update(file_signatures(key))
+    return {'files': sources, 'xlim': str(params.xlim), 'ylim': str(params.ylim),
+            'tlim': str(params.tlim)}
+
+def file_signatures(file_name):
+    """
+    Modification time and size of each file matching file_name (within tlim).
+    These change when XIOS adds a chunk file or flushes new records.
+    Returns: {path: [mtime, size]}
+    """
+    sources = {}
+    for fname in expand_nemo_files(file_name, params.tlim):
+        stat = os.stat(fname)
+        sources[fname] = [stat.st_mtime, stat.st_size]
+    return sources
+
+def as_masked(arr):
+    """
+    Return arr as a numpy masked array, masking NaNs.
+    Reads the data if arr is a lazy (xarray or dask) array.
+    """
+    if isinstance(arr, np.ma.MaskedArray):
+        return arr
+    if isinstance(arr, xr.DataArray):
+        arr = arr.values
+    return np.ma.masked_invalid(np.asarray(arr))
+
 def set_plot_lim(wlim, nav_arr):
     """
     Fill xlim or ylim if empty
@@ -643,49 +1581,40 @@ def set_plot_lim(wlim, nav_arr):
         wlim = [nav_arr.min(), nav_arr.max()]
     return wlim
 
+def animation_file_name(quiver_flag, spec=None):
+    """ Animation output file from the spec (default params) ofile: .gif or .mp4 """
+    ofile = params.ofile if spec is None else spec['ofile']
+    root, ext = os.path.splitext(ofile.replace('TEMPLATE',config))
+    if quiver_flag:
+        root = root + '_vec'
+    return root + ext
+
 def make_gif(files,output,delay=100, repeat=True,**kwargs):
     """
-    Uses imageio to produce an animated .gif from a list of
-    picture files.
+    Uses AnimationWriter to produce an animated .gif (or .mp4) from a list of
+    picture files. The files are read one at a time.
     """
-
-    images = []
-    for filename in files:
-        images.append(imageio.imread(filename))
-    output_file = 'Gif-%s.gif' % datetime.datetime.now().strftime('%Y-%M-%d-%H-%M-%S')
-    imageio.mimsave(output, images, fps=10)
+    with TRACE.stage('make_gif', output=output):
+        writer = AnimationWriter(output, fps=10)
+        for filename in files:
+            writer.append_frame(np.asarray(imageio.imread(filename))[:,:,:3])
+        writer.close()
 
 def findJI(lat, lon, lat_grid, lon_grid):
      """
      Simple routine to find the nearest J,I coordinates for given lat lon
+     The KD-tree for the grid is built on first use and then reused.
      Usage: [J,I] = findJI(49, -12, nav_lat_grid_T, nav_lon_grid_T)
      """
-     dist2 = np.square(lat_grid - lat) + np.square(lon_grid - lon)
-     [J,I] = np.unravel_index( dist2.argmin(), dist2.shape  )
-     return [J,I]
-
-def nearest(items, pivot):
-    """
-    This function will return the thing in items which is the closest to the pivot.
-    Usage: ind,val = nearest( datetime_arr, date)
-    """
-    val = min(items, key=lambda x: abs(x - pivot))
-    ind = items.index(val)
-    return ind, val
+     J,I = get_grid_index(lat_grid, lon_grid).query(lat, lon)
+     return [int(J),int(I)]
 
-def npdatetime2datetime(items):
+def format_datetime64(item, fmt):
     """
-    Convert numpy datetime object into datetime object via string format
-    Only accurate to second. Truncates milleseconds etc
-    Assumes format with "T" e.g.
-    1966-12-26T12:00:00.000000000
+    Format one numpy datetime64 with a strftime format. Truncates to the second.
+    Usage: format_datetime64(vars['datetime'][0], '%d %b %Y')
     """
-    datetime_obj = []
-    for val in items.astype(str):
-        datetime_obj.append( datetime.datetime.strptime( \
-         val.rstrip('0').rstrip('.'), "%Y-%m-%dT%H:%M:%S") \
-            )
-    return datetime_obj
+    return np.datetime64(item, 's').item().strftime(fmt)
 
 
 ###################### CORE CODE ############################
@@ -693,16 +1622,54 @@ def npdatetime2datetime(items):
 ## Now do the main routine stuff
 if __name__ == '__main__':
 
-    import importlib
-
     ## Pass the argument as the configuration file to read
-    if len(sys.argv) >1:
-        scriptname = sys.argv[0]
-        config = sys.argv[1]
-    else:
-        config = "SEAsia"
-        #config = "ORCA0083"
-        #config = "ORCA0083_Mauritius"
+    parser = argparse.ArgumentParser(description='Load NEMO surface fields, then plot and animate them.',
+                epilog='Without --batch or --jobs the interactive menu is started.')
+    parser.add_argument('config', nargs='?', default='SEAsia',
+                help='XXX, where XXX_config.py exists')
+    parser.add_argument('--batch', nargs='+', metavar='ACTION',
+                help='run these actions (a, s, pcolor, quiver, pa, qa) without prompting, then save and exit')
+    parser.add_argument('--field', nargs='+',
+                help='field(s) from the config field_specs, e.g. temperature salinity')
+    parser.add_argument('--tlim', nargs=2, metavar=('START','END'),
+                help='time window, e.g. 1995-01-01 1995-01-05T12:00')
+    parser.add_argument('--workers', type=int,
+                help='number of processes rendering animation frames (params.nworkers)')
+    parser.add_argument('--lazy', action='store_true',
+                help='keep (time,y,x) fields on disk and read them a frame at a time (params.lazy)')
+    parser.add_argument('--follow', nargs='?', const='pf', choices=['pf', 'qf'],
+                help='after the --batch actions (default a), animate and follow the running model output')
+    parser.add_argument('--interval', type=float,
+                help='seconds between polls of the output files in follow mode (params.follow_interval)')
+    parser.add_argument('--max-idle', type=int,
+                help='stop following after this many polls without new records (params.follow_max_idle)')
+    parser.add_argument('--trace', metavar='FILE',
+                help='time each stage and frame, write the trace to FILE (.json or .csv) and print a summary at exit')
+    parser.add_argument('--trace-memory', action='store_true',
+                help='with --trace, also record allocation peaks (tracemalloc)')
+    parser.add_argument('--profile', nargs='+', metavar='ACTION', default=[],
+                help='profile these commands (with --trace, or alone)')
+    parser.add_argument('--profile-mode', choices=['cprofile', 'sample'], default='cprofile',
+                help='cProfile, or sample the stack every few ms (folded stacks for flame graphs)')
+    parser.add_argument('--report',
+                help='timing report (json). Default XXX_timing.json')
+    parser.add_argument('--jobs',
+                help='json job file. Runs each job as a separate --batch process')
+    parser.add_argument('--parallel', type=int, default=1,
+                help='number of --jobs run at the same time')
+    args = parser.parse_args()
+    scriptname = sys.argv[0]
+
+    if args.jobs is not None:
+        sys.exit(run_jobs(args.jobs, args.parallel, args.report))
+
+    if args.trace is not None or args.profile:
+        TRACE.enable(args.trace, memory=args.trace_memory, profile_commands=args.profile,
+                     profile_mode=args.profile_mode)
+
+    config = args.config
+    #config = "ORCA0083"
+    #config = "ORCA0083_Mauritius"
 
     ## load the config file
     if os.path.exists(config+"_config.py"):
@@ -710,6 +1677,7 @@ if __name__ == '__main__':
     else:
         print('Expecting argument of form XXX, where XXX_config.py exists')
         print('E.g. $ python {} XXX'.format(scriptname))
+        sys.exit(2)
     #E.g. import SEAsia_config as params
     if "2.7" in python_version():
         print("Need to manually refresh changes to %s_config"%config)
@@ -717,9 +1685,25 @@ if __name__ == '__main__':
         importlib.reload(params)
     print("Loading parameters from {}_config".format(config))
 
+    ## Command line settings override the config file
+    if args.tlim is not None:
+        params.tlim = [parse_time(tt) for tt in args.tlim]
+    if args.workers is not None:
+        params.nworkers = args.workers
+    if args.lazy:
+        params.lazy = True
+    if args.interval is not None:
+        params.follow_interval = args.interval
+    if args.max_idle is not None:
+        params.follow_max_idle = args.max_idle
+    for field in args.field or []:
+        if field not in getattr(params, 'field_specs', {}) and field != params.field:
+            print('Field {} is not in {}_config.field_specs'.format(field, config))
+            sys.exit(2)
+
 
     #### Constants
-    SAVE_FILE_NAME = config+".pkl"
+    SAVE_FILE_NAME = config+"_cache.nc"
     INSTRUCTIONS = """
 
     Choose Action:
@@ -732,6 +1716,8 @@ if __name__ == '__main__':
 
     pa      pcolor anim to file
     qa      pcolor+quiver anim to file
+    pf      pcolor anim to file, adding frames as the model writes output
+    qf      pcolor+quiver anim to file, adding frames as the model writes output
 
     q       to quit
     """
@@ -739,6 +1725,15 @@ if __name__ == '__main__':
 
 
     ## Do the main program
+    if args.batch is not None or args.follow is not None:
+        plt.switch_backend('Agg') # no display needed
+        c = Controller(interactive=False)
+        actions = args.batch or ['a']
+        if args.follow is not None:
+            actions = actions + [args.follow]
+        report_file = args.report or config+'_timing.json'
+        sys.exit( c.run_batch(actions, args.field, report_file) )
+
     c = Controller()
 
 
@@ -0,0 +1,361 @@
+"""
+NEMO_tidal_analysis.py
+
+Tidal harmonic analysis of hourly NEMO output (e.g. zos on grid_T), offline,
+for every wet grid point at once.
+
+** Summary **
+The in-model analysis (diaharm.F90, the tidal_harmonics file group of
+file_def_nemo.xml) is switched off, so the harmonics are fitted here. The
+model, as in diaharm.F90, is
+    zos(t) = z0 + sum_k f_k (a_k cos(w_k t + V_k + u_k) + b_k sin(w_k t + V_k + u_k))
+with t from the start of the analysis and the frequencies w, astronomical
+arguments V and nodal corrections f, u of tide_mod.F90 (Schureman), taken at
+the start of the analysis. Phases are then Greenwich phase lags.
+
+The least-squares normal equations have the same matrix A'A at every point.
+The records are read a block at a time: A'A (a few tens of numbers) and A'Y
+(one column per wet point) are accumulated with one matrix product per block.
+A'A is Cholesky factorised once and the coefficients of all the points are
+solved together. No loop runs over grid points, and memory is one block of
+records plus A'Y.
+
+Constituents that the record cannot separate (Rayleigh criterion: the
+record must be longer than 1/|f1-f2|) are reported.
+
+The output has, per constituent, the XIOS names of the in-model analysis:
+M2x, M2y (cosine and minus sine parts, as diaharm.F90), M2amp (m) and M2phase
+(degrees), with nav_lat, nav_lon and one time_counter record, plus the mean
+and the residual RMS. NEMO_surface_var_diag.py draws them with a field_specs
+entry whose plot_var is the name, e.g. 'M2amp'.
+
+** Useage**::
+python NEMO_tidal_analysis.py '/Belize_workshop/RUN_NEMO/EXP_demo/BLZE12_C1_1h_*_grid_T.nc' \
+    --var zos --tlim 1995-01-01 1995-02-01 --output BLZ_harmonics.nc
+"""
+
+#### Imports
+import os
+import time
+import argparse
+import numpy as np
+import scipy.linalg
+from netCDF4 import Dataset, date2num, num2date
+
+from NEMO_file_tools import expand_nemo_files, parse_time
+
+
+#### Constants
+RAD = np.pi / 180.
+BLOCK_BYTES = 256*2**20 # size of a block of time records, as float64
+## Doodson numbers and nodal corrections, as Wave() in tide_FES14.h90:
+## name: (nT, ns, nh, np, np1, shift, nksi, nnu0, nnu1, nnu2, R, formula)
+CONSTITUENTS = {
+    'M2':  (2, -2,  2,  0, 0,   0,  2, -2,  0,  0, 0,  78),
+    'S2':  (2,  0,  0,  0, 0,   0,  0,  0,  0,  0, 0,   0),
+    'N2':  (2, -3,  2,  1, 0,   0,  2, -2,  0,  0, 0,  78),
+    'K1':  (1,  0,  1,  0, 0, -90,  0,  0, -1,  0, 0, 227),
+    'O1':  (1, -2,  1,  0, 0,  90,  2, -1,  0,  0, 0,  75),
+    'Q1':  (1, -3,  1,  1, 0,  90,  2, -1,  0,  0, 0,  75),
+    'K2':  (2,  0,  2,  0, 0,   0,  0,  0,  0, -2, 0, 235),
+    'P1':  (1,  0, -1,  0, 0,  90,  0,  0,  0,  0, 0,   0),
+    'M4':  (4, -4,  4,  0, 0,   0,  4, -4,  0,  0, 0,   1),
+    'MS4': (4, -2,  2,  0, 0,   0,  2, -2,  0,  0, 0,  78),
+    'MN4': (4, -5,  4,  1, 0,   0,  4, -4,  0,  0, 0,   1),
+    'Mf':  (0,  2,  0,  0, 0,   0, -2,  0,  0,  0, 0,  74),
+    'Mm':  (0,  1,  0, -1, 0,   0,  0,  0,  0,  0, 0,  73),
+    }
+DEFAULT_CONSTITUENTS = ['M2', 'S2', 'N2', 'K1', 'O1', 'Q1', 'K2', 'P1', 'M4', 'MS4', 'MN4', 'Mf', 'Mm']
+
+
+#### Classes
+
+class HarmonicFit(object):
+    """
+    Normal equations of the harmonic fit, accumulated a block of records at a time
+    """
+    def __init__(self, constituents, start):
+        """
+        constituents - names from CONSTITUENTS
+        start - datetime of t = 0. V, u and f are taken at this time
+        """
+        self.names = list(constituents)
+        self.start = start
+        self.omega, self.v0u, self.f = tide_harmo(self.names, start)
+        ncol = 1 + 2*len(self.names)
+        self.AtA = np.zeros((ncol, ncol))
+        self.AtY = None # (ncol, npoints)
+        self.YtY = None # (npoints,)
+        self.count = None # records per point
+        self.nrec = 0
+
+    def design(self, seconds):
+        """ Design matrix rows [1, f cos, f sin, ...] for times in seconds from start. Returns: (nt, ncol) """
+        phase = np.outer(seconds, self.omega) + self.v0u
+        A = np.empty((len(seconds), 1 + 2*len(self.names)))
+        A[:, 0] = 1.
+        A[:, 1::2] = self.f * np.cos(phase)
+        A[:, 2::2] = self.f * np.sin(phase)
+        return A
+
+    def update(self, seconds, block):
+        """
+        Add records: seconds (nt,) and block (nt, npoints). Masked or NaN values count as
+        missing; points with any missing record are left out of the result
+        """
+        block = np.ma.filled(np.ma.asarray(block, dtype=float), np.nan)
+        valid = np.isfinite(block)
+        block = np.where(valid, block, 0.)
+        if self.AtY is None:
+            self.AtY = np.zeros((self.AtA.shape[0], block.shape[1]))
+            self.YtY = np.zeros(block.shape[1])
+            self.count = np.zeros(block.shape[1], dtype=np.int64)
+        A = self.design(seconds)
+        self.AtA += A.T.dot(A)
+        self.AtY += A.T.dot(block)
+        self.YtY += np.einsum('ij,ij->j', block, block)
+        self.count += valid.sum(axis=0)
+        self.nrec += len(seconds)
+
+    def solve(self):
+        """
+        Cholesky factorise A'A once and solve for every point
+        Returns: coefficients (ncol, npoints), residual RMS (npoints,), NaN for incomplete points
+        """
+        factor = scipy.linalg.cho_factor(self.AtA)
+        coef = scipy.linalg.cho_solve(factor, self.AtY)
+        # |Y - A c|^2 = Y'Y - 2 c'A'Y + c'A'A c, with A'A c = A'Y
+        residual = self.YtY - np.einsum('ij,ij->j', coef, self.AtY)
+        rms = np.sqrt(np.maximum(residual, 0.) / max(self.nrec, 1))
+        complete = self.count == self.nrec
+        coef[:, ~complete] = np.nan
+        rms[~complete] = np.nan
+        return coef, rms
+
+
+###################### FUNCTIONS ############################
+
+def astronomic_angles(when):
+    """
+    Astronomical angles at datetime when (radians), as astronomic_angle in tide_mod.F90
+    Returns: dictionary T, s, h, p, p1, N, I, xi, nu, nuprim, nusec, R, x1ra
+    """
+    zqy = float(int((when.year - 1901.) / 4.))
+    zsy = when.year - 1900.
+    zday = dayjul(when.year, when.month, when.day) + zqy - 1.
+    zhfrac = (when.hour*3600. + when.minute*60. + when.second) / 3600.
+
+    ang = {}
+    ang['N'] = np.mod((259.1560564 - 19.328185764*zsy - .0529539336*zday - .0022064139*zhfrac)*RAD, 2*np.pi)
+    ang['T'] = (180. + zhfrac*(360./24.))*RAD
+    ang['h'] = np.mod((280.1895014 - .238724988*zsy + .9856473288*zday + .0410686387*zhfrac)*RAD, 2*np.pi)
+    ang['s'] = np.mod((277.0256206 + 129.38482032*zsy + 13.176396768*zday + .549016532*zhfrac)*RAD, 2*np.pi)
+    ang['p1'] = np.mod((281.2208569 + .01717836*zsy + .000047064*zday + .000001961*zhfrac)*RAD, 2*np.pi)
+    ang['p'] = np.mod((334.3837214 + 40.66246584*zsy + .111404016*zday + .004641834*zhfrac)*RAD, 2*np.pi)
+
+    N = ang['N']
+    I = np.arccos(0.913694997 - 0.035692561*np.cos(N))
+    at1 = np.arctan(1.01883*np.tan(N/2.))
+    at2 = np.arctan(0.64412*np.tan(N/2.))
+    xi = -at1 - at2 + N
+    if N > np.pi:
+        xi -= 2.*np.pi
+    nu = at1 - at2
+    ang.update({'I': I, 'xi': xi, 'nu': nu})
+
+    t2 = np.tan(I/2.)**2
+    P1 = ang['p'] - xi
+    ang['x1ra'] = np.sqrt(1. - 12.*t2*np.cos(2.*P1) + 36.*t2*t2)
+    ang['R'] = np.arctan(np.sin(2.*P1) / (1./(6.*t2) - np.cos(2.*P1)))
+    ang['nuprim'] = np.arctan(np.sin(2.*I)*np.sin(nu) / (np.sin(2.*I)*np.cos(nu) + 0.3347))
+    s2 = np.sin(I)**2
+    ang['nusec'] = 0.5*np.arctan(s2*np.sin(2.*nu) / (s2*np.cos(2.*nu) + 0.0727))
+    return ang
+
+def dayjul(year, month, day):
+    """ Day of the year, as dayjul in tide_mod.F90 """
+    idayt = [0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334]
+    inc = 1 if (year - 1900) % 4 == 0 else 0
+    return idayt[month-1] + (inc if month >= 3 else 0) + day
+
+def nodal_factor(formula, ang):
+    """ Nodal correction factor f, as nodal_factort in tide_mod.F90 (the formulas used in CONSTITUENTS) """
+    I = ang['I']
+    if formula == 0: # solar waves
+        return 1.
+    if formula == 1: # compound waves (78 x 78)
+        return nodal_factor(78, ang)**2
+    if formula == 73:
+        return (2./3. - np.sin(I)**2) / 0.5021
+    if formula == 74:
+        return np.sin(I)**2 / 0.1578
+    if formula == 75:
+        return np.sin(I) * np.cos(I/2.)**2 / 0.3800
+    if formula == 78:
+        return np.cos(I/2.)**4 / 0.9154
+    if formula == 227:
+        zs = np.sin(2.*I)
+        return np.sqrt(0.8965*zs*zs + 0.6001*zs*np.cos(ang['nu']) + 0.1006)
+    if formula == 235:
+        zs = np.sin(I)
+        return np.sqrt(19.0444*zs**4 + 2.7702*zs*zs*np.cos(2.*ang['nu']) + .0981)
+    raise ValueError('nodal_factor: formula {} not implemented'.format(formula))
+
+def tide_harmo(names, when):
+    """
+    Frequencies (rad/s), V0+u (rad) and f of the constituents at datetime when,
+    as tide_pulse and tide_vuf in tide_mod.F90
+    Returns: omega, v0u, f arrays
+    """
+    speeds = np.array([13149000.0, 481267.892, 36000.76892, 4069.0322056, 1.719175]) # deg per julian century
+    ang = astronomic_angles(when)
+    omega, v0u, f = [], [], []
+    for name in names:
+        nT, ns, nh, np_, np1, shift, nksi, nnu0, nnu1, nnu2, R, formula = CONSTITUENTS[name]
+        omega.append( np.dot(speeds, [nT, ns, nh, np_, np1]) * RAD / (36525.*86400.) )
+        vt = ang['T']*nT + ang['s']*ns + ang['h']*nh + ang['p']*np_ + ang['p1']*np1 + shift*RAD
+        ut = ang['xi']*nksi + ang['nu']*nnu0 + ang['nuprim']*nnu1 + ang['nusec']*nnu2 + ang['R']*R
+        v0u.append(vt + ut)
+        f.append(nodal_factor(formula, ang))
+    return np.array(omega), np.array(v0u), np.array(f)
+
+def rayleigh_check(names, omega, duration):
+    """
+    Pairs of constituents the record (seconds) cannot separate: |w1-w2| duration < 2 pi
+    Returns: list of (name1, name2, days needed)
+    """
+    unresolved = []
+    for i in range(len(names)):
+        for j in range(i+1, len(names)):
+            dw = abs(omega[i] - omega[j])
+            if dw * duration < 2.*np.pi:
+                unresolved.append((names[i], names[j], 2.*np.pi / dw / 86400.))
+    return unresolved
+
+def record_times(files, tlim=None):
+    """
+    Times of the records of each file, within tlim
+    Returns: list of (file, first index, last index + 1, datetimes), units, calendar
+    """
+    records = []
+    units = calendar = None
+    for fname in files:
+        with Dataset(fname) as nc:
+            tvar = nc.variables['time_counter']
+            units = units or tvar.units
+            calendar = calendar or getattr(tvar, 'calendar', 'standard')
+            dates = num2date(tvar[:], tvar.units, getattr(tvar, 'calendar', 'standard'),
+                             only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        keep = np.array([not tlim or (tlim[0] <= date <= tlim[1]) for date in dates])
+        if keep.any():
+            i0, i1 = np.flatnonzero(keep)[[0, -1]]
+            records.append((fname, i0, i1+1, list(dates[i0:i1+1])))
+    return records, units, calendar
+
+def analyse(files, var, constituents=DEFAULT_CONSTITUENTS, tlim=None, block_bytes=BLOCK_BYTES):
+    """
+    Fit the constituents to var at every point of files
+    Returns: HarmonicFit (solved: coef, rms), info (nav_lat, nav_lon, units, calendar, dates)
+    """
+    records, units, calendar = record_times(files, tlim)
+    if not records:
+        raise IOError('analyse: no records in the files within tlim')
+    start = records[0][3][0]
+    end = records[-1][3][-1]
+    fit = HarmonicFit(constituents, start)
+
+    duration = (end - start).total_seconds()
+    for name1, name2, days in rayleigh_check(fit.names, fit.omega, duration):
+        print("analyse: WARNING {} and {} are not separated by {:.1f} days of record (Rayleigh criterion needs {:.1f})".format(
+                    name1, name2, duration/86400., days))
+    interval = np.median(np.diff([(date - start).total_seconds() for fname, i0, i1, dates in records for date in dates]))
+    if fit.omega.max() * interval >= np.pi:
+        print("analyse: WARNING {:.0f}s sampling cannot resolve {} (Nyquist). Use hourly output".format(
+                    interval, fit.names[np.argmax(fit.omega)]))
+
+    info = {'units': units, 'calendar': calendar, 'start': start, 'end': end}
+    for fname, i0, i1, dates in records:
+        seconds = np.array([(date - start).total_seconds() for date in dates])
+        with Dataset(fname) as nc:
+            if 'nav_lat' not in info:
+                info['nav_lat'] = nc.variables['nav_lat'][:]
+                info['nav_lon'] = nc.variables['nav_lon'][:]
+            nc_var = nc.variables[var]
+            ny, nx = nc_var.shape[-2:]
+            nrec = max(1, int(block_bytes // (8 * ny * nx)))
+            for t0 in range(i0, i1, nrec):
+                t1 = min(t0+nrec, i1)
+                block = nc_var[t0:t1, 0] if nc_var.ndim == 4 else nc_var[t0:t1]
+                fit.update(seconds[t0-i0:t1-i0], np.ma.reshape(block, (t1-t0, ny*nx)))
+        print("analyse: {} ({} records so far)".format(fname, fit.nrec))
+
+    try:
+        info['coef'], info['rms'] = fit.solve()
+    except np.linalg.LinAlgError:
+        raise ValueError('analyse: the fit is singular. Drop constituents that the record cannot separate')
+    info['shape'] = (ny, nx)
+    return fit, info
+
+def write_harmonics(output, fit, info, var='zos', source=''):
+    """
+    Write <C>x, <C>y, <C>amp, <C>phase per constituent (XIOS names of the
+    in-model analysis), <var>_mean and <var>_residual_rms, as (time_counter,y,x)
+    fields with nav_lat, nav_lon and one time_counter record (the middle of the analysis)
+    """
+    ny, nx = info['shape']
+    coef = info['coef'].reshape((-1, ny, nx))
+    fields = {var+'_mean': (coef[0], 'mean of '+var, 'm'),
+              var+'_residual_rms': (info['rms'].reshape((ny, nx)), 'RMS of '+var+' minus the harmonic fit', 'm')}
+    for k, name in enumerate(fit.names):
+        a, b = coef[1+2*k], coef[2+2*k]
+        fields[name+'x'] = (a, name+' Elevation harmonic real part', 'm')
+        fields[name+'y'] = (-b, name+' Elevation harmonic imaginary part', 'm')
+        fields[name+'amp'] = (np.hypot(a, b), name+' Elevation harmonic Amplitude', 'm')
+        fields[name+'phase'] = (np.mod(np.degrees(np.arctan2(b, a)), 360.), name+' Elevation harmonic Phase', 'degree')
+
+    with Dataset(output+'.tmp', 'w') as nc:
+        nc.createDimension('time_counter', None)
+        nc.createDimension('y', ny)
+        nc.createDimension('x', nx)
+        for name in ['nav_lat', 'nav_lon']:
+            nc.createVariable(name, 'f4', ('y', 'x'))[:] = info[name]
+        tvar = nc.createVariable('time_counter', 'f8', ('time_counter',))
+        tvar.units = info['units']
+        tvar.calendar = info['calendar']
+        tvar[0] = date2num(info['start'] + (info['end'] - info['start'])/2, info['units'], info['calendar'])
+        for name, (value, long_name, units) in fields.items():
+            out = nc.createVariable(name, 'f4', ('time_counter', 'y', 'x'), zlib=True, fill_value=np.float32(1.e20))
+            out.long_name = long_name
+            out.units = units
+            out[0, :, :] = np.ma.masked_invalid(value)
+        nc.constituents = ' '.join(fit.names)
+        nc.phase_reference = 'Greenwich phase lag. V0, u and f (tide_mod.F90) at ' + str(info['start'])
+        nc.time_coverage_start = str(info['start'])
+        nc.time_coverage_end = str(info['end'])
+        nc.records = fit.nrec
+        nc.source = source
+    os.replace(output+'.tmp', output)
+    print("write_harmonics: {} constituents from {} records written to {}".format(len(fit.names), fit.nrec, output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tidal harmonic analysis of NEMO output at every grid point.')
+    parser.add_argument('files', nargs='+',
+                help='NEMO output files or glob patterns (XIOS chunks), e.g. hourly grid_T')
+    parser.add_argument('--var', default='zos',
+                help='variable to analyse')
+    parser.add_argument('--constituents', nargs='+', default=DEFAULT_CONSTITUENTS, choices=DEFAULT_CONSTITUENTS,
+                help='constituents to fit')
+    parser.add_argument('--tlim', nargs=2, type=parse_time, metavar=('START', 'END'),
+                help='analysis period, e.g. 1995-01-01 1995-02-01')
+    parser.add_argument('--output', default='NEMO_harmonics.nc',
+                help='output NetCDF file')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    files = []
+    for pattern in args.files:
+        files += expand_nemo_files(pattern, args.tlim or [])
+    fit, info = analyse(files, args.var, args.constituents, args.tlim)
+    write_harmonics(args.output, fit, info, args.var, ' '.join(files))
+    print("NEMO_tidal_analysis: {:.1f}s".format(time.time()-t0))